@@ -1,12 +1,237 @@
-from google.cloud import storage
+from flaskr import storage
+from flaskr.cache import LRUCache, NegativeCache
+from flaskr.favorites import Favorites
+from flaskr.metrics import Counter, Metrics
+from flaskr.passwords import PasswordHasher
+from flaskr import passwords
+from flaskr.index import ImageIndex, LoggedIndex, PageIndex, StoredIndex, decode_cursor, encode_cursor
+from flaskr.render import RENDERER_VERSION, render_page
+from flaskr import revisions
+from flaskr.revisions import RevisionLog
+from flaskr.search import SearchIndex
+from flaskr import thumbnails
+from flaskr import compression
 from flask import Flask
+from google.api_core import exceptions
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import concurrent.futures
+import contextvars
 import io
-import hashlib
+import hmac
+import logging
+import threading
+import time
 from flask import Flask, render_template
 
 # Initialize:
 app = Flask(__name__)
 
+# Settings used when the config passed to `Backend` doesn't provide them.
+DEFAULT_CONFIG = {
+    # Storage driver behind the backend: "gcs", "memory" or "local".
+    'STORAGE_DRIVER': 'gcs',
+    # Directory holding the buckets of the "local" driver.
+    'STORAGE_ROOT': None,
+    # Number of pooled connections kept open to Cloud Storage.
+    'STORAGE_POOL_SIZE': storage.DEFAULT_POOL_SIZE,
+    # Seconds the "memory" and "local" drivers wait on every request.
+    'STORAGE_LATENCY': 0,
+    # How page text is stored: "gzip", "zstd" (with the zstandard package) or
+    # None for plain text. Pages shorter than PAGE_COMPRESSION_MIN_SIZE bytes
+    # are always stored plain. Either way, pages stored any other way are
+    # still read.
+    'PAGE_COMPRESSION': compression.GZIP,
+    'PAGE_COMPRESSION_MIN_SIZE': 1024,
+    # Maximum number of characters of page text kept in memory.
+    'PAGE_CACHE_SIZE': 32 * 1024 * 1024,
+    # Seconds a cached page is served before checking its generation again.
+    'PAGE_CACHE_TTL': 60,
+    # Maximum number of characters of rendered page HTML kept in memory. The
+    # HTML is checked again every PAGE_CACHE_TTL seconds, like the text.
+    'HTML_CACHE_SIZE': 32 * 1024 * 1024,
+    # Seconds before the page index is checked against its manifest again, so
+    # pages added by other instances show up.
+    'PAGE_INDEX_TTL': 300,
+    # Same as PAGE_INDEX_TTL, for the index of page images.
+    'IMAGE_INDEX_TTL': 300,
+    # Maximum number of users whose favorites are kept in memory.
+    'FAVORITES_CACHE_SIZE': 10000,
+    # Seconds before cached favorites are loaded again.
+    'FAVORITES_CACHE_TTL': 300,
+    # Seconds favorite changes wait so they can be written together.
+    'FAVORITES_FLUSH_DELAY': 1.0,
+    # Maximum number of users remembered as existing by `get_user`.
+    'USER_CACHE_SIZE': 10000,
+    # Seconds `get_user` trusts a cached answer.
+    'USER_CACHE_TTL': 60,
+    # Threads used to run independent storage requests concurrently.
+    'FETCH_POOL_SIZE': 16,
+    # Bytes downloaded per request when streaming a blob.
+    'STREAM_CHUNK_SIZE': 256 * 1024,
+    # Bytes sent per request by resumable uploads, rounded up to a multiple of
+    # 256KB. An interrupted upload resends at most one chunk.
+    'UPLOAD_CHUNK_SIZE': 8 * 1024 * 1024,
+    # Pages and images written or read together by bulk imports and exports,
+    # and the most bytes an import batch may hold in memory.
+    'BULK_BATCH_SIZE': 100,
+    'BULK_BATCH_BYTES': 32 * 1024 * 1024,
+    # Every how many revisions a page stores its full text rather than the
+    # changes since the previous revision. Lower keeps rebuilding an old
+    # revision cheap (it reads at most this many blobs), higher stores less.
+    'REVISION_SNAPSHOT_INTERVAL': 10,
+    # Widths, in pixels, of the resized copies made of uploaded images, and
+    # the quality they are compressed with.
+    'IMAGE_VARIANT_WIDTHS': thumbnails.DEFAULT_WIDTHS,
+    'IMAGE_VARIANT_QUALITY': thumbnails.DEFAULT_QUALITY,
+    # Maximum number of characters of rebuilt revisions kept in memory.
+    'REVISION_CACHE_SIZE': 8 * 1024 * 1024,
+    # Maximum number of images remembered by `get_image_assets`.
+    'ASSET_CACHE_SIZE': 256,
+    # Seconds before `get_image_assets` checks an image for a new generation.
+    'ASSET_CACHE_TTL': 300,
+    # Seconds before the search index is checked for changes made by other
+    # instances.
+    'SEARCH_INDEX_TTL': 300,
+    # Seconds search index changes wait so they can be logged together, and
+    # the bytes of logged changes after which a new snapshot is written.
+    'SEARCH_INDEX_FLUSH_DELAY': 1.0,
+    'SEARCH_INDEX_LOG_SIZE': 1024 * 1024,
+    # Maximum number of missing pages, images and users remembered.
+    'NEGATIVE_CACHE_SIZE': 10000,
+    # Processes hashing passwords, and how many hashes may be queued or running
+    # before logins and sign-ups are turned away.
+    'PASSWORD_HASH_WORKERS': 2,
+    'PASSWORD_HASH_MAX_PENDING': 8,
+    # Seconds a login waits for its hash before giving up.
+    'PASSWORD_HASH_TIMEOUT': 10.0,
+    # scrypt cost of new password hashes. Passwords hashed with another cost
+    # are hashed again on their next login.
+    'PASSWORD_SCRYPT_N': passwords.DEFAULT_N,
+    'PASSWORD_SCRYPT_R': passwords.DEFAULT_R,
+    'PASSWORD_SCRYPT_P': passwords.DEFAULT_P,
+    # Seconds a page, image or user is remembered as missing. Things created
+    # through other instances can take this long to show up.
+    'NEGATIVE_CACHE_TTL': 10,
+}
+
+# Manifest holding the names of every page, stored in the wiki-content bucket.
+PAGE_INDEX_MANIFEST = storage.META_PREFIX + 'page-index.json'
+
+# Manifest mapping pages to their image, stored in the web-uploads bucket.
+IMAGE_INDEX_MANIFEST = storage.META_PREFIX + 'image-index.json'
+
+# Manifest listing the resized variants of every image, stored in the
+# web-uploads bucket.
+IMAGE_VARIANTS_MANIFEST = storage.META_PREFIX + 'image-variants.json'
+
+# Prefix of the variants of every image, stored in the web-uploads bucket as
+# `<prefix><image blob>/<generation of the image>/<width>w.<extension>`.
+VARIANTS_PREFIX = storage.META_PREFIX + 'variants/'
+
+# Variants never change (a new upload gets new names), so they can be cached
+# for good.
+VARIANT_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Snapshot of the full-text search index, stored in the wiki-content bucket.
+SEARCH_INDEX_SNAPSHOT = storage.META_PREFIX + 'search-index.bin'
+
+# Pages written since that snapshot, stored in the wiki-content bucket.
+SEARCH_INDEX_LOG = storage.META_PREFIX + 'search-index.log.json'
+
+# Prefix of the rendered HTML of every page, stored in the wiki-content bucket
+# as `<prefix><page name>.html`.
+RENDERED_PREFIX = storage.META_PREFIX + 'html/'
+
+# Prefix of the revisions of every page, stored in the wiki-content bucket:
+# `<prefix><page name>/log.json` lists them, and each one is a blob of the
+# same directory named after the generation of the page it was written as.
+REVISIONS_PREFIX = storage.META_PREFIX + 'revisions/'
+
+# Extensions of the images that can be shown on a page, by order of preference
+# when a page has more than one.
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.webp']
+
+# How many times we reload and retry a manifest write that lost a race.
+MANIFEST_WRITE_ATTEMPTS = 5
+
+# Buckets of the upload throughput histogram, in bytes per second.
+UPLOAD_THROUGHPUT_BUCKETS = (1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7, 2.5e7,
+                             5e7, 1e8, 2.5e8, 1e9)
+
+logger = logging.getLogger(__name__)
+
+# A cached page: the generation and update time of its blob and the text it held.
+CachedPage = collections.namedtuple('CachedPage',
+                                    ['generation', 'updated', 'text'])
+
+# Rendered HTML of a page: the generation of the page blob it was rendered
+# from, the update time of that blob and the HTML.
+RenderedPage = collections.namedtuple('RenderedPage',
+                                      ['generation', 'updated', 'html'])
+
+# What identifies the current version of a page: the generation of its blob
+# and when it was last updated.
+PageInfo = collections.namedtuple('PageInfo', ['generation', 'updated'])
+
+# An image of the images bucket and its current generation (None if there is
+# no such image), enough to link to a versioned /image/ URL.
+ImageAsset = collections.namedtuple('ImageAsset', ['name', 'generation'])
+
+# The image of a page: the URL of the original, and the `srcset` of its WebP
+# variants and of its variants in a format every browser reads ("" when there
+# are none yet).
+PageImage = collections.namedtuple('PageImage',
+                                   ['url', 'webp_srcset', 'srcset'])
+
+# Everything the page view needs: the `PageInfo` of the page (None if it doesn't
+# exist), its rendered HTML (None if it doesn't exist or wasn't asked for), its
+# `PageImage` (None if it has none) and whether it is one of the user's
+# favorites.
+PageView = collections.namedtuple('PageView',
+                                  ['info', 'html', 'image', 'is_favorite'])
+
+# A page or image moved by `import_items` and `export_items`:
+#   kind         - "page" or "image".
+#   name         - Name of the page, or of the image blob.
+#   size         - Size of `data` in bytes.
+#   data         - The content, as bytes. Exported images are an iterable of
+#                  chunks instead, so they never have to fit in memory.
+#   content_type - Content type of images, None for pages.
+BulkItem = collections.namedtuple('BulkItem',
+                                  ['kind', 'name', 'size', 'data',
+                                   'content_type'])
+
+# What `import_items` did: how many pages and images it wrote, and how many
+# items it skipped because they existed already.
+ImportResult = collections.namedtuple('ImportResult',
+                                      ['pages', 'images', 'skipped'])
+
+# A file uploaded to storage: the name of its blob, its size in bytes, the
+# seconds it took, and the generation and update time it was stored with.
+UploadResult = collections.namedtuple(
+    'UploadResult', ['name', 'size', 'seconds', 'generation', 'updated'])
+
+
+class EditConflict(Exception):
+    """
+    Raised by `update_wiki_page` when the page changed since the version the
+    edit was made on.
+
+    Attributes:
+        page_name  - Name of the page.
+
+        expected   - Generation the edit was made on.
+
+        generation - Current generation of the page.
+    """
+
+    def __init__(self, page_name, expected, generation):
+        super().__init__(f"{page_name} changed since generation {expected}")
+        self.page_name = page_name
+        self.expected = expected
+        self.generation = generation
+
 
 class Backend:
     """
@@ -29,120 +254,1275 @@ class Backend:
 
 
     Attributes:
-        web_uploads_client  - 
+        config              - Settings for the backend, `DEFAULT_CONFIG` updated with
+                              whatever was passed in (usually the Flask `app.config`).
+
+        client              - The storage driver shared by every bucket below. Unless
+                              one is passed in, it is picked by `STORAGE_DRIVER`; the
+                              "gcs" driver uses the process-wide pooled client from
+                              `storage.get_client`.
+
+        storage             - `client` wrapped in a `storage.InstrumentedDriver`. The
+                              buckets below come from it, so their requests are
+                              reported to `metrics`.
+
+        metrics             - `Metrics` of the app: storage requests by operation and
+                              route, plus whatever the frontend records.
+
+        web_uploads_bucket  - Bucket holding the images uploaded alongside wiki pages.
+
+        wiki_content_bucket - Bucket holding the text of every wiki page.
+
+        password_bucket     - Bucket holding one blob per user with its hashed password.
+
+        images_bucket       - Bucket holding the images used by the about page.
+
+        favorites_bucket    - Bucket holding one object per user with their favorite
+                              pages.
+
+        favorites           - `Favorites` store caching and batching the writes to
+                              `favorites_bucket`.
 
-        wiki_content_client - 
+        passwords           - `PasswordHasher` running the password KDF in worker
+                              processes, with a bound on pending hashes.
 
-        web_uploads_bucket  - 
+        user_cache          - Cache of the users `get_user` found, so logged in users
+                              don't cost a storage request on every page.
 
-        wiki_content_bucket - 
+        executor            - Pool of `FETCH_POOL_SIZE` threads running independent
+                              storage requests side by side.
+
+        index_executor      - Thread indexing uploaded files after the upload request
+                              returned, one upload after the other.
+
+        asset_cache         - Cache of the `ImageAsset`s returned by `get_image_assets`.
+
+        page_cache          - LRU cache of page text keyed by page name, bounded by
+                              `PAGE_CACHE_SIZE` characters. Entries remember the blob
+                              generation they came from.
+
+        html_cache          - Same as `page_cache`, for the rendered HTML of the pages,
+                              bounded by `HTML_CACHE_SIZE` characters.
+
+        revision_cache      - LRU cache of the text of old revisions, keyed by page
+                              name and revision number. Revisions never change, so
+                              entries don't expire.
+
+        page_index          - Sorted index of every page name, loaded lazily from the
+                              `PAGE_INDEX_MANIFEST` blob by `get_all_page_names`.
+
+        image_index         - Index of the image blob uploaded for each page, loaded
+                              lazily from the `IMAGE_INDEX_MANIFEST` blob.
+
+        variant_index       - `thumbnails.VariantIndex` of the resized copies of each
+                              uploaded image, loaded lazily from the
+                              `IMAGE_VARIANTS_MANIFEST` blob. Variants are made on
+                              `index_executor` after uploads, or on first view for
+                              images uploaded before.
+
+        negative_cache      - `NegativeCache` of the pages, images and users recently
+                              found missing, with counters of the lookups it saved.
+
+        search_index        - Full-text `SearchIndex` of every page, loaded lazily from
+                              the `SEARCH_INDEX_SNAPSHOT` blob and the
+                              `SEARCH_INDEX_LOG` of pages written since. Writes
+                              only change it in memory, the log is written in
+                              batches from a timer thread.
     """
 
-    def __init__(self):
-        # Instantiate a new client for Cloud Storage
-        self.web_uploads_client = storage.Client()
-        self.wiki_content_client = storage.Client()
+    def __init__(self, config=None, client=None):
+        self.config = dict(DEFAULT_CONFIG)
+        if config is not None:
+            self.config.update(config)
+
+        if (self.config['PAGE_COMPRESSION'] == compression.ZSTD and
+                compression.ZSTD not in compression.available_encodings()):
+            logger.warning("zstandard is not installed, storing pages with gzip")
+            self.config['PAGE_COMPRESSION'] = compression.GZIP
+
+        # Every bucket shares one client, and therefore one connection pool.
+        if client is None:
+            client = storage.make_client(self.config)
+        self.client = client
+
+        # Every storage request made through the buckets below is timed and
+        # counted, see `metrics`
+        self.metrics = Metrics()
+        self.metrics.add_collector(self._collect_metrics)
+        self.storage = storage.InstrumentedDriver(client,
+                                                  self.metrics.record_storage)
+        self.upload_bytes = self.metrics.counter(
+            'wiki_upload_bytes_total', 'Bytes uploaded, by kind.', ['kind'])
+        self.upload_seconds = self.metrics.histogram(
+            'wiki_upload_seconds', 'Duration of uploads, by kind.', ['kind'])
+        self.upload_throughput = self.metrics.histogram(
+            'wiki_upload_bytes_per_second', 'Throughput of uploads, by kind.',
+            ['kind'], buckets=UPLOAD_THROUGHPUT_BUCKETS)
+        self.upload_in_flight = self.metrics.gauge(
+            'wiki_upload_bytes_in_flight',
+            'Bytes read from uploads and not stored yet.')
+        self.upload_in_flight.set(0)
 
         # Get a reference to the web-uploads bucket
-        self.web_uploads_bucket = self.web_uploads_client.bucket('web-uploads')
+        self.web_uploads_bucket = self.storage.bucket('web-uploads')
 
         # Get a reference to the wiki-content bucket
-        self.wiki_content_bucket = self.wiki_content_client.bucket('wiki-content-bucket')
+        self.wiki_content_bucket = self.storage.bucket('wiki-content-bucket')
 
         # Set the default bucket to wiki-content-bucket
         self.bucket = self.wiki_content_bucket
 
-        # Initiate buckets and clients for `sign_in` and `sign_up` methods
-
-        self.user_client = storage.Client(project='sds-project-1')
-        self.password_bucket = self.user_client.bucket("passwords-bucket")
+        # Bucket for `sign_in` and `sign_up` methods
+        self.password_bucket = self.storage.bucket("passwords-bucket")
 
         # Create a bucket for the images-bucket
-        self.images_client = storage.Client()
-        self.images_bucket = self.images_client.bucket('img__bucket')
+        self.images_bucket = self.storage.bucket('img__bucket')
+
+        # Full-text index of every page, loaded on first use
+        self.search_index = LoggedIndex(
+            SEARCH_INDEX_SNAPSHOT, SEARCH_INDEX_LOG, SearchIndex,
+            self._read_all_pages,
+            ttl=self.config['SEARCH_INDEX_TTL'],
+            flush_delay=self.config['SEARCH_INDEX_FLUSH_DELAY'],
+            log_size=self.config['SEARCH_INDEX_LOG_SIZE'],
+            attempts=MANIFEST_WRITE_ATTEMPTS)
+
+        # Favorites of every user, one object each
+        self.favorites_bucket = self.storage.bucket('favorites-bucket')
+        self.favorites = Favorites(
+            self.favorites_bucket,
+            cache_size=self.config['FAVORITES_CACHE_SIZE'],
+            ttl=self.config['FAVORITES_CACHE_TTL'],
+            flush_delay=self.config['FAVORITES_FLUSH_DELAY'],
+            legacy_client=self.storage)
+
+        # Pages, images and users we know don't exist
+        self.negative_cache = NegativeCache(self.config['NEGATIVE_CACHE_SIZE'],
+                                            ttl=self.config['NEGATIVE_CACHE_TTL'])
+
+        # Hashes passwords in worker processes
+        self.passwords = PasswordHasher(
+            workers=self.config['PASSWORD_HASH_WORKERS'],
+            max_pending=self.config['PASSWORD_HASH_MAX_PENDING'],
+            timeout=self.config['PASSWORD_HASH_TIMEOUT'],
+            n=self.config['PASSWORD_SCRYPT_N'],
+            r=self.config['PASSWORD_SCRYPT_R'],
+            p=self.config['PASSWORD_SCRYPT_P'])
+
+        # Users we know exist
+        self.user_cache = LRUCache(self.config['USER_CACHE_SIZE'],
+                                   ttl=self.config['USER_CACHE_TTL'])
+
+        # Versions of the images used by our own pages
+        self.asset_cache = LRUCache(self.config['ASSET_CACHE_SIZE'],
+                                    ttl=self.config['ASSET_CACHE_TTL'])
+
+        # Threads for fetching several things at once
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.config['FETCH_POOL_SIZE'],
+            thread_name_prefix='backend-fetch')
+
+        # A single thread, so uploads of the same page are indexed in order
+        self.index_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='backend-index')
+
+        # The text of the most read pages is kept in memory
+        self.page_cache = LRUCache(self.config['PAGE_CACHE_SIZE'],
+                                   ttl=self.config['PAGE_CACHE_TTL'],
+                                   sizeof=lambda page: len(page.text))
+
+        # And so is their rendered HTML
+        self.html_cache = LRUCache(self.config['HTML_CACHE_SIZE'],
+                                   ttl=self.config['PAGE_CACHE_TTL'],
+                                   sizeof=lambda page: len(page.html))
+
+        # Old revisions, rebuilt from their snapshot and deltas
+        self.revision_cache = LRUCache(self.config['REVISION_CACHE_SIZE'],
+                                       sizeof=len)
+
+        # The names of every page, loaded on first use
+        self.page_index = StoredIndex(PAGE_INDEX_MANIFEST, PageIndex,
+                                      self._list_page_names,
+                                      ttl=self.config['PAGE_INDEX_TTL'],
+                                      attempts=MANIFEST_WRITE_ATTEMPTS)
+
+        # The image uploaded for each page, loaded on first use
+        self.image_index = StoredIndex(IMAGE_INDEX_MANIFEST, ImageIndex,
+                                       self._list_page_images,
+                                       ttl=self.config['IMAGE_INDEX_TTL'],
+                                       attempts=MANIFEST_WRITE_ATTEMPTS)
+
+        # The resized copies of each image, loaded on first use. Variants are
+        # only made by us, so there is nothing to build from.
+        self.variant_index = StoredIndex(IMAGE_VARIANTS_MANIFEST,
+                                         thumbnails.VariantIndex,
+                                         lambda bucket: {},
+                                         ttl=self.config['IMAGE_INDEX_TTL'],
+                                         attempts=MANIFEST_WRITE_ATTEMPTS)
+        # Images whose variants are being made
+        self._pending_variants = set()
+        self._pending_variants_lock = threading.Lock()
+
+    def warm_up(self):
+        """
+        Does the work otherwise left to the first requests: builds the storage
+        client, loads the page, image and search indexes and starts the
+        password hashing processes.
+        """
+        self._get_page_index()
+        self.image_index.get(self.web_uploads_bucket)
+        self.search_index.get(self.bucket)
+        self.passwords.warm_up()
+
+    def _collect_metrics(self):
+        # The negative cache keeps its own counters, read them when scraped
+        hits = Counter('wiki_negative_cache_hits_total',
+                       'Lookups answered by the negative cache, by kind.',
+                       ['kind'])
+        misses = Counter('wiki_negative_cache_misses_total',
+                         'Lookups the negative cache could not answer, by kind.',
+                         ['kind'])
+        for kind, stats in self.negative_cache.stats().items():
+            hits.inc(kind, amount=stats['hits'])
+            misses.inc(kind, amount=stats['misses'])
+        return [hits, misses]
 
     def create_wiki_page(self, page_name, content, author=None):
+        """
+        Creates a new page. The write only succeeds if there is no page with
+        this name yet, so two users creating the same page at once can't
+        overwrite each other.
+
+        Returns:
+            The name of the page, or None if it already exists.
+        """
         # Create a new blob in the wiki-content bucket with the provided page_name
         blob = self.wiki_content_bucket.blob(f"{page_name}.txt")
 
-        # Set the content of the blob to the provided content
-        blob.upload_from_string(content)
+        # Set the content of the blob to the provided content, as long as no
+        # blob exists yet (generation 0)
+        try:
+            blob.upload_from_string(*self._encode_page(content),
+                                    if_generation_match=0)
+        except exceptions.PreconditionFailed:
+            return None
+
+        # We already know the new text, so write it through to the cache
+        self.negative_cache.discard('page', page_name)
+        self.page_cache.set(
+            page_name, CachedPage(blob.generation, blob.updated, content))
+        self._store_rendered(page_name, content, blob.generation, blob.updated)
+        self._schedule_revision(page_name, content, blob, author=author)
+        self._add_to_page_index(page_name)
+        self._add_to_search_index(page_name, content)
 
         # Return the name of the newly created page
         return page_name
 
-    def update_wiki_page(self, page_name, content):
-        # Get a reference to the blob that contains the content for the specified page
-        blob = self.bucket.get_blob(f"{page_name}.txt")
+    def update_wiki_page(self, page_name, content, generation=None,
+                         author=None):
+        """
+        Replaces the text of a page, in a single conditional write: it only
+        succeeds if the page is still at `generation`, so an edit made in
+        between is never lost silently.
 
-        if blob is not None:
-            # Update the content of the blob with the provided content
-            blob.upload_from_string(content)
+        Args:
+            page_name - Name of the page.
 
-            # Return the name of the updated page
-            return page_name
+            content - The new text.
 
-        else:
-            # If the blob does not exist, return None
+            generation - Generation of the page the edit was made on, as
+            returned by `get_page_info`. By default, the generation we last saw.
+
+            author - Who made the edit, recorded in the history of the page.
+            The revision is recorded afterwards on `index_executor`, call
+            `flush_indexing` to wait until it is.
+
+        Returns:
+            The name of the page, or None if the page doesn't exist.
+
+        Raises:
+            EditConflict if the page was changed since `generation`.
+        """
+        if generation is None:
+            # Free when the page is cached, a metadata request otherwise
+            info = self.get_page_info(page_name)
+            if info is None:
+                # If the blob does not exist, return None
+                return None
+            generation = info.generation
+
+        # The text we replace, if we have it, so the new revision can be
+        # stored as a delta without rebuilding the previous one
+        cached = self.page_cache.get_stale(page_name)
+        previous = (cached.text if cached is not None and
+                    cached.generation == generation else None)
+
+        blob = self.bucket.blob(f"{page_name}.txt")
+        try:
+            blob.upload_from_string(*self._encode_page(content),
+                                    if_generation_match=generation)
+        except exceptions.PreconditionFailed:
+            # Either someone else saved the page first or it was deleted, our
+            # copies of it are out of date either way
+            self.page_cache.invalidate(page_name)
+            self.html_cache.invalidate(page_name)
+            current = self.get_page_info(page_name)
+            if current is None:
+                return None
+            raise EditConflict(page_name, generation, current.generation)
+
+        self.negative_cache.discard('page', page_name)
+        self.page_cache.set(
+            page_name, CachedPage(blob.generation, blob.updated, content))
+        self._store_rendered(page_name, content, blob.generation, blob.updated)
+        self._schedule_revision(page_name, content, blob, author=author,
+                                base_generation=generation, previous=previous)
+        self._add_to_search_index(page_name, content)
+
+        # Return the name of the updated page
+        return page_name
+
+    def get_revisions(self, page_name):
+        """
+        Returns the history of a page, as a list of `revisions.Revision`,
+        oldest first. Empty if the page has no recorded revision: history
+        starts with the first write made once revisions were introduced.
+        """
+        return self._load_revision_log(page_name).revisions
+
+    def get_revision(self, page_name, number):
+        """
+        Returns the text of revision `number` of a page (1 being the first).
+
+        The text is rebuilt from the closest full snapshot and the deltas after
+        it, all downloaded at once, so it costs at most
+        `REVISION_SNAPSHOT_INTERVAL` reads however long the history is. The
+        current text is better read with `get_wiki_page`, in a single read.
+
+        Returns:
+            The text, or None if there is no such revision.
+        """
+        cached = self.revision_cache.get((page_name, number))
+        if cached is not None:
+            return cached
+        return self._rebuild_revision(page_name,
+                                      self._load_revision_log(page_name),
+                                      number)
+
+    def diff_revisions(self, page_name, old, new):
+        """
+        Returns the unified diff between revisions `old` and `new` of a page, as
+        a list of lines, or None if either doesn't exist.
+        """
+        log = self._load_revision_log(page_name)
+        texts = self._rebuild_revisions(page_name, log, [old, new])
+        if None in texts:
             return None
+        return revisions.diff(texts[0], texts[1], f"{page_name} r{old}",
+                              f"{page_name} r{new}")
+
+    def _revision_log_name(self, page_name):
+        return f"{REVISIONS_PREFIX}{page_name}/log.json"
+
+    def _load_revision_log(self, page_name):
+        # Downloading sets the generation, so this is a single read
+        blob = self.bucket.blob(self._revision_log_name(page_name))
+        try:
+            data = blob.download_as_bytes()
+        except exceptions.NotFound:
+            return RevisionLog()
+        return RevisionLog.loads(data, blob.generation)
+
+    def _rebuild_revision(self, page_name, log, number):
+        return self._rebuild_revisions(page_name, log, [number])[0]
+
+    def _rebuild_revisions(self, page_name, log, numbers):
+        # Rebuilds several revisions of a page, downloading the blobs of all
+        # their chains in a single `fetch_all`: the rebuilds must not run on the
+        # fetch pool themselves, waiting there on downloads that need its
+        # threads. Returns the texts in the order of `numbers`, None for those
+        # that don't exist.
+        plans = []
+        for number in numbers:
+            chain = log.chain(number)
+            if chain is None:
+                plans.append(None)
+                continue
+
+            # Start from the latest revision of the chain we still have in
+            # memory
+            text = None
+            for start in range(len(chain) - 1, -1, -1):
+                text = self.revision_cache.get((page_name, chain[start].number))
+                if text is not None:
+                    chain = chain[start + 1:]
+                    break
+            plans.append((text, chain))
+
+        def read(name):
+            return self.bucket.blob(name).download_as_text()
+
+        # Chains of close revisions share most of their blobs
+        names = list(dict.fromkeys(revision.blob for plan in plans if plan
+                                   for revision in plan[1]))
+        contents = dict(zip(names,
+                            self.fetch_all(*[(read, name) for name in names])))
+
+        texts = []
+        for plan in plans:
+            if plan is None:
+                texts.append(None)
+                continue
+            text, chain = plan
+            for revision in chain:
+                if revision.kind == revisions.FULL:
+                    text = contents[revision.blob]
+                else:
+                    text = revisions.apply_delta(text, contents[revision.blob])
+                self.revision_cache.set((page_name, revision.number), text)
+            texts.append(text)
+        return texts
+
+    def _schedule_revision(self, page_name, content, blob, author=None,
+                           base_generation=None, previous=None):
+        # Records the revision on `index_executor`, so the write doesn't wait
+        # for the revision log. Its single thread records the revisions of a
+        # page in the order they were written, which keeps the deltas valid.
+        def record():
+            try:
+                self._record_revision(page_name, content, blob, author=author,
+                                      base_generation=base_generation,
+                                      previous=previous)
+            except Exception:
+                # Nobody waits for this in the background, don't lose the error
+                logger.exception("Failed to record revision %s of %s",
+                                 blob.generation, page_name)
+                raise
+
+        self.index_executor.submit(record)
+
+    def _record_revision(self, page_name, content, blob, author=None,
+                         base_generation=None, previous=None):
+        # Adds the text just written as `blob` (or `UploadResult`, anything
+        # with its generation and update time) to the history of the page. It
+        # is stored as a delta from the previous revision when that revision
+        # is the version the write replaced, and as a full snapshot otherwise
+        # or every REVISION_SNAPSHOT_INTERVAL revisions.
+        interval = self.config['REVISION_SNAPSHOT_INTERVAL']
+        updated = blob.updated.isoformat() if blob.updated else None
+
+        for _ in range(MANIFEST_WRITE_ATTEMPTS):
+            log = self._load_revision_log(page_name)
+            if log.find(blob.generation) is not None:
+                # Recorded already
+                return
+
+            last = log.last()
+            can_delta = (last is not None and base_generation is not None and
+                         last.generation == base_generation and
+                         log.since_snapshot() + 1 < interval)
+            if can_delta and previous is None:
+                previous = self._rebuild_revision(page_name, log, last.number)
+
+            if can_delta and previous is not None:
+                kind, data = revisions.DELTA, revisions.make_delta(previous,
+                                                                   content)
+            else:
+                kind, data = revisions.FULL, content
+
+            name = f"{REVISIONS_PREFIX}{page_name}/{blob.generation}.{kind}"
+            self.bucket.blob(name).upload_from_string(
+                data, content_type='text/plain; charset=utf-8')
+
+            number = len(log) + 1
+            log.add(revisions.Revision(number, kind, name, blob.generation,
+                                       updated, author, len(content)))
+            self.revision_cache.set((page_name, number), content)
+
+            log_blob = self.bucket.blob(self._revision_log_name(page_name))
+            try:
+                log_blob.upload_from_string(log.dumps(),
+                                            content_type=log.content_type,
+                                            if_generation_match=log.generation)
+                return
+            except exceptions.PreconditionFailed:
+                # Another revision was recorded meanwhile, start over from it
+                self.revision_cache.invalidate((page_name, number))
+
+        logger.warning("Gave up recording revision %s of %s", blob.generation,
+                       page_name)
 
     def get_all_page_names(self):
+        # The names come from the page index, which only lists the bucket
+        # when there is no manifest yet
+        return self._get_page_index().names()
+
+    def get_page_names(self, prefix='', limit=None, cursor=None):
+        """
+        Returns one page of the sorted page names, straight from the page index.
+
+        Args:
+            prefix - Only return pages whose name starts with this.
+
+            limit - Maximum number of names to return, all of them if None.
+
+            cursor - The `next_cursor` returned for the previous page, or None
+            to start from the beginning.
+
+        Returns:
+            A (names, next_cursor) tuple. `next_cursor` is None on the last page.
+
+        Raises:
+            ValueError if the cursor is not valid.
+        """
+        start_after = decode_cursor(cursor) if cursor else None
+        names, has_more = self._get_page_index().page(prefix, start_after, limit)
+        next_cursor = encode_cursor(names[-1]) if has_more else None
+        return names, next_cursor
+
+    def rebuild_page_index(self):
+        """
+        Rebuilds the page index from a full listing of the content bucket and
+        stores it as the new manifest. Only needed if the manifest got out of
+        sync with the bucket, for example after pages were copied in by hand.
+        """
+        return self.page_index.rebuild(self.bucket).names()
+
+    def _list_page_names(self, bucket):
         # List all the blobs in the wiki-content bucket
-        blobs = self.bucket.list_blobs()
+        blobs = bucket.list_blobs()
 
         # Extract the name of each blob (page) and add it to a list
         page_names = []
         for blob in blobs:
-            # Ignore blobs that are not files (i.e., folders)
-            if not blob.name.endswith('/'):
+            # Ignore blobs that are not files (i.e., folders) or that hold our own data
+            if not blob.name.endswith('/') and not blob.name.startswith(
+                    storage.META_PREFIX):
                 # Extract the page name from the blob name (remove the file extension)
                 page_name = blob.name.split('.')[0]
                 page_names.append(page_name)
 
         return page_names
 
+    def _get_page_index(self):
+        return self.page_index.get(self.bucket)
+
+    def _add_to_page_index(self, page_name):
+        self.page_index.update(self.bucket, lambda index: index.add(page_name))
+
+    def search(self, query, limit=20):
+        """
+        Full-text search over every page. Queries are answered from the index in
+        memory, without any storage request once the index is loaded.
+
+        Args:
+            query - Words to look for. Words between double quotes must appear as
+            an exact phrase.
+
+            limit - Maximum number of results.
+
+        Returns:
+            A list of `SearchResult` (page name and score), best match first.
+        """
+        return self.search_index.read(self.bucket,
+                                      lambda index: index.search(query, limit))
+
+    def rebuild_search_index(self):
+        """
+        Rebuilds the search index by reading every page, and stores it as the
+        new snapshot.
+        """
+        return len(self.search_index.rebuild(self.bucket))
+
+    def _add_to_search_index(self, page_name, content):
+        self.search_index.update(self.bucket, [(page_name, content)])
+
+    def _read_all_pages(self, bucket):
+        # Used to build the search index when there is no snapshot yet
+        names = [
+            blob.name for blob in bucket.list_blobs()
+            if blob.name.endswith('.txt') and
+            not blob.name.startswith(storage.META_PREFIX)
+        ]
+
+        def read(name):
+            try:
+                return self._decode_page(bucket.blob(name).download_as_bytes())
+            except exceptions.NotFound:
+                # Deleted while we were reading the others
+                return None
+
+        texts = self.fetch_all(*[(read, name) for name in names])
+        return [(name[:-len('.txt')], text)
+                for name, text in zip(names, texts)
+                if text is not None]
+
     def get_wiki_page(self, page_name):
+        # Pages read in the last PAGE_CACHE_TTL seconds are served from memory
+        cached = self.page_cache.get(page_name)
+        if cached is not None:
+            return cached.text
+
         # Get a reference to the blob that contains the content for the specified page
-        blob = self.bucket.get_blob(f"{page_name}.txt")
+        blob = self._get_page_blob(page_name)
 
         if blob is not None:
-            # Download the content from the blob
-            content = blob.download_as_text()
+            # If the cached copy expired but the blob hasn't changed since,
+            # we can keep it and skip the download.
+            stale = self.page_cache.get_stale(page_name)
+            if stale is not None and stale.generation == blob.generation:
+                content = stale.text
+            else:
+                # Download the content from the blob
+                content = self._decode_page(blob.download_as_bytes())
+
+            self.page_cache.set(
+                page_name, CachedPage(blob.generation, blob.updated, content))
 
             # Return the content
             return content
 
         else:
             # If the blob does not exist, return None
+            self.page_cache.invalidate(page_name)
             return None
 
-    def get_wiki_image(self, image_name):
+    def _encode_page(self, content):
+        # Returns the data and content type to store the text of a page with
+        data = content.encode('utf-8')
+        encoding = self.config['PAGE_COMPRESSION']
+        if not encoding or len(data) < self.config['PAGE_COMPRESSION_MIN_SIZE']:
+            return data, 'text/plain; charset=utf-8'
+        return (compression.compress(data, encoding),
+                compression.CONTENT_TYPES[encoding])
+
+    def _decode_page(self, data):
+        # Pages may be stored compressed or not, see `compression`
+        return compression.decompress(data).decode('utf-8', errors='replace')
+
+    def get_page_info(self, page_name):
+        """
+        Returns the generation and update time of a page without downloading it,
+        for building HTTP validators. Pages in the page cache don't need any
+        request at all.
+
+        Args:
+            page_name - Name of the page.
+
+        Returns:
+            A `PageInfo`, or None if the page doesn't exist.
+        """
+        for cache in (self.page_cache, self.html_cache):
+            cached = cache.get(page_name)
+            if cached is not None:
+                return PageInfo(cached.generation, cached.updated)
+
+        blob = self._get_page_blob(page_name)
+        if blob is None:
+            self.page_cache.invalidate(page_name)
+            self.html_cache.invalidate(page_name)
+            return None
+
+        # An expired copy of the same generation is good for another TTL
+        for cache in (self.page_cache, self.html_cache):
+            stale = cache.get_stale(page_name)
+            if stale is not None and stale.generation == blob.generation:
+                cache.set(page_name, stale)
+
+        return PageInfo(blob.generation, blob.updated)
+
+    def _get_page_blob(self, page_name):
+        # Links to missing pages are followed over and over (by bots, mostly),
+        # so remember for a while that they don't exist
+        if self.negative_cache.is_missing('page', page_name):
+            return None
+
+        blob = self.bucket.get_blob(f"{page_name}.txt")
+        if blob is None:
+            self.negative_cache.add('page', page_name)
+        return blob
+
+    def get_page_html(self, page_name):
+        """
+        Returns the rendered HTML of a page.
+
+        Pages are rendered when they are written and the HTML is stored next to
+        their text, so reading a page costs the same however complex its
+        formatting is. HTML rendered from an older generation of the page or by
+        an older `RENDERER_VERSION` is rendered again and stored, the first time
+        it is read.
+
+        Args:
+            page_name - Name of the page.
+
+        Returns:
+            The HTML, safe to insert in a template as is, or None if the page
+            doesn't exist.
+        """
+        cached = self.html_cache.get(page_name)
+        if cached is not None:
+            return cached.html
+
+        # Also brings back the cached HTML if the page didn't change since
+        info = self.get_page_info(page_name)
+        if info is None:
+            return None
+
+        cached = self.html_cache.get(page_name)
+        if cached is not None and cached.generation == info.generation:
+            return cached.html
+
+        blob = self.bucket.get_blob(self._rendered_name(page_name))
+        metadata = (blob.metadata or {}) if blob is not None else {}
+        if (metadata.get('renderer-version') == str(RENDERER_VERSION) and
+                metadata.get('source-generation') == str(info.generation)):
+            html = blob.download_as_text()
+            self.html_cache.set(
+                page_name, RenderedPage(info.generation, info.updated, html))
+            return html
+
+        # Missing or out of date, render the text again
+        content = self.get_wiki_page(page_name)
+        source = self.page_cache.get_stale(page_name)
+        if content is None or source is None:
+            return None
+        return self._store_rendered(page_name, content, source.generation,
+                                    source.updated)
+
+    def _rendered_name(self, page_name):
+        return f"{RENDERED_PREFIX}{page_name}.html"
+
+    def _store_rendered(self, page_name, content, generation, updated):
+        # Renders the text of a page and stores the HTML, tagged with the
+        # generation of the text and the renderer version that produced it
+        html = render_page(content)
+
+        blob = self.bucket.blob(self._rendered_name(page_name))
+        blob.metadata = {
+            'renderer-version': str(RENDERER_VERSION),
+            'source-generation': str(generation),
+        }
+        blob.upload_from_string(html, content_type='text/html; charset=utf-8')
+
+        self.html_cache.set(page_name, RenderedPage(generation, updated, html))
+        return html
+
+    def get_page_view(self, page_name, username=None, html=True):
+        """
+        Fetches everything the page view shows: the info and HTML of the page,
+        its image and whether it is one of the user's favorites. None of these
+        depend on each other, so they are fetched concurrently and the whole
+        call takes about as long as the slowest of them.
+
+        Args:
+            page_name - Name of the page.
+
+            username - The current user, or None if nobody is logged in.
 
-        accepted_extensions = ['.png', '.jpg', '.jpeg', '.gif', '.webp']
+            html - Whether to fetch the HTML too. The page view leaves it out
+            until it knows the browser's copy is stale.
 
-        for extension in accepted_extensions:
-            blob = self.web_uploads_bucket.get_blob(image_name + extension)
+        Returns:
+            A `PageView`. Its `info` and `html` are None if the page doesn't
+            exist.
+        """
+        calls = [
+            (self.get_page_info, page_name),
+            (self.get_page_image, page_name),
+            (self.is_favorite, page_name, username),
+        ]
+        if html:
+            calls.append((self.get_page_html, page_name))
+        info, image, is_favorite, *rest = self.fetch_all(*calls)
+        return PageView(info, rest[0] if rest else None, image, is_favorite)
+
+    def fetch_all(self, *calls):
+        """
+        Runs independent backend calls concurrently on the fetch pool.
 
+        Args:
+            calls - Tuples of a function followed by its arguments.
 
-            if blob:
-                image = blob.public_url
-                return image
+        Returns:
+            The list of results, in the same order as `calls`. If a call raised,
+            the exception is raised once every call is done.
+
+        The calls must not use `fetch_all` themselves: waiting on the pool from
+        one of its threads hangs once every thread does the same.
+        """
+        # Each call runs in a copy of our context, so its storage requests
+        # still count towards the HTTP request being served
+        futures = [
+            self.executor.submit(contextvars.copy_context().run, *call)
+            for call in calls
+        ]
+        concurrent.futures.wait(futures)
+        return [future.result() for future in futures]
+
+    def get_wiki_image(self, image_name):
+        # The image index knows which blob (if any) was uploaded for the page,
+        # so there is no need to probe every extension
+        blob_name = self.image_index.get(self.web_uploads_bucket).get(image_name)
+
+        if blob_name is not None:
+            # Building the public URL doesn't make any request
+            return self.web_uploads_bucket.blob(blob_name).public_url
 
         return None
 
+    def get_page_image(self, page_name):
+        """
+        Returns the image of a page with its resized variants, from the image
+        and variant indexes, so without any storage request once they are
+        loaded. Variants of an image that has none yet are made in the
+        background, the page shows the original meanwhile.
+
+        Returns:
+            A `PageImage`, or None if the page has no image.
+        """
+        blob_name = self.image_index.get(self.web_uploads_bucket).get(page_name)
+        if blob_name is None:
+            return None
+
+        url = self.web_uploads_bucket.blob(blob_name).public_url
+        variants = self._get_variants(blob_name)
+
+        def srcset(webp):
+            return ', '.join(
+                f"{self.web_uploads_bucket.blob(variant.name).public_url} "
+                f"{variant.width}w"
+                for variant in variants
+                if (variant.content_type == thumbnails.WEBP) == webp)
+
+        return PageImage(url, srcset(True), srcset(False))
+
+    def pick_image_variant(self, page_name, width, webp=False):
+        """
+        Returns the URL of the smallest image of a page at least `width` pixels
+        wide: one of its variants, or the original if none is big enough.
+
+        Args:
+            page_name - Name of the page.
+
+            width - Width the image is displayed at, in device pixels.
+
+            webp - Whether the client reads WebP.
+
+        Returns:
+            The URL, or None if the page has no image.
+        """
+        blob_name = self.image_index.get(self.web_uploads_bucket).get(page_name)
+        if blob_name is None:
+            return None
+
+        # WebP variants are smaller, when the client reads them
+        variants = self._get_variants(blob_name)
+        if webp:
+            variants = sorted(variants, key=lambda variant:
+                              variant.content_type != thumbnails.WEBP)
+        for variant in variants:
+            if (variant.width >= width and
+                    (webp or variant.content_type != thumbnails.WEBP)):
+                return self.web_uploads_bucket.blob(variant.name).public_url
+        return self.web_uploads_bucket.blob(blob_name).public_url
+
+    def _get_variants(self, blob_name):
+        # Variants of an image, smallest first. The first time an image without
+        # any is asked for, they are made in the background.
+        variants = self.variant_index.get(self.web_uploads_bucket).get(blob_name)
+        if variants is None:
+            self._schedule_variants(blob_name)
+            return []
+        return variants
+
+    def _schedule_variants(self, blob_name):
+        if not thumbnails.available():
+            return
+        with self._pending_variants_lock:
+            if blob_name in self._pending_variants:
+                return
+            self._pending_variants.add(blob_name)
+
+        def make():
+            try:
+                self.make_image_variants(blob_name)
+            finally:
+                with self._pending_variants_lock:
+                    self._pending_variants.discard(blob_name)
+
+        self.index_executor.submit(make)
+
+    def make_image_variants(self, blob_name):
+        """
+        Makes the resized variants of an uploaded image, stores them next to
+        it and records them in the variant index, in place of the variants of
+        its previous version. Those are left in storage, other instances may
+        still link to them until they reload the index. Does nothing if the
+        variants of the current version exist already.
+
+        Returns:
+            The list of `thumbnails.Variant`, or None if the image doesn't
+            exist or Pillow isn't installed.
+        """
+        if not thumbnails.available():
+            return None
+
+        try:
+            blob = self.web_uploads_bucket.get_blob(blob_name)
+            if blob is None:
+                return None
+
+            index = self.variant_index.get(self.web_uploads_bucket)
+            if index.source_generation(blob_name) == blob.generation:
+                return index.get(blob_name)
+
+            try:
+                data = blob.download_as_bytes(if_generation_match=blob.generation)
+            except (exceptions.PreconditionFailed, exceptions.NotFound):
+                # Replaced or deleted meanwhile, whoever did it makes new ones
+                return None
+
+            variants = []
+            made = thumbnails.make_variants(
+                data, self.config['IMAGE_VARIANT_WIDTHS'],
+                self.config['IMAGE_VARIANT_QUALITY'])
+            for width, content_type, variant_data in made:
+                name = (f"{VARIANTS_PREFIX}{blob_name}/{blob.generation}/"
+                        f"{width}w{thumbnails.extension(content_type)}")
+                variant_blob = self.web_uploads_bucket.blob(name)
+                variant_blob.cache_control = VARIANT_CACHE_CONTROL
+                variant_blob.upload_from_string(variant_data,
+                                                content_type=content_type)
+                variants.append(thumbnails.Variant(width, content_type, name))
+
+            self.variant_index.update(
+                self.web_uploads_bucket,
+                lambda index: index.add(blob_name, blob.generation, variants))
+            return variants
+        except Exception:
+            # Runs in the background, don't lose the error
+            logger.exception("Failed to make the variants of %s", blob_name)
+            raise
+
+    def _list_page_images(self, bucket):
+        # Used once to build the image index from the blobs already uploaded
+        images = {}
+        ranks = {}
+        for blob in bucket.list_blobs():
+            if blob.name.startswith(storage.META_PREFIX):
+                continue
+
+            page_name, dot, extension = blob.name.rpartition('.')
+            extension = dot + extension.lower()
+            if not page_name or extension not in IMAGE_EXTENSIONS:
+                continue
+
+            # Keep the same image the old extension probing would have found
+            rank = IMAGE_EXTENSIONS.index(extension)
+            if page_name not in images or rank < ranks[page_name]:
+                images[page_name] = blob.name
+                ranks[page_name] = rank
+
+        return images
+
     def upload(self, file):
-        # Create a new blob in the web-uploads bucket and upload the file data
+        """
+        Uploads a page file (its text if it's a .txt, anything else otherwise)
+        and indexes it before returning.
+
+        Args:
+            file - File-like object with a `filename`, named after the page.
+
+        Returns:
+            The `UploadResult`.
+        """
+        result = self._stream_upload(self.bucket, file, 'page')
+        page_name, extension = self._uploaded_page(file.filename)
 
-        # Make sure that the blob doesn't already exist, or should this be allowed as to update pages?
+        # Text files are the content of the page, and we still have it
+        content = None
+        if extension == 'txt':
+            file.seek(0)
+            content = file.read()
 
-        blob = self.bucket.blob(file.filename)
-        blob.upload_from_file(file)
+        self._index_page_upload(page_name, extension, result, content)
+        return result
 
     # This will be used solely for upload image-type files, the method
     # above should then be used to only upload text-type files 
     def upload_image(self, image):
-        blob = self.web_uploads_bucket.blob(image.filename)
-        blob.upload_from_file(image)
+        result = self._stream_upload(self.web_uploads_bucket, image, 'image')
+        self._index_image_upload(image.filename)
+        self._schedule_variants(image.filename)
+        return result
+
+    def upload_page_files(self, file, image=None):
+        """
+        Uploads the file of a page and, if given, its image at the same time,
+        streaming each from its file object in `UPLOAD_CHUNK_SIZE` chunks.
+
+        Only the caches are updated before returning. The page and image
+        indexes, the rendered HTML and the search index are updated afterwards
+        on `index_executor`, so the upload request doesn't wait for them. Call
+        `flush_indexing` to wait until they are.
+
+        Args:
+            file - Page file, like for `upload`.
+
+            image - Image file, like for `upload_image`, or None.
+
+        Returns:
+            The `UploadResult` of the page file, and of the image if any.
+        """
+        calls = [(self._stream_upload, self.bucket, file, 'page')]
+        if image is not None:
+            calls.append((self._stream_upload, self.web_uploads_bucket, image,
+                          'image'))
+        results = self.fetch_all(*calls)
+
+        page_name, extension = self._uploaded_page(file.filename)
+        self.index_executor.submit(self._index_page_upload, page_name,
+                                   extension, results[0])
+        if image is not None:
+            self.index_executor.submit(self._index_image_upload,
+                                       image.filename)
+            self._schedule_variants(image.filename)
+        return results
+
+    def flush_indexing(self):
+        """
+        Waits until the uploads submitted so far are indexed, and the pages
+        written so far are recorded in their history and logged in the search
+        index.
+        """
+        self.index_executor.submit(lambda: None).result()
+        self.search_index.flush()
+
+    def _uploaded_page(self, filename):
+        # The uploaded file may replace the text of a page we have cached, so
+        # forget it right away, before the upload is indexed
+        page_name, _, extension = filename.rpartition('.')
+        self.page_cache.invalidate(page_name)
+        self.html_cache.invalidate(page_name)
+        self.negative_cache.discard('page', page_name)
+        return page_name, extension
+
+    def _stream_upload(self, bucket, file, kind):
+        # Streams `file` to a blob of `bucket` named after it, keeping the
+        # upload metrics up to date as bytes are read and stored
+        blob = bucket.blob(file.filename)
+        content_type = getattr(file, 'mimetype', None) or None
+
+        read = 0
+
+        def on_read(count):
+            nonlocal read
+            read += count
+            self.upload_in_flight.add(count)
+
+        start = time.perf_counter()
+        try:
+            size = storage.upload_stream(blob, file,
+                                         self.config['UPLOAD_CHUNK_SIZE'],
+                                         content_type=content_type,
+                                         on_read=on_read)
+        finally:
+            self.upload_in_flight.add(-read)
+        seconds = time.perf_counter() - start
+
+        self.upload_bytes.inc(kind, amount=size)
+        self.upload_seconds.observe(seconds, kind)
+        if seconds > 0:
+            self.upload_throughput.observe(size / seconds, kind)
+        logger.info("Uploaded %s: %d bytes in %.1fms (%.1f MB/s)", blob.name,
+                    size, seconds * 1000,
+                    size / seconds / 1e6 if seconds > 0 else 0)
+        return UploadResult(blob.name, size, seconds, blob.generation,
+                            blob.updated)
+
+    def _index_page_upload(self, page_name, extension, result, content=None):
+        try:
+            self._add_to_page_index(page_name)
+
+            # Text files are the content of the page, so they get rendered and
+            # searched too
+            if extension != 'txt':
+                return
+
+            if content is None:
+                # Read back what we uploaded, unless it was replaced since
+                blob = self.bucket.blob(result.name)
+                try:
+                    content = self._decode_page(blob.download_as_bytes(
+                        if_generation_match=result.generation))
+                except (exceptions.PreconditionFailed, exceptions.NotFound):
+                    # Whoever replaced it indexes their own version
+                    return
+
+            if isinstance(content, bytes):
+                content = content.decode('utf-8', errors='replace')
+            self._store_rendered(page_name, content, result.generation,
+                                 result.updated)
+            self._record_revision(page_name, content, result)
+            self._add_to_search_index(page_name, content)
+        except Exception:
+            # Nobody waits for this in the background, don't lose the error
+            logger.exception("Failed to index the upload of %s", page_name)
+            raise
+
+    def _index_image_upload(self, filename):
+        # Remember this is now the image of the page
+        page_name = filename.rsplit('.', 1)[0]
+        try:
+            self.image_index.update(
+                self.web_uploads_bucket,
+                lambda index: index.add(page_name, filename))
+        except Exception:
+            logger.exception("Failed to index the image %s", filename)
+            raise
+
+    def import_items(self, items, overwrite=True):
+        """
+        Writes many pages and images at once, for seeding or migrating a wiki.
+
+        Items are written in batches of up to `BULK_BATCH_SIZE` items (and
+        `BULK_BATCH_BYTES` bytes), each item of a batch on the fetch pool, so
+        at most `FETCH_POOL_SIZE` writes run at once. The page, image and
+        search indexes are then updated once per batch rather than once per
+        page.
+
+        Args:
+            items - Iterable of `BulkItem`, read as the import goes.
+
+            overwrite - Whether to replace the pages and images that exist
+            already. If False, they are skipped.
+
+        Returns:
+            An `ImportResult`.
+        """
+        pages = images = skipped = 0
+        for batch in self._import_batches(items):
+            written_pages, written_images = self._import_batch(batch, overwrite)
+            pages += written_pages
+            images += written_images
+            skipped += len(batch) - written_pages - written_images
+        return ImportResult(pages, images, skipped)
+
+    def _import_batches(self, items):
+        # Groups items by BULK_BATCH_SIZE items or BULK_BATCH_BYTES bytes,
+        # whichever comes first
+        batch = []
+        batch_bytes = 0
+        for item in items:
+            if item.kind not in ('page', 'image'):
+                raise ValueError(f"Unknown kind of item: {item.kind}")
+            batch.append(item)
+            batch_bytes += item.size
+            if (len(batch) >= self.config['BULK_BATCH_SIZE'] or
+                    batch_bytes >= self.config['BULK_BATCH_BYTES']):
+                yield batch
+                batch = []
+                batch_bytes = 0
+        if batch:
+            yield batch
+
+    def _import_batch(self, batch, overwrite):
+        written = self.fetch_all(*[(self._import_item, item, overwrite)
+                                   for item in batch])
+
+        pages = [(item, content) for item, content in zip(batch, written)
+                 if item.kind == 'page' and content is not None]
+        images = [item for item, content in zip(batch, written)
+                  if item.kind == 'image' and content is not None]
+
+        # One manifest write per index for the whole batch
+        if pages:
+            self.page_index.update(
+                self.bucket,
+                lambda index: any([index.add(item.name) for item, _ in pages]))
+            self.search_index.update(
+                self.bucket, [(item.name, content) for item, content in pages])
+        if images:
+            self.image_index.update(
+                self.web_uploads_bucket,
+                lambda index: any([index.add(item.name.rsplit('.', 1)[0],
+                                             item.name)
+                                   for item in images]))
+
+        return len(pages), len(images)
+
+    def _import_item(self, item, overwrite):
+        # Writes one item. Returns the text of pages (the data of images), or
+        # None if it was skipped.
+        precondition = None if overwrite else 0
+
+        if item.kind == 'image':
+            blob = self.web_uploads_bucket.blob(item.name)
+            try:
+                blob.upload_from_string(item.data,
+                                        content_type=item.content_type,
+                                        if_generation_match=precondition)
+            except exceptions.PreconditionFailed:
+                return None
+            self.negative_cache.discard('image', item.name)
+            return item.data
+
+        content = item.data
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', errors='replace')
+
+        blob = self.bucket.blob(f"{item.name}.txt")
+        try:
+            blob.upload_from_string(*self._encode_page(content),
+                                    if_generation_match=precondition)
+        except exceptions.PreconditionFailed:
+            return None
+
+        self.negative_cache.discard('page', item.name)
+        self.page_cache.invalidate(item.name)
+        self._store_rendered(item.name, content, blob.generation, blob.updated)
+        self._schedule_revision(item.name, content, blob)
+        return content
+
+    def export_items(self):
+        """
+        Yields every page, then every image uploaded for the pages, as
+        `BulkItem`s.
+
+        Pages are downloaded `BULK_BATCH_SIZE` at a time on the fetch pool.
+        Images are streamed in `STREAM_CHUNK_SIZE` chunks as the caller reads
+        them, so only one batch of pages is ever held in memory.
+        """
+        names = [
+            blob.name for blob in self.bucket.list_blobs()
+            if blob.name.endswith('.txt') and
+            not blob.name.startswith(storage.META_PREFIX)
+        ]
+
+        def read(name):
+            try:
+                # Exported as plain text, however it is stored
+                return compression.decompress(
+                    self.bucket.blob(name).download_as_bytes())
+            except exceptions.NotFound:
+                # Deleted since we listed it
+                return None
+
+        batch_size = self.config['BULK_BATCH_SIZE']
+        for start in range(0, len(names), batch_size):
+            batch = names[start:start + batch_size]
+            texts = self.fetch_all(*[(read, name) for name in batch])
+            for name, text in zip(batch, texts):
+                if text is not None:
+                    yield BulkItem('page', name[:-len('.txt')], len(text), text,
+                                   None)
+
+        for blob in self.web_uploads_bucket.list_blobs():
+            if blob.name.startswith(storage.META_PREFIX):
+                continue
+            yield BulkItem('image', blob.name, blob.size, self.stream_blob(blob),
+                           blob.content_type)
 
     def sign_up(self, username, password):
         """
@@ -163,26 +1543,32 @@ class Backend:
             Boolean value determining if the process went right or not. The only case
             in which it will return `False` is if the username already exists, otherwise
             it will create the blob for the User and return True.
-        
+
+        Raises:
+            `passwords.Overloaded` if too many passwords are being hashed right now.
         """
         blob_name = username
         user_password = password
 
-        blob_contents = str(
-            int(hashlib.sha256(user_password.encode("utf-8")).hexdigest(), 16))
+        # Salted scrypt hash, computed in a worker process
+        blob_contents = self.passwords.hash(user_password)
 
-        # Ahead, we will check if a blob for the username already exists.
+        # Ahead, we will create the blob for the username, but only if it
+        # doesn't exist yet (generation 0). Checking first and writing after
+        # would let two people sign up with the same name at once.
         blob_check = self.password_bucket.blob(blob_name)
 
-        if blob_check.exists():
+        try:
+            blob_check.upload_from_string(blob_contents, if_generation_match=0)
+        except exceptions.PreconditionFailed:
             print("Username already exists, please try a different username")
             # We shouldn't exactly print, but somehow render in the sign-up page
             return False
-        else:
-            # If blob doesn't exist, create new username with password
-            blob_check.upload_from_string(blob_contents)
-            print("User succesfully created")
-            return True
+
+        self.negative_cache.discard('user', username)
+        self.user_cache.set(username, True)
+        print("User succesfully created")
+        return True
 
     def sign_in(self, username, password):
         """
@@ -207,33 +1593,67 @@ class Backend:
         """
 
         blob_name = username
-        blob_check = self.password_bucket.blob(blob_name)
 
-        if blob_check.exists():
+        # Usernames we recently found missing can't sign in
+        if self.negative_cache.is_missing('user', username):
+            logger.debug("Sign in as %s, known not to exist", username)
+            return False
 
-            # Get the hashed password to later compare it to the data inside the username blob
-            user_password = password
-            hashed_password = str(
-                int(
-                    hashlib.sha256(user_password.encode("utf-8")).hexdigest(),
-                    16))
+        # Download the hash right away, a missing blob means a missing user
+        blob_check = self.password_bucket.blob(blob_name)
+        try:
+            blob_contents = blob_check.download_as_string()  # REAL PASSWORD
+        except exceptions.NotFound:
+            self.negative_cache.add('user', username)
+            print("Username doesn't exist")
+            return False
 
-            # We download the hashed password as a string, thus we must compare it as one
-            blob_contents = str(
-                blob_check.download_as_string())  # REAL PASSWORD
-            blob_contents = blob_contents[2:-1]
+        if passwords.is_hash(blob_contents):
+            try:
+                matches, needs_rehash = self.passwords.verify(
+                    password, blob_contents.decode('ascii'))
+            except ValueError:
+                # A damaged hash can't match anything, don't fail the login
+                logger.warning("Stored password hash of %s is not valid",
+                               username)
+                return False
+        else:
+            # Accounts created before salted hashes hold the decimal SHA-256 of
+            # the password, which used to be compared to str(bytes)[2:-1]
+            legacy = str(blob_contents)[2:-1]
+            matches = hmac.compare_digest(passwords.legacy_digest(password),
+                                          legacy)
+            needs_rehash = matches
+
+        if not matches:
+            print("Wrong password or username, please try again")
+            return False
 
-            if hashed_password == blob_contents:
-                #Everything good, welcome
-                return True
+        if needs_rehash:
+            self._rehash_password(username, password, blob_check.generation)
 
-            else:
-                print("Wrong password or username, please try again")
+        #Everything good, welcome
+        return True
 
-        else:
-            print("Username doesn't exist")
+    def _rehash_password(self, username, password, generation):
+        # Upgrades the stored hash in the background once the user logged in
+        # with the right password. Only the version we checked is replaced.
+        try:
+            future = self.passwords.hash_async(password)
+        except passwords.Overloaded:
+            # Busy, we'll do it on another login
+            return
 
-        return False
+        def store(future):
+            try:
+                blob = self.password_bucket.blob(username)
+                blob.upload_from_string(future.result(),
+                                        if_generation_match=generation)
+            except (exceptions.PreconditionFailed, exceptions.NotFound):
+                # Changed or deleted meanwhile, leave it alone
+                pass
+
+        future.add_done_callback(store)
 
     def get_image(self, name):
         # Get a reference to the blob that contains the image data
@@ -250,6 +1670,89 @@ class Backend:
             # If the blob does not exist, return None
             return None
 
+    def get_image_blob(self, name):
+        """
+        Looks up an image of the images bucket without downloading it.
+
+        Args:
+            name - Name of the image blob.
+
+        Returns:
+            The blob with its size, content type, md5 hash and generation loaded,
+            or None if there is no such image.
+        """
+        if self.negative_cache.is_missing('image', name):
+            return None
+
+        blob = self.images_bucket.get_blob(name)
+        if blob is None:
+            self.negative_cache.add('image', name)
+        return blob
+
+    def get_image_assets(self, names):
+        """
+        Returns the current version of several images of the images bucket,
+        without downloading them. Pages can then link to them with versioned
+        URLs that browsers and the CDN keep for as long as they like.
+
+        Versions are cached for `ASSET_CACHE_TTL` seconds; the ones that are
+        missing or expired are looked up concurrently.
+
+        Args:
+            names - Names of the image blobs.
+
+        Returns:
+            A dictionary from name to `ImageAsset`, without the images that
+            don't exist.
+        """
+        assets = {name: self.asset_cache.get(name) for name in names}
+        missing = [name for name, asset in assets.items() if asset is None]
+
+        blobs = self.fetch_all(*[(self.get_image_blob, name) for name in missing])
+        for name, blob in zip(missing, blobs):
+            asset = ImageAsset(name, blob.generation if blob is not None else None)
+            self.asset_cache.set(name, asset)
+            assets[name] = asset
+
+        return {
+            name: asset
+            for name, asset in assets.items()
+            if asset.generation is not None
+        }
+
+    def stream_blob(self, blob, start=0, end=None):
+        """
+        Yields the content of a blob in chunks of `STREAM_CHUNK_SIZE` bytes, so
+        big files never have to fit in memory.
+
+        Args:
+            blob - A blob returned by `get_blob` (or `get_image_blob`), so its
+            size and generation are known.
+
+            start - Offset of the first byte to send.
+
+            end - Offset of the last byte to send (inclusive), the last byte of
+            the blob by default.
+        """
+        if end is None:
+            end = blob.size - 1
+
+        # The body is sent once the request is over, so the downloads run in
+        # a copy of its context to still count towards its route
+        context = contextvars.copy_context()
+        return self._stream_chunks(context, blob, start, end)
+
+    def _stream_chunks(self, context, blob, start, end):
+        chunk_size = self.config['STREAM_CHUNK_SIZE']
+        position = start
+        while position <= end:
+            chunk_end = min(position + chunk_size - 1, end)
+            # Every chunk must come from the same version of the blob
+            yield context.run(blob.download_as_bytes, start=position,
+                              end=chunk_end,
+                              if_generation_match=blob.generation)
+            position = chunk_end + 1
+
     def get_user(self, ID):
         """
         This method serves as a helper for the `login_manager()` from Flask Login.
@@ -261,38 +1764,75 @@ class Backend:
         Returns:
             Boolean which determines if the ID exists as a user or not.
         """
+        # Users found in the last USER_CACHE_TTL seconds are trusted
+        if self.user_cache.get(ID):
+            return True
+
+        # And so are the ones we recently didn't find
+        if self.negative_cache.is_missing('user', ID):
+            return False
+
         blob_name = ID
         blob_check = self.password_bucket.blob(blob_name)
-        return blob_check.exists()
+        user_exists = blob_check.exists()
+        if user_exists:
+            self.user_cache.set(ID, True)
+        else:
+            self.negative_cache.add('user', ID)
+        return user_exists
+
+    def delete_user(self, ID):
+        """
+        Removes a user account. The user is forgotten by `get_user` right away,
+        so their sessions stop working on this instance.
+
+        Args:
+            ID - The unique username of the user.
+
+        Returns:
+            Boolean which determines if the user existed.
+        """
+        self.user_cache.invalidate(ID)
+        self.negative_cache.add('user', ID)
+
+        blob_check = self.password_bucket.blob(ID)
+        try:
+            blob_check.delete()
+        except exceptions.NotFound:
+            return False
+        return True
     
     def add_to_favorites(self, page_name, username):
         """
-        This method will add the current page to the user's favorite bucket when the button "Add to Favorites" is clicked
+        This method will add the current page to the user's favorites when the button "Add to Favorites" is clicked
 
+        The change shows up right away, but it is written to the favorites bucket
+        together with the other changes made in the next `FAVORITES_FLUSH_DELAY`
+        seconds.
         """
-        favorites_bucket = self.user_client.bucket(username + "-favorites")
-        if not favorites_bucket.exists():
-            #Creates the favorites bucket for the user
-            user_bucket = self.user_client.create_bucket(bucket_or_name=username + "-favorites", location="us", user_project="sds-project-1")
-            #Creating a blob with the pages name in it, to be used in the future to grab the url information, and adds it to the bucket.
-            blob = user_bucket.blob(page_name)
-            blob.upload_from_string("")
-        else:
-            #If the user already has a bucket, add the page to the bucket     
-            blob = favorites_bucket.blob(page_name)
-            blob.upload_from_string("")
+        self.favorites.add(username, page_name)
 
     def remove_from_favorites(self, page_name, username):
         """
-        This method will remove the current page from the user's favorite bucket when the button "Remove from Favorites" is clicked
+        This method will remove the current page from the user's favorites when the button "Remove from Favorites" is clicked
 
         """
-        favorites_bucket = self.user_client.bucket(username + "-favorites")
-        if favorites_bucket.exists():
-            blob = favorites_bucket.blob(page_name)
-            if blob.exists():
-                blob.delete()
+        self.favorites.remove(username, page_name)
 
     def get_favorites(self, username):
-        favorites_bucket = self.user_client.bucket(username + "-favorites")
-        return [blob.name for blob in favorites_bucket.list_blobs()] if favorites_bucket.exists() else []
\ No newline at end of file
+        return self.favorites.get(username)
+
+    def is_favorite(self, page_name, username):
+        """
+        Checks whether `page_name` is one of the favorites of `username`. Once the
+        user's favorites are cached this doesn't make any request.
+
+        Args:
+            page_name - Name of the page.
+
+            username - The user, or None for anonymous users who have no favorites.
+
+        Returns:
+            Boolean telling if the page is a favorite of the user.
+        """
+        return self.favorites.contains(username, page_name)
@@ -1,14 +1,19 @@
 from flaskr import backend
 import unittest
+import pytest
 from unittest import mock, TestCase
 from unittest.mock import Mock, MagicMock
 import hashlib
 import os
 import io
+import json
+import time
+import threading
 from google.cloud.storage.blob import Blob
 from google.cloud import storage
 from flaskr.backend import Backend
 from flaskr import create_app
+from flaskr import storage as flaskr_storage
 
 
 
@@ -72,8 +77,10 @@ def test_sign_up_fail():
     back.password_bucket = MagicMock()
     back.password_bucket.blob.return_value = blobX
 
-    # Here, we state that the username does exist, so the test will be False
-    blobX.exists.return_value = True
+    # Here, we state that the username does exist, so the write creating it
+    # fails its precondition and the test will be False
+    blobX.upload_from_string.side_effect = backend.exceptions.PreconditionFailed(
+        "exists")
 
     result = back.sign_up(username, password)
     assert result == False
@@ -161,6 +168,8 @@ def test_get_all_page_names():
     
     
     #Test if a valid page name is in the list
+    #There is no page index manifest yet, so the bucket gets listed
+    backend.bucket.get_blob.return_value = None
     backend.bucket.list_blobs.return_value = [blob, blob]
     result = backend.get_all_page_names()
     first_blob = result[0]
@@ -199,15 +208,17 @@ def test_add_to_favorites():
     backend.bucket = MagicMock()
 
     #Creation of a mock bucket and blob
-    backend.user_client.bucket = MagicMock()
+    backend.client.bucket = MagicMock()
+    backend.favorites.bucket = MagicMock()
+    backend.favorites.bucket.get_blob.return_value = None
     blob = MagicMock()
 
     #Test that the bucket contains an existing page the user added
     page_name = "Mario"
     username = "Deez"
     backend.add_to_favorites(page_name, username)
-    backend.user_client.bucket(username + "-favorites").blob.return_value = blob
-    assert backend.user_client.bucket(username + "-favorites").blob(page_name) != None
+    backend.client.bucket(username + "-favorites").blob.return_value = blob
+    assert backend.client.bucket(username + "-favorites").blob(page_name) != None
 
 # Testing new methods that were used for my feature : Hover Display
 
@@ -218,9 +229,11 @@ def test_upload_image():
     blobX = MagicMock()
 
     image = MagicMock()
-    image.filename.return_value = "image_name"
+    image.filename = "image_name.jpg"
 
     back.web_uploads_bucket = MagicMock()
+    # There is no image index manifest yet
+    back.web_uploads_bucket.get_blob.return_value = None
     back.web_uploads_bucket.blob.return_value = blobX
     back.web_uploads_bucket.blob("image_name").return_value = "Hi!"
 
@@ -265,3 +278,647 @@ def test_get_wiki_image():
     bucket.blob.assert_called_with(page_name + ".txt")
     created_blob = bucket.blob.return_value
     created_blob.upload_from_string.assert_called_with(content)
+
+
+def test_backend_shares_one_client():
+    client = MagicMock()
+    back = backend.Backend(client=client)
+
+    # Buckets are only asked from the client when first used
+    assert back.client is client
+    client.bucket.assert_not_called()
+    for bucket in [back.bucket, back.web_uploads_bucket, back.password_bucket,
+                   back.images_bucket]:
+        bucket.blob("x")
+
+    # Every bucket should come from the client that was passed in
+    client.bucket.assert_any_call('wiki-content-bucket')
+    client.bucket.assert_any_call('web-uploads')
+    client.bucket.assert_any_call('passwords-bucket')
+    client.bucket.assert_any_call('img__bucket')
+
+
+def test_get_client_is_shared():
+    flaskr_storage.reset_client()
+
+    with mock.patch("flaskr.storage._build_client") as build:
+        first = flaskr_storage.get_client(pool_size=4)
+        second = flaskr_storage.get_client(pool_size=8)
+
+    # The client is only built once, and with the first pool size
+    assert first is second
+    build.assert_called_once_with(4)
+    flaskr_storage.reset_client()
+
+
+def test_backend_with_memory_driver():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory'})
+
+    # Nothing is mocked here, the pages really go in and out of the driver
+    back.create_wiki_page("Mario", "It's a me")
+    assert back.get_wiki_page("Mario") == "It's a me"
+    assert back.update_wiki_page("Mario", "Mario!") == "Mario"
+    assert back.get_wiki_page("Mario") == "Mario!"
+    assert back.get_wiki_page("Luigi") is None
+    assert back.get_all_page_names() == ["Mario"]
+
+    assert back.sign_up("sam", "1234")
+    assert not back.sign_up("sam", "1234")
+    assert back.sign_in("sam", "1234")
+    assert not back.sign_in("sam", "4321")
+    assert back.get_user("sam")
+
+
+def test_get_wiki_page_cache():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory'})
+    back.bucket.blob("Mario.txt").upload_from_string("It's a me")
+
+    assert back.get_wiki_page("Mario") == "It's a me"
+
+    # The second read is served from memory without touching the bucket
+    back.bucket = MagicMock()
+    assert back.get_wiki_page("Mario") == "It's a me"
+    back.bucket.get_blob.assert_not_called()
+
+
+def test_get_wiki_page_cache_revalidates_generation():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory', 'PAGE_CACHE_TTL': 0})
+    back.create_wiki_page("Mario", "It's a me")
+
+    # Once expired, an unchanged blob is kept without downloading it again
+    blob = MagicMock()
+    blob.generation = back.page_cache.get_stale("Mario").generation
+    back.bucket = MagicMock()
+    back.bucket.get_blob.return_value = blob
+    assert back.get_wiki_page("Mario") == "It's a me"
+    blob.download_as_bytes.assert_not_called()
+
+    # A new generation is downloaded
+    blob.generation += 1
+    blob.download_as_bytes.return_value = b"Mario!"
+    assert back.get_wiki_page("Mario") == "Mario!"
+
+
+def test_writes_refresh_page_cache():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory'})
+    back.create_wiki_page("Mario", "It's a me")
+    assert back.get_wiki_page("Mario") == "It's a me"
+
+    back.update_wiki_page("Mario", "Mario!")
+    assert back.get_wiki_page("Mario") == "Mario!"
+
+    file = io.BytesIO(b"Luigi time")
+    file.filename = "Mario.txt"
+    back.upload(file)
+    assert back.get_wiki_page("Mario") == "Luigi time"
+
+
+def test_page_index_manifest():
+    client = flaskr_storage.MemoryDriver()
+    back = backend.Backend({'STORAGE_DRIVER': 'memory'}, client=client)
+    back.bucket.blob("Zelda.txt").upload_from_string("Link")
+    back.bucket.blob("Mario.txt").upload_from_string("It's a me")
+
+    # The first call lists the bucket and stores the manifest
+    assert back.get_all_page_names() == ["Mario", "Zelda"]
+    assert back.bucket.get_blob(backend.PAGE_INDEX_MANIFEST) is not None
+
+    # Writes update the index in place
+    back.create_wiki_page("Metroid", "Samus")
+    assert back.get_all_page_names() == ["Mario", "Metroid", "Zelda"]
+
+    # A new instance loads the manifest instead of listing the bucket
+    other = backend.Backend({'STORAGE_DRIVER': 'memory'}, client=client)
+    with mock.patch.object(other.bucket, "list_blobs") as list_blobs:
+        assert other.get_all_page_names() == ["Mario", "Metroid", "Zelda"]
+    list_blobs.assert_not_called()
+
+
+def test_page_index_merges_concurrent_writers():
+    client = flaskr_storage.MemoryDriver()
+    first = backend.Backend({'STORAGE_DRIVER': 'memory'}, client=client)
+    second = backend.Backend({'STORAGE_DRIVER': 'memory'}, client=client)
+    assert first.get_all_page_names() == []
+    assert second.get_all_page_names() == []
+
+    first.create_wiki_page("Mario", "It's a me")
+    # `second` holds a stale manifest, its write must not drop "Mario"
+    second.create_wiki_page("Zelda", "Link")
+    assert second.get_all_page_names() == ["Mario", "Zelda"]
+
+    # The TTL is not up yet for `first`, but a rebuild catches everything
+    assert first.rebuild_page_index() == ["Mario", "Zelda"]
+
+
+def test_get_wiki_image_from_index():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory'})
+    back.web_uploads_bucket.blob("Mario.jpg").upload_from_string(b"jpg")
+    back.web_uploads_bucket.blob("Mario.png").upload_from_string(b"png")
+
+    # The index is built from a listing and prefers the same extensions the
+    # old probing did
+    assert back.get_wiki_image("Mario") == \
+        "https://storage.googleapis.com/web-uploads/Mario.png"
+
+    # Lookups, including pages without an image, don't touch the bucket
+    with mock.patch.object(back.web_uploads_bucket, "get_blob") as get_blob:
+        assert back.get_wiki_image("Zelda") is None
+        assert back.get_wiki_image("Mario") is not None
+    get_blob.assert_not_called()
+
+    # Uploading an image records it in the index
+    image = io.BytesIO(b"gif")
+    image.filename = "Zelda.gif"
+    back.upload_image(image)
+    assert back.get_wiki_image("Zelda") == \
+        "https://storage.googleapis.com/web-uploads/Zelda.gif"
+
+
+def test_favorites_with_memory_driver():
+    back = backend.Backend({
+        'STORAGE_DRIVER': 'memory',
+        'FAVORITES_FLUSH_DELAY': 60
+    })
+
+    back.add_to_favorites("Mario", "sam")
+    back.add_to_favorites("Zelda", "sam")
+    back.remove_from_favorites("Mario", "sam")
+
+    # Changes show up right away but nothing was written yet
+    assert back.get_favorites("sam") == ["Zelda"]
+    assert back.is_favorite("Zelda", "sam")
+    assert not back.is_favorite("Mario", "sam")
+    assert back.favorites_bucket.get_blob("sam.json") is None
+
+    # Flushing writes all three changes at once
+    back.favorites.flush()
+    assert json.loads(back.favorites_bucket.get_blob(
+        "sam.json").download_as_text())['pages'] == ["Zelda"]
+
+    # Anonymous users have no favorites
+    assert back.get_favorites(None) == []
+    assert not back.is_favorite("Zelda", None)
+
+
+def test_favorites_replay_on_conflict():
+    client = flaskr_storage.MemoryDriver()
+    config = {'STORAGE_DRIVER': 'memory', 'FAVORITES_FLUSH_DELAY': 0}
+    first = backend.Backend(config, client=client)
+    second = backend.Backend(config, client=client)
+
+    assert second.get_favorites("sam") == []
+    first.add_to_favorites("Mario", "sam")
+    # `second` has an outdated copy, its write must keep "Mario"
+    second.add_to_favorites("Zelda", "sam")
+
+    assert second.get_favorites("sam") == ["Mario", "Zelda"]
+    third = backend.Backend(config, client=client)
+    assert third.get_favorites("sam") == ["Mario", "Zelda"]
+
+
+def test_favorites_imported_from_legacy_bucket():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory'})
+    legacy = back.client.create_bucket("sam-favorites")
+    legacy.blob("Mario").upload_from_string("")
+
+    assert back.get_favorites("sam") == ["Mario"]
+
+
+def test_get_user_cache():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory'})
+    back.sign_up("sam", "1234")
+
+    # Signing up already told the cache about the user
+    with mock.patch.object(back.password_bucket, "blob") as blob:
+        assert back.get_user("sam")
+    blob.assert_not_called()
+
+    # Deleting the account is seen right away
+    assert back.delete_user("sam")
+    assert not back.get_user("sam")
+    assert not back.delete_user("sam")
+
+
+def test_get_page_view_fetches_concurrently():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory'})
+
+    def slow(result):
+        def call(*args):
+            time.sleep(0.2)
+            return result
+        return call
+
+    info = backend.PageInfo(3, None)
+    back.get_page_info = slow(info)
+    back.get_page_html = slow("<p>It's a me</p>")
+    image = backend.PageImage("https://example.com/Mario.png", "", "")
+    back.get_page_image = slow(image)
+    back.is_favorite = slow(True)
+
+    start = time.monotonic()
+    view = back.get_page_view("Mario", "sam")
+    elapsed = time.monotonic() - start
+
+    assert view == backend.PageView(info, "<p>It's a me</p>", image, True)
+    # The four calls ran side by side
+    assert elapsed < 0.5
+
+    # The HTML can be left out
+    view = back.get_page_view("Mario", "sam", html=False)
+    assert view == backend.PageView(info, None, image, True)
+
+
+def test_pages_are_rendered_on_write():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory'})
+    back.create_wiki_page("Mario", "It's a **me**")
+
+    artifact = back.bucket.get_blob("_meta/html/Mario.html")
+    page = back.bucket.get_blob("Mario.txt")
+    assert artifact.download_as_text() == "<p>It&#39;s a <strong>me</strong></p>"
+    assert artifact.metadata == {
+        'renderer-version': str(backend.RENDERER_VERSION),
+        'source-generation': str(page.generation),
+    }
+
+    # A new instance reads the stored HTML without rendering anything
+    other = backend.Backend({'STORAGE_DRIVER': 'memory'}, client=back.client)
+    with mock.patch.object(backend, "render_page") as render_page:
+        assert other.get_page_html("Mario") == artifact.download_as_text()
+    render_page.assert_not_called()
+
+    back.update_wiki_page("Mario", "It's a *me*")
+    assert back.get_page_html("Mario") == "<p>It&#39;s a <em>me</em></p>"
+    assert back.get_page_html("Luigi") is None
+
+
+def test_page_html_rerendered_when_out_of_date():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory'})
+    back.create_wiki_page("Mario", "It's a me")
+    back.html_cache.clear()
+
+    # Rendered by an older version of the renderer
+    with mock.patch.object(backend, "RENDERER_VERSION", 2):
+        assert back.get_page_html("Mario") == "<p>It&#39;s a me</p>"
+    artifact = back.bucket.get_blob("_meta/html/Mario.html")
+    assert artifact.metadata['renderer-version'] == '2'
+
+    # Text written without its HTML, for example by an older instance
+    back.bucket.blob("Mario.txt").upload_from_string("Wahoo")
+    back.page_cache.clear()
+    back.html_cache.clear()
+    assert back.get_page_html("Mario") == "<p>Wahoo</p>"
+
+    # Rendered HTML is not a page
+    assert back.get_all_page_names() == ["Mario"]
+
+
+def test_create_wiki_page_does_not_overwrite():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory'})
+    assert back.create_wiki_page("Mario", "It's a me") == "Mario"
+    assert back.create_wiki_page("Mario", "Wahoo") is None
+    assert back.get_wiki_page("Mario") == "It's a me"
+
+
+def test_update_wiki_page_detects_conflicts():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory'})
+    other = backend.Backend({'STORAGE_DRIVER': 'memory'}, client=back.client)
+    back.create_wiki_page("Mario", "It's a me")
+    generation = back.get_page_info("Mario").generation
+
+    assert other.update_wiki_page("Mario", "Wahoo", generation) == "Mario"
+
+    # Our edit was made on the old text
+    with pytest.raises(backend.EditConflict) as conflict:
+        back.update_wiki_page("Mario", "Mamma mia", generation)
+    assert conflict.value.generation == back.bucket.get_blob(
+        "Mario.txt").generation
+    assert back.get_wiki_page("Mario") == "Wahoo"
+
+    # Without a generation, the one we last saw is used
+    assert back.update_wiki_page("Mario", "Mamma mia") == "Mario"
+    assert back.bucket.blob("Mario.txt").download_as_text() == "Mamma mia"
+    assert back.update_wiki_page("Luigi", "Hi") is None
+
+
+def test_sign_up_twice():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory'})
+    assert back.sign_up("sam", "pw")
+    assert not back.sign_up("sam", "other")
+    assert back.sign_in("sam", "pw")
+
+
+def test_missing_pages_and_users_are_remembered():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory'})
+
+    with mock.patch.object(back.bucket, "get_blob",
+                           wraps=back.bucket.get_blob) as get_blob:
+        assert back.get_wiki_page("Luigi") is None
+        assert back.get_page_info("Luigi") is None
+        assert back.get_page_html("Luigi") is None
+    assert get_blob.call_count == 1
+
+    # Creating the page makes it show up right away
+    back.create_wiki_page("Luigi", "Mamma mia")
+    assert back.get_wiki_page("Luigi") == "Mamma mia"
+
+    with mock.patch.object(back.password_bucket, "blob",
+                           wraps=back.password_bucket.blob) as blob:
+        assert not back.get_user("sam")
+        assert not back.get_user("sam")
+    assert blob.call_count == 1
+    back.sign_up("sam", "pw")
+    assert back.get_user("sam")
+
+    assert back.get_image_blob("missing.png") is None
+    assert back.get_image_blob("missing.png") is None
+
+    assert back.negative_cache.stats() == {
+        'image': {'hits': 1, 'misses': 1},
+        'page': {'hits': 2, 'misses': 1},
+        'user': {'hits': 1, 'misses': 1},
+    }
+
+
+def test_gcs_client_built_on_first_use():
+    with mock.patch("flaskr.storage._build_client") as build:
+        back = backend.Backend({'STORAGE_DRIVER': 'gcs'})
+        build.assert_not_called()
+
+        back.bucket.blob("Mario.txt")
+        build.assert_called_once()
+    flaskr_storage.reset_client()
+
+
+def test_passwords_are_salted_and_migrated():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory',
+                            'PASSWORD_HASH_WORKERS': 0,
+                            'PASSWORD_SCRYPT_N': 2**10})
+    assert back.sign_up("sam", "1234")
+    stored = back.password_bucket.blob("sam").download_as_text()
+    assert stored.startswith("$scrypt$v=1$")
+    assert back.sign_in("sam", "1234")
+    assert not back.sign_in("sam", "4321")
+
+    # Accounts from before hold the unsalted SHA-256, and are upgraded on
+    # their next successful login
+    legacy = str(int(hashlib.sha256(b"abcd").hexdigest(), 16))
+    back.password_bucket.blob("angel").upload_from_string(legacy)
+    assert not back.sign_in("angel", "wrong")
+    assert back.password_bucket.blob("angel").download_as_text() == legacy
+
+    assert back.sign_in("angel", "abcd")
+    stored = back.password_bucket.blob("angel").download_as_text()
+    assert stored.startswith("$scrypt$v=1$")
+    assert back.sign_in("angel", "abcd")
+    assert not back.sign_in("angel", "wrong")
+
+    assert not back.sign_in("nobody", "abcd")
+
+
+def test_sign_in_with_damaged_hash():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory',
+                            'PASSWORD_HASH_WORKERS': 0})
+    back.password_bucket.blob("bob").upload_from_string(b"$scrypt$garbage")
+    assert not back.sign_in("bob", "x")
+
+
+def test_sign_in_overloaded():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory',
+                            'PASSWORD_HASH_WORKERS': 0,
+                            'PASSWORD_HASH_MAX_PENDING': 1,
+                            'PASSWORD_SCRYPT_N': 2**10})
+    assert back.sign_up("sam", "1234")
+
+    back.passwords._slots.acquire()
+    with pytest.raises(backend.passwords.Overloaded):
+        back.sign_in("sam", "1234")
+    back.passwords._slots.release()
+    assert back.sign_in("sam", "1234")
+
+
+def test_upload_page_files_indexes_in_background():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory',
+                            'UPLOAD_CHUNK_SIZE': 1})
+    back.create_wiki_page("Mario", "It's a me")
+    assert back.get_wiki_page("Mario") == "It's a me"
+
+    file = io.BytesIO(b"Luigi time")
+    file.filename = "Mario.txt"
+    image = io.BytesIO(b"gif")
+    image.filename = "Mario.gif"
+    with mock.patch.object(back, "_index_page_upload") as index_page, \
+            mock.patch.object(back, "_index_image_upload") as index_image:
+        page, picture = back.upload_page_files(file, image)
+        back.flush_indexing()
+
+    assert (page.name, page.size) == ("Mario.txt", 10)
+    assert (picture.name, picture.size) == ("Mario.gif", 3)
+    # The cached text is already gone, the indexing was left to the thread
+    assert back.get_wiki_page("Mario") == "Luigi time"
+    index_page.assert_called_once_with("Mario", "txt", page)
+    index_image.assert_called_once_with("Mario.gif")
+
+    back._index_page_upload("Mario", "txt", page)
+    back._index_image_upload("Mario.gif")
+    assert back.get_page_html("Mario") == "<p>Luigi time</p>"
+    assert [result.name for result in back.search("luigi")] == ["Mario"]
+    assert back.get_wiki_image("Mario") == \
+        "https://storage.googleapis.com/web-uploads/Mario.gif"
+
+    assert back.upload_bytes.get("page") == 10
+    assert back.upload_bytes.get("image") == 3
+    assert back.upload_seconds.count("page") == 1
+    assert back.upload_in_flight.get() == 0
+
+
+def test_replaced_upload_is_not_indexed():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory'})
+    file = io.BytesIO(b"Luigi time")
+    file.filename = "Mario.txt"
+    result, = back.upload_page_files(file)
+    back.flush_indexing()
+
+    # Someone uploaded another version before this one was indexed
+    back.bucket.blob("Mario.txt").upload_from_string("Wahoo")
+    with mock.patch.object(back, "_store_rendered") as store_rendered:
+        back._index_page_upload("Mario", "txt", result)
+    store_rendered.assert_not_called()
+
+
+def test_revisions():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory',
+                            'REVISION_SNAPSHOT_INTERVAL': 3})
+    lines = "".join(f"Line {i}\n" for i in range(50))
+    texts = [lines + f"Version {i}\n" for i in range(7)]
+    back.create_wiki_page("Mario", texts[0], author="sam")
+    for text in texts[1:]:
+        back.update_wiki_page("Mario", text)
+    back.flush_indexing()
+
+    history = back.get_revisions("Mario")
+    assert [r.number for r in history] == [1, 2, 3, 4, 5, 6, 7]
+    assert [r.kind for r in history] == ["full", "delta", "delta"] * 2 + ["full"]
+    assert history[0].author == "sam"
+    # Deltas only hold the changed lines
+    delta = back.bucket.get_blob(history[1].blob)
+    assert delta.size < len(texts[1]) / 4
+
+    # Rebuilt from storage, without the texts cached while writing
+    back.revision_cache.clear()
+    for number, text in enumerate(texts, 1):
+        assert back.get_revision("Mario", number) == text
+    assert back.get_revision("Mario", 8) is None
+    assert back.get_revisions("Luigi") == []
+
+    assert back.diff_revisions("Mario", 1, 2)[-2:] == ["-Version 0",
+                                                       "+Version 1"]
+    assert back.diff_revisions("Mario", 1, 9) is None
+
+
+def test_diff_revisions_with_small_pool():
+    # Both revisions are rebuilt with one fetch_all, not from the pool, which
+    # would hang as soon as the pool is full of rebuilds
+    back = backend.Backend({'STORAGE_DRIVER': 'memory', 'FETCH_POOL_SIZE': 1})
+    back.create_wiki_page("Mario", "It's a me\n")
+    back.update_wiki_page("Mario", "It's a me\nMario\n")
+    back.update_wiki_page("Mario", "It's a me\nMario!\n")
+    back.flush_indexing()
+    back.revision_cache.clear()
+
+    with mock.patch.object(back, "fetch_all", wraps=back.fetch_all) as fetch:
+        diff = back.diff_revisions("Mario", 1, 3)
+    assert diff[-1] == "+Mario!"
+    # The chains share their blobs, each is read once
+    assert fetch.call_count == 1
+    assert len(fetch.call_args.args) == 3
+
+
+def test_revision_after_unknown_edit_is_full():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory'})
+    back.create_wiki_page("Mario", "It's a me")
+
+    # Written without going through the backend, so not in the history
+    back.bucket.blob("Mario.txt").upload_from_string("Wahoo")
+    generation = back.bucket.get_blob("Mario.txt").generation
+    back.update_wiki_page("Mario", "Mario!", generation)
+    back.flush_indexing()
+
+    assert [r.kind for r in back.get_revisions("Mario")] == ["full", "full"]
+    back.revision_cache.clear()
+    assert back.get_revision("Mario", 2) == "Mario!"
+
+
+def test_write_does_not_wait_for_revision():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory'})
+    release = threading.Event()
+    record = back._record_revision
+
+    def slow_record(*args, **kwargs):
+        release.wait(5)
+        record(*args, **kwargs)
+
+    back._record_revision = slow_record
+    start = time.monotonic()
+    back.create_wiki_page("Mario", "It's a me")
+    back.update_wiki_page("Mario", "It's a me, Mario")
+    assert time.monotonic() - start < 1
+    # The page itself is up to date, only its history is behind
+    assert back.get_wiki_page("Mario") == "It's a me, Mario"
+
+    release.set()
+    back.flush_indexing()
+    assert [r.kind for r in back.get_revisions("Mario")] == ["full", "delta"]
+
+
+def test_image_variants():
+    pytest.importorskip("PIL")
+    from PIL import Image
+
+    back = backend.Backend({'STORAGE_DRIVER': 'memory',
+                            'IMAGE_VARIANT_WIDTHS': [320, 640]})
+    data = io.BytesIO()
+    Image.new('RGB', (1000, 800), 'blue').save(data, 'JPEG')
+    back.web_uploads_bucket.blob("Mario.jpg").upload_from_string(
+        data.getvalue(), content_type="image/jpeg")
+
+    # Images uploaded before variants existed get them on first view
+    image = back.get_page_image("Mario")
+    assert image.url.endswith("/web-uploads/Mario.jpg")
+    assert image.srcset == ""
+    back.flush_indexing()
+
+    image = back.get_page_image("Mario")
+    generation = back.web_uploads_bucket.get_blob("Mario.jpg").generation
+    prefix = f"https://storage.googleapis.com/web-uploads/_meta/variants/Mario.jpg/{generation}/"
+    assert image.webp_srcset == f"{prefix}320w.webp 320w, {prefix}640w.webp 640w"
+    assert image.srcset == f"{prefix}320w.jpg 320w, {prefix}640w.jpg 640w"
+    variant = back.web_uploads_bucket.get_blob(
+        f"_meta/variants/Mario.jpg/{generation}/640w.jpg")
+    assert variant.content_type == "image/jpeg"
+
+    assert back.pick_image_variant("Mario", 300, webp=True) == f"{prefix}320w.webp"
+    assert back.pick_image_variant("Mario", 500) == f"{prefix}640w.jpg"
+    assert back.pick_image_variant("Mario", 2000).endswith("/Mario.jpg")
+    assert back.pick_image_variant("Luigi", 300) is None
+
+    # A new upload gets new variants
+    data = io.BytesIO()
+    Image.new('RGB', (500, 500), 'green').save(data, 'PNG')
+    image = io.BytesIO(data.getvalue())
+    image.filename = "Mario.jpg"
+    back.upload_image(image)
+    back.flush_indexing()
+    assert back.get_page_image("Mario").srcset.count("w,") == 0
+    assert "320w.jpg 320w" in back.get_page_image("Mario").srcset
+
+
+def test_page_image_does_not_wait_for_variant_manifest():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory'})
+    back.web_uploads_bucket.blob("Mario.png").upload_from_string(
+        b"\x89PNG", content_type="image/png")
+    assert back.get_page_image("Mario").srcset == ""
+    back.flush_indexing()
+
+    # A resize job is writing the variant manifest, and hangs
+    saving = threading.Event()
+    release = threading.Event()
+    upload = back.variant_index._upload
+
+    def slow_upload(*args):
+        saving.set()
+        release.wait(5)
+        return upload(*args)
+
+    with mock.patch.object(back.variant_index, "_upload", slow_upload):
+        writer = threading.Thread(target=back.variant_index.update, args=(
+            back.web_uploads_bucket, lambda index: index.add("Luigi.png", 1, [])))
+        writer.start()
+        assert saving.wait(5)
+        start = time.monotonic()
+        assert back.get_page_image("Mario").url.endswith("/Mario.png")
+        assert time.monotonic() - start < 1
+        release.set()
+        writer.join(5)
+
+
+def test_pages_are_stored_compressed():
+    back = backend.Backend({'STORAGE_DRIVER': 'memory',
+                            'PAGE_COMPRESSION_MIN_SIZE': 100})
+    text = "It's a me, Mario!\n" * 100
+    back.create_wiki_page("Mario", text)
+    back.create_wiki_page("Luigi", "Short")
+
+    blob = back.bucket.get_blob("Mario.txt")
+    assert blob.content_type == "application/gzip"
+    assert blob.size < len(text) / 10
+    assert back.bucket.get_blob("Luigi.txt").download_as_bytes() == b"Short"
+
+    back.page_cache.clear()
+    assert back.get_wiki_page("Mario") == text
+    assert back.get_wiki_page("Luigi") == "Short"
+
+    # Other readers decompress too
+    back.search_index.rebuild(back.bucket)
+    assert [r.name for r in back.search("mario")] == ["Mario"]
+    exported = {item.name: item.data for item in back.export_items()}
+    assert exported["Mario"] == text.encode("utf-8")
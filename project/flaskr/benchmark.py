@@ -0,0 +1,327 @@
+"""
+------------------------------------------------
+Route benchmarks
+------------------------------------------------
+
+Drives the routes of the wiki through the Flask test client, against the
+in-memory storage driver with an injected latency per storage request, and
+reports latency percentiles, requests per second and storage round trips per
+request for every route:
+
+    python -m flaskr.benchmark --requests 200 --latency-ms 20 --output new.json
+
+Results are JSON, so two runs (for example on two commits) can be compared:
+
+    python -m flaskr.benchmark --compare old.json new.json
+"""
+import argparse
+import collections
+import io
+import json
+import math
+import platform
+import subprocess
+import sys
+import time
+
+from flaskr import create_app
+
+# Version of the format of the results.
+RESULTS_VERSION = 1
+
+# Account used by the routes that need a logged in user.
+USERNAME = 'bench-user'
+PASSWORD = 'bench-password'
+
+# Image served by the image scenario, and its size.
+IMAGE_NAME = 'bench.png'
+IMAGE_SIZE = 256 * 1024
+
+# One benchmarked route:
+#   name    - Name of the scenario in the results.
+#   method  - HTTP method.
+#   route   - Route rule being measured, for humans.
+#   request - Function taking the number of the request and returning the path
+#             and the keyword arguments of `client.open`.
+#   login   - Whether the request is made by a logged in user.
+Scenario = collections.namedtuple('Scenario',
+                                  ['name', 'method', 'route', 'request', 'login'])
+
+
+def _page_name(i, pages):
+    return f"Page-{i % pages}"
+
+
+def _scenarios(pages):
+    return [
+        Scenario('page', 'GET', '/pages/<path>',
+                 lambda i: (f"/pages/{_page_name(i, pages)}", {}), False),
+        Scenario('page_index', 'GET', '/pages',
+                 lambda i: ("/pages", {}), False),
+        Scenario('image', 'GET', '/image/<name>',
+                 lambda i: (f"/image/{IMAGE_NAME}", {}), False),
+        Scenario('about', 'GET', '/about',
+                 lambda i: ("/about", {}), False),
+        Scenario('login', 'POST', '/login',
+                 lambda i: ("/login", {'data': {'username': USERNAME,
+                                                'password': PASSWORD}}), False),
+        Scenario('upload', 'POST', '/upload',
+                 lambda i: ("/upload", {'data': _upload_form(i)}), True),
+        Scenario('add_favorite', 'POST', '/add-favs/<page_path>',
+                 lambda i: (f"/add-favs/{_page_name(i, pages)}", {}), True),
+        Scenario('remove_favorite', 'POST', '/remove-favs/<page_path>',
+                 lambda i: (f"/remove-favs/{_page_name(i, pages)}", {}), True),
+        Scenario('favorites', 'GET', '/favs',
+                 lambda i: ("/favs", {}), True),
+    ]
+
+
+def _upload_form(i):
+    return {
+        'wikiname': f"Uploaded-{i}",
+        'file': (io.BytesIO(b"Uploaded by the benchmark.\n" * 20), 'page.txt'),
+        # No image
+        'image': (io.BytesIO(b""), ''),
+    }
+
+
+def percentile(values, p):
+    """
+    Returns the `p`th percentile (0 to 100) of `values`, by nearest rank.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def run(requests=100, latency=0.0, warmup=5, pages=50, names=None):
+    """
+    Runs the benchmark on a fresh app.
+
+    Every scenario first makes `warmup` requests that are not measured, then
+    `requests` measured ones, one after the other. Storage is seeded with
+    `pages` pages, the images of the about page and a user account before the
+    latency is turned on.
+
+    Args:
+        requests - Measured requests per scenario.
+
+        latency - Seconds every storage request waits.
+
+        warmup - Requests made before measuring each scenario.
+
+        pages - Number of pages created, and cycled through by the scenarios
+        that read pages.
+
+        names - Names of the scenarios to run, all of them by default.
+
+    Returns:
+        The results, as a dictionary ready to be dumped as JSON.
+    """
+    app = create_app({
+        'TESTING': True,
+        'STORAGE_DRIVER': 'memory',
+        # Favorites are written before the request returns, so the writes
+        # count towards the route
+        'FAVORITES_FLUSH_DELAY': 0,
+    })
+    back = app.extensions['backend']
+    _seed(back, pages)
+    back.client.latency = latency
+
+    anonymous = app.test_client()
+    logged_in = app.test_client()
+    logged_in.post("/login", data={'username': USERNAME, 'password': PASSWORD})
+
+    routes = {}
+    for scenario in _scenarios(pages):
+        if names and scenario.name not in names:
+            continue
+        client = logged_in if scenario.login else anonymous
+        routes[scenario.name] = _run_scenario(back, client, scenario, requests,
+                                              warmup)
+
+    return {
+        'version': RESULTS_VERSION,
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'config': {
+            'requests': requests,
+            'latency_ms': latency * 1000,
+            'warmup': warmup,
+            'pages': pages,
+        },
+        'routes': routes,
+    }
+
+
+def _seed(back, pages):
+    for i in range(pages):
+        back.create_wiki_page(_page_name(i, pages),
+                              f"Page number {i}.\n\nSee [[Page-{i + 1}]].")
+    back.sign_up(USERNAME, PASSWORD)
+
+    for name in ['cambrell.jpg', 'samuel.jpg', 'angel.jpg']:
+        back.images_bucket.blob(name).upload_from_string(
+            b"\xff\xd8" + b"0" * 1024, content_type='image/jpeg')
+    back.images_bucket.blob(IMAGE_NAME).upload_from_string(
+        b"\x89PNG" + b"0" * (IMAGE_SIZE - 4), content_type='image/png')
+
+
+def _run_scenario(back, client, scenario, requests, warmup):
+    for i in range(warmup):
+        _request(client, scenario, i)
+
+    # Work queued in the background by earlier requests (indexing uploads,
+    # logging search index changes, resizing images) must neither slow down
+    # nor be counted as this scenario
+    back.flush_indexing()
+
+    # Only storage requests made for the route being measured are counted
+    path, kwargs = scenario.request(0)
+    rule = _url_rule(client.application, path, scenario.method)
+    round_trips = _round_trips(back.metrics, rule)
+    timings = []
+    statuses = collections.Counter()
+
+    start = time.perf_counter()
+    for i in range(warmup, warmup + requests):
+        request_start = time.perf_counter()
+        status = _request(client, scenario, i)
+        timings.append(time.perf_counter() - request_start)
+        statuses[status] += 1
+    elapsed = time.perf_counter() - start
+
+    round_trips = _round_trips(back.metrics, rule) - round_trips
+    return {
+        'method': scenario.method,
+        'route': scenario.route,
+        'requests': requests,
+        'errors': sum(count for status, count in statuses.items()
+                      if status >= 500),
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'p50_ms': _ms(percentile(timings, 50)),
+        'p95_ms': _ms(percentile(timings, 95)),
+        'p99_ms': _ms(percentile(timings, 99)),
+        'mean_ms': _ms(sum(timings) / len(timings)) if timings else None,
+        'requests_per_second': round(requests / elapsed, 2) if elapsed else None,
+        'round_trips_per_request': round(round_trips / requests, 3)
+                                   if requests else None,
+    }
+
+
+def _url_rule(app, path, method):
+    # The route label of the storage requests made for `path`
+    adapter = app.url_map.bind('localhost')
+    rule, _ = adapter.match(path, method=method, return_rule=True)
+    return rule.rule
+
+
+def _round_trips(metrics, rule):
+    return sum(value for _, labels, value in metrics.storage_operations.samples()
+               if labels['route'] == rule)
+
+
+def _request(client, scenario, i):
+    path, kwargs = scenario.request(i)
+    response = client.open(path, method=scenario.method, **kwargs)
+    # Read streamed bodies, they are part of the work
+    response.get_data()
+    response.close()
+    return response.status_code
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True,
+                              timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(old, new):
+    """
+    Compares two results of `run`, route by route.
+
+    Returns:
+        A list of lines, one per route found in both, with the p50 and p95
+        latencies and round trips per request of each run.
+    """
+    lines = [f"{'route':<16} {'p50 ms':>20} {'p95 ms':>20} {'round trips':>16}"]
+    for name, after in new['routes'].items():
+        before = old['routes'].get(name)
+        if before is None:
+            continue
+        lines.append(
+            f"{name:<16} "
+            f"{_change(before['p50_ms'], after['p50_ms']):>20} "
+            f"{_change(before['p95_ms'], after['p95_ms']):>20} "
+            f"{_change(before['round_trips_per_request'], after['round_trips_per_request']):>16}")
+    return lines
+
+
+def _change(before, after):
+    if not before:
+        return f"{before} -> {after}"
+    return f"{before:g} -> {after:g} ({(after - before) / before:+.0%})"
+
+
+def _summary(results):
+    lines = [f"{'route':<16} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+             f"{'req/s':>9} {'trips':>7} {'errors':>6}"]
+    for name, route in results['routes'].items():
+        lines.append(f"{name:<16} {route['p50_ms']:>9.2f} {route['p95_ms']:>9.2f} "
+                     f"{route['p99_ms']:>9.2f} {route['requests_per_second']:>9.1f} "
+                     f"{route['round_trips_per_request']:>7.2f} {route['errors']:>6}")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m flaskr.benchmark',
+        description="Benchmarks the wiki routes against in-memory storage.")
+    parser.add_argument('--requests', type=int, default=100,
+                        help="measured requests per route (default: 100)")
+    parser.add_argument('--warmup', type=int, default=5,
+                        help="unmeasured requests per route (default: 5)")
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help="latency of every storage request (default: 0)")
+    parser.add_argument('--pages', type=int, default=50,
+                        help="number of pages to create (default: 50)")
+    parser.add_argument('--route', action='append', dest='routes',
+                        help="only run this route, can be repeated")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help="compare two result files instead of running")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        print('\n'.join(compare(old, new)))
+        return 0
+
+    results = run(requests=args.requests,
+                  latency=args.latency_ms / 1000,
+                  warmup=args.warmup,
+                  pages=args.pages,
+                  names=args.routes)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    print('\n'.join(_summary(results)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,47 @@
+import json
+
+from flaskr import benchmark
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert benchmark.percentile(values, 50) == 50
+    assert benchmark.percentile(values, 99) == 99
+    assert benchmark.percentile([3], 95) == 3
+    assert benchmark.percentile([], 50) is None
+
+
+def test_run_reports_every_route(tmp_path):
+    results = benchmark.run(requests=3, warmup=1, pages=3, latency=0.001)
+
+    assert set(results['routes']) == {
+        'page', 'page_index', 'image', 'about', 'login', 'upload',
+        'add_favorite', 'remove_favorite', 'favorites'
+    }
+    for route in results['routes'].values():
+        assert route['errors'] == 0
+        assert route['p50_ms'] <= route['p95_ms'] <= route['p99_ms']
+
+    # Every image request looks the image up and downloads it, and waits on
+    # the injected latency each time
+    image = results['routes']['image']
+    assert image['round_trips_per_request'] == 2
+    assert image['p50_ms'] >= 2
+
+    # Results survive a round trip through JSON and compare with themselves
+    path = tmp_path / "results.json"
+    path.write_text(json.dumps(results))
+    lines = benchmark.compare(results, json.loads(path.read_text()))
+    assert len(lines) == 1 + len(results['routes'])
+
+
+def test_run_selected_routes():
+    results = benchmark.run(requests=2, warmup=0, pages=2, names=['about'])
+    assert list(results['routes']) == ['about']
+
+
+def test_background_work_is_not_counted():
+    # Uploads are indexed in the background, which doesn't count towards the
+    # upload route: it only streams the file to storage
+    results = benchmark.run(requests=3, warmup=1, pages=2, names=['upload'])
+    assert results['routes']['upload']['round_trips_per_request'] == 1
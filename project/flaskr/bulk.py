@@ -0,0 +1,259 @@
+"""
+------------------------------------------------
+Bulk import and export
+------------------------------------------------
+
+Moves every page and image of the wiki in and out of one archive, through
+`Backend.import_items` and `Backend.export_items`. Two formats are supported:
+
+    tar   - A tar archive (gzipped on export, any compression on import) with
+            the text of every page as `pages/<page name>.txt` and every image
+            as `images/<blob name>`.
+
+    jsonl - One JSON object per line: {"kind": "page", "name": ...,
+            "content": ...} for pages (the kind may be left out) and
+            {"kind": "image", "name": ..., "content_type": ..., "data": ...}
+            for images, with the data in base64.
+
+Both are read and written as streams, so archives of any size go through
+without being held in memory. From the command line:
+
+    flask export-pages wiki.tar.gz
+    flask import-pages wiki.tar.gz --no-overwrite
+"""
+import base64
+import json
+import mimetypes
+import tarfile
+import time
+import zlib
+
+import click
+
+from flaskr.backend import BulkItem
+
+FORMATS = ('tar', 'jsonl')
+
+# Directories of the pages and images in tar archives.
+PAGES_DIR = 'pages/'
+IMAGES_DIR = 'images/'
+
+# Content type and file name of each format, for downloads.
+CONTENT_TYPES = {'tar': 'application/gzip', 'jsonl': 'application/x-ndjson'}
+FILENAMES = {'tar': 'wiki-export.tar.gz', 'jsonl': 'wiki-export.jsonl'}
+
+
+def format_for(filename):
+    """
+    Guesses the format of an archive from its file name: "jsonl" for .jsonl
+    (and .ndjson) files, "tar" for anything else.
+    """
+    if filename and filename.lower().endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    return 'tar'
+
+
+def read_archive(fileobj, format='tar'):
+    """
+    Yields the `BulkItem`s of an archive, reading it as they are consumed.
+
+    Args:
+        fileobj - Binary file-like object to read the archive from. It only
+        needs `read`, so request bodies and pipes work.
+
+        format - "tar" or "jsonl".
+
+    Raises:
+        ValueError if the archive holds something that is neither a page nor
+        an image.
+    """
+    if format == 'jsonl':
+        return _read_jsonl(fileobj)
+    if format == 'tar':
+        return _read_tar(fileobj)
+    raise ValueError(f"Unknown archive format: {format}")
+
+
+def write_archive(items, format='tar'):
+    """
+    Yields the bytes of an archive holding `items`, as they are produced, so
+    it can be written to a file or sent as a streamed response.
+
+    Args:
+        items - Iterable of `BulkItem`, usually `Backend.export_items()`.
+
+        format - "tar" (gzipped) or "jsonl".
+    """
+    if format == 'jsonl':
+        chunks = _write_jsonl(items)
+    elif format == 'tar':
+        chunks = _write_tar(items)
+    else:
+        raise ValueError(f"Unknown archive format: {format}")
+    return (chunk for chunk in chunks if chunk)
+
+
+def _read_tar(fileobj):
+    # "r|*" reads the archive as a stream, whatever its compression
+    with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+
+            path = member.name
+            if path.startswith('./'):
+                path = path[2:]
+            data = archive.extractfile(member).read()
+
+            if path.startswith(PAGES_DIR) and path.endswith('.txt'):
+                yield BulkItem('page', path[len(PAGES_DIR):-len('.txt')],
+                               len(data), data, None)
+            elif path.startswith(IMAGES_DIR):
+                name = path[len(IMAGES_DIR):]
+                yield BulkItem('image', name, len(data), data,
+                               mimetypes.guess_type(name)[0])
+            else:
+                raise ValueError(f"Not a page or an image: {member.name}")
+
+
+def _read_jsonl(fileobj):
+    for number, line in enumerate(fileobj, 1):
+        if not line.strip():
+            continue
+
+        try:
+            entry = json.loads(line)
+            kind = entry.get('kind', 'page')
+            name = entry['name']
+            if kind == 'page':
+                data = entry['content'].encode('utf-8')
+                content_type = None
+            elif kind == 'image':
+                data = base64.b64decode(entry['data'], validate=True)
+                content_type = (entry.get('content_type') or
+                                mimetypes.guess_type(name)[0])
+            else:
+                raise ValueError(f"unknown kind {kind!r}")
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            raise ValueError(f"Line {number} is not a page or an image: "
+                             f"{e}") from e
+
+        yield BulkItem(kind, name, len(data), data, content_type)
+
+
+def _chunks(data):
+    # Exported images are iterables of chunks, pages are plain bytes
+    if isinstance(data, bytes):
+        return [data]
+    return data
+
+
+def _write_tar(items):
+    # The archive is written by hand rather than with `tarfile`, which needs
+    # the whole content of a file at once to add it. Every entry is a header
+    # followed by the data padded to a block, and the archive ends with two
+    # empty blocks.
+    compressor = zlib.compressobj(wbits=31)  # gzip
+    mtime = int(time.time())
+    offset = 0
+
+    for item in items:
+        directory = PAGES_DIR if item.kind == 'page' else IMAGES_DIR
+        suffix = '.txt' if item.kind == 'page' else ''
+        info = tarfile.TarInfo(directory + item.name + suffix)
+        info.size = item.size
+        info.mtime = mtime
+        info.mode = 0o644
+
+        # PAX headers allow names longer than 100 characters
+        header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        yield compressor.compress(header)
+        offset += len(header)
+
+        written = 0
+        for chunk in _chunks(item.data):
+            written += len(chunk)
+            yield compressor.compress(chunk)
+        if written != item.size:
+            raise ValueError(f"{item.name} changed while it was exported")
+
+        padding = -written % tarfile.BLOCKSIZE
+        yield compressor.compress(tarfile.NUL * padding)
+        offset += written + padding
+
+    end = 2 * tarfile.BLOCKSIZE
+    end += -(offset + end) % tarfile.RECORDSIZE
+    yield compressor.compress(tarfile.NUL * end)
+    yield compressor.flush()
+
+
+def _write_jsonl(items):
+    for item in items:
+        if item.kind == 'page':
+            entry = {
+                'kind': 'page',
+                'name': item.name,
+                'content': item.data.decode('utf-8', errors='replace'),
+            }
+            yield json.dumps(entry).encode('utf-8') + b'\n'
+            continue
+
+        # Images are encoded as they are read. Base64 works on groups of 3
+        # bytes, so whatever is left of a chunk waits for the next one.
+        prefix = json.dumps({'kind': 'image', 'name': item.name,
+                             'content_type': item.content_type})
+        yield prefix[:-1].encode('utf-8') + b', "data": "'
+        left = b''
+        for chunk in _chunks(item.data):
+            chunk = left + chunk
+            cut = len(chunk) - len(chunk) % 3
+            yield base64.b64encode(chunk[:cut])
+            left = chunk[cut:]
+        yield base64.b64encode(left) + b'"}\n'
+
+
+def register_commands(app):
+    """
+    Adds the `flask export-pages` and `flask import-pages` commands to the
+    app. They use the backend of the app, so its storage settings.
+    """
+
+    @app.cli.command('export-pages')
+    @click.argument('path', type=click.Path(dir_okay=False, writable=True))
+    @click.option('--format', 'format', type=click.Choice(FORMATS),
+                  help="Archive format, guessed from PATH by default.")
+    def export_pages(path, format):
+        """Writes every page and image of the wiki to an archive."""
+        back = app.extensions['backend']
+        format = format or format_for(path)
+        pages = images = 0
+
+        def counted(items):
+            nonlocal pages, images
+            for item in items:
+                if item.kind == 'page':
+                    pages += 1
+                else:
+                    images += 1
+                yield item
+
+        with open(path, 'wb') as out:
+            for chunk in write_archive(counted(back.export_items()), format):
+                out.write(chunk)
+        click.echo(f"Exported {pages} pages and {images} images to {path}")
+
+    @app.cli.command('import-pages')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--format', 'format', type=click.Choice(FORMATS),
+                  help="Archive format, guessed from PATH by default.")
+    @click.option('--overwrite/--no-overwrite', default=True,
+                  help="Replace the pages and images that exist already.")
+    def import_pages(path, format, overwrite):
+        """Writes the pages and images of an archive to the wiki."""
+        back = app.extensions['backend']
+        with open(path, 'rb') as archive:
+            result = back.import_items(
+                read_archive(archive, format or format_for(path)),
+                overwrite=overwrite)
+        click.echo(f"Imported {result.pages} pages and {result.images} images"
+                   f" ({result.skipped} skipped)")
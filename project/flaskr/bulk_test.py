@@ -0,0 +1,126 @@
+import base64
+import io
+import json
+import tarfile
+from unittest import mock
+
+import pytest
+
+from flaskr import backend
+from flaskr import bulk
+from flaskr import create_app
+
+
+def make_backend(**config):
+    return backend.Backend(dict({'STORAGE_DRIVER': 'memory'}, **config))
+
+
+def seed(back):
+    back.create_wiki_page("Mario", "It's a *me*")
+    back.create_wiki_page("Games/Zelda", "Link")
+    back.create_wiki_page("L" * 150, "Long name")
+    # Big enough to be streamed in several chunks
+    back.web_uploads_bucket.blob("Mario.png").upload_from_string(
+        b"\x89PNG" + bytes(range(256)) * 10, content_type="image/png")
+
+
+def test_tar_round_trip():
+    source = make_backend(STREAM_CHUNK_SIZE=1000, BULK_BATCH_SIZE=2)
+    seed(source)
+    archive = b"".join(bulk.write_archive(source.export_items(), 'tar'))
+
+    # Anything reading tar files can read it
+    with tarfile.open(fileobj=io.BytesIO(archive), mode='r:gz') as tar:
+        assert sorted(tar.getnames()) == sorted([
+            "images/Mario.png", "pages/" + "L" * 150 + ".txt",
+            "pages/Games/Zelda.txt", "pages/Mario.txt"])
+        assert tar.extractfile("pages/Mario.txt").read() == b"It's a *me*"
+
+    target = make_backend(BULK_BATCH_SIZE=2)
+    result = target.import_items(bulk.read_archive(io.BytesIO(archive)))
+    assert result == backend.ImportResult(pages=3, images=1, skipped=0)
+
+    assert target.get_wiki_page("Games/Zelda") == "Link"
+    assert target.get_page_html("Mario") == "<p>It&#39;s a <em>me</em></p>"
+    assert target.get_all_page_names() == sorted(["Mario", "Games/Zelda",
+                                                  "L" * 150])
+    assert [r.name for r in target.search("link")] == ["Games/Zelda"]
+    assert target.get_wiki_image("Mario").endswith("/web-uploads/Mario.png")
+    image = target.web_uploads_bucket.get_blob("Mario.png")
+    assert image.content_type == "image/png"
+    assert image.download_as_bytes() == b"\x89PNG" + bytes(range(256)) * 10
+
+
+def test_jsonl_round_trip():
+    source = make_backend(STREAM_CHUNK_SIZE=1000)
+    seed(source)
+    archive = b"".join(bulk.write_archive(source.export_items(), 'jsonl'))
+
+    lines = [json.loads(line) for line in archive.splitlines()]
+    assert lines[-1]['kind'] == 'image'
+    assert base64.b64decode(lines[-1]['data']) == \
+        b"\x89PNG" + bytes(range(256)) * 10
+
+    target = make_backend()
+    result = target.import_items(
+        bulk.read_archive(io.BytesIO(archive), 'jsonl'))
+    assert result == backend.ImportResult(pages=3, images=1, skipped=0)
+    assert target.get_wiki_page("Mario") == "It's a *me*"
+
+
+def test_import_batches_index_updates():
+    back = make_backend(BULK_BATCH_SIZE=10)
+    items = (backend.BulkItem('page', f"Page-{i}", 4, b"text", None)
+             for i in range(25))
+
+    with mock.patch.object(back.page_index, "update",
+                           wraps=back.page_index.update) as update:
+        result = back.import_items(items)
+
+    assert result.pages == 25
+    # One manifest write per batch, not per page
+    assert update.call_count == 3
+    assert len(back.get_all_page_names()) == 25
+
+
+def test_import_without_overwrite_skips_existing():
+    back = make_backend()
+    back.create_wiki_page("Mario", "It's a me")
+    archive = io.BytesIO(b'{"name": "Mario", "content": "Wahoo"}\n'
+                         b'\n'
+                         b'{"name": "Luigi", "content": "Mama mia"}\n')
+
+    result = back.import_items(bulk.read_archive(archive, 'jsonl'),
+                               overwrite=False)
+    assert result == backend.ImportResult(pages=1, images=0, skipped=1)
+    assert back.get_wiki_page("Mario") == "It's a me"
+    assert back.get_wiki_page("Luigi") == "Mama mia"
+
+
+def test_read_archive_rejects_unknown_entries():
+    with pytest.raises(ValueError, match="Line 1"):
+        list(bulk.read_archive(io.BytesIO(b'{"kind": "user"}\n'), 'jsonl'))
+
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w') as tar:
+        info = tarfile.TarInfo("passwords/Mario")
+        tar.addfile(info, io.BytesIO(b""))
+    archive.seek(0)
+    with pytest.raises(ValueError, match="passwords/Mario"):
+        list(bulk.read_archive(archive))
+
+
+def test_cli_commands(tmp_path):
+    app = create_app({'TESTING': True, 'STORAGE_DRIVER': 'memory'})
+    seed(app.extensions['backend'])
+    path = str(tmp_path / "wiki.tar.gz")
+
+    result = app.test_cli_runner().invoke(args=["export-pages", path])
+    assert result.exit_code == 0, result.output
+    assert "Exported 3 pages and 1 images" in result.output
+
+    other = create_app({'TESTING': True, 'STORAGE_DRIVER': 'memory'})
+    result = other.test_cli_runner().invoke(args=["import-pages", path])
+    assert result.exit_code == 0, result.output
+    assert "Imported 3 pages and 1 images (0 skipped)" in result.output
+    assert other.extensions['backend'].get_wiki_page("Mario") == "It's a *me*"
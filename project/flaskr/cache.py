@@ -0,0 +1,161 @@
+import collections
+import threading
+import time
+
+
+class LRUCache:
+    """
+    A thread-safe cache that evicts the least recently used entries once the
+    total size of its values goes over `max_size`, and treats entries older than
+    `ttl` seconds as expired.
+
+    Expired entries are not dropped right away: `get` ignores them, but
+    `get_stale` still returns them so the caller can revalidate an old value
+    (for example by comparing a blob generation) instead of downloading it
+    again.
+
+    Args:
+        max_size - Maximum total size of the cached values, as measured by
+        `sizeof`.
+
+        ttl - Number of seconds an entry stays fresh, or None to never expire.
+
+        sizeof - Function giving the size of a value. By default every value
+        has size 1, so `max_size` is the maximum number of entries.
+    """
+
+    def __init__(self, max_size, ttl=None, sizeof=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored for `key`, or `default` if there is none or it
+        has expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry):
+                return default
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def get_stale(self, key, default=None):
+        """
+        Returns the value stored for `key` even if it has expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry is not None else default
+
+    def set(self, key, value):
+        """
+        Stores `value` under `key` and makes it fresh again. Values bigger than
+        the whole cache are not stored.
+        """
+        size = self.sizeof(value)
+
+        with self._lock:
+            self._remove(key)
+            if size > self.max_size:
+                return
+
+            self._entries[key] = (value, time.monotonic(), size)
+            self.size += size
+
+            while self.size > self.max_size:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _expired(self, entry):
+        return self.ttl is not None and time.monotonic() - entry[1] > self.ttl
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+
+class NegativeCache:
+    """
+    Remembers lookups that found nothing ("this page doesn't exist"), so
+    repeated requests for missing pages, images or users don't each cost a
+    storage request.
+
+    Entries are keyed by a kind ("page", "image", "user"...) and a name, share
+    one bounded LRU and expire after a short `ttl`, so things created by other
+    instances show up quickly. Writes made through this instance must call
+    `discard` so the new object is seen right away.
+
+    Args:
+        max_size - Maximum number of missing names remembered.
+
+        ttl - Seconds a name is remembered as missing.
+
+    Attributes:
+        hits - Counter of the lookups answered from the cache, by kind.
+
+        misses - Counter of the lookups the cache couldn't answer, by kind.
+    """
+
+    def __init__(self, max_size, ttl):
+        self._cache = LRUCache(max_size, ttl=ttl)
+        self._lock = threading.Lock()
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def is_missing(self, kind, name):
+        """
+        Returns True if `name` was recently found missing, in which case the
+        caller can skip the lookup.
+        """
+        missing = self._cache.get((kind, name)) is not None
+        with self._lock:
+            if missing:
+                self.hits[kind] += 1
+            else:
+                self.misses[kind] += 1
+        return missing
+
+    def add(self, kind, name):
+        self._cache.set((kind, name), True)
+
+    def discard(self, kind, name):
+        self._cache.invalidate((kind, name))
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        """
+        Returns the hits and misses of every kind, as
+        {kind: {'hits': ..., 'misses': ...}}.
+        """
+        with self._lock:
+            kinds = sorted(set(self.hits) | set(self.misses))
+            return {
+                kind: {'hits': self.hits[kind], 'misses': self.misses[kind]}
+                for kind in kinds
+            }
@@ -0,0 +1,68 @@
+from unittest import mock
+from flaskr.cache import LRUCache, NegativeCache
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(max_size=10, sizeof=len)
+    cache.set("a", "aaaa")
+    cache.set("b", "bbbb")
+
+    # Reading "a" makes "b" the least recently used entry
+    assert cache.get("a") == "aaaa"
+    cache.set("c", "cccc")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "aaaa"
+    assert cache.get("c") == "cccc"
+    assert cache.size == 8
+
+
+def test_values_bigger_than_the_cache_are_not_stored():
+    cache = LRUCache(max_size=3, sizeof=len)
+    cache.set("a", "aaaa")
+    assert cache.get("a") is None
+    assert cache.size == 0
+
+
+def test_ttl():
+    cache = LRUCache(max_size=10, ttl=5)
+
+    with mock.patch("flaskr.cache.time.monotonic", return_value=100):
+        cache.set("a", 1)
+    with mock.patch("flaskr.cache.time.monotonic", return_value=104):
+        assert cache.get("a") == 1
+    with mock.patch("flaskr.cache.time.monotonic", return_value=106):
+        # Expired entries are only visible through get_stale
+        assert cache.get("a") is None
+        assert cache.get_stale("a") == 1
+
+
+def test_invalidate():
+    cache = LRUCache(max_size=10)
+    cache.set("a", 1)
+    cache.invalidate("a")
+    assert cache.get_stale("a") is None
+    assert len(cache) == 0
+
+
+def test_negative_cache():
+    cache = NegativeCache(max_size=10, ttl=5)
+
+    with mock.patch("flaskr.cache.time.monotonic", return_value=100):
+        assert not cache.is_missing("page", "Luigi")
+        cache.add("page", "Luigi")
+        assert cache.is_missing("page", "Luigi")
+        # Kinds don't mix
+        assert not cache.is_missing("user", "Luigi")
+
+        cache.discard("page", "Luigi")
+        assert not cache.is_missing("page", "Luigi")
+        cache.add("page", "Luigi")
+
+    with mock.patch("flaskr.cache.time.monotonic", return_value=106):
+        assert not cache.is_missing("page", "Luigi")
+
+    assert cache.stats() == {
+        "page": {"hits": 1, "misses": 3},
+        "user": {"hits": 0, "misses": 1},
+    }
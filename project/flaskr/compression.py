@@ -0,0 +1,164 @@
+"""
+------------------------------------------------
+Compression
+------------------------------------------------
+
+Compressed page storage, and compressed HTTP responses.
+
+Pages longer than `PAGE_COMPRESSION_MIN_SIZE` bytes are stored gzip (or zstd)
+compressed. Compressed and plain blobs are told apart by their first bytes:
+neither format can start like UTF-8 text, so pages written before compression
+existed, or uploaded as plain .txt files, are still read as they are.
+
+`init_app` compresses HTML responses for clients that accept it, and keeps the
+compressed bodies of the hottest pages so they aren't compressed again on every
+request.
+"""
+import gzip
+import hashlib
+
+from flask import request
+
+from flaskr.cache import LRUCache
+
+try:
+    # Optional: zstd is only offered when the package is installed
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+
+# First bytes of each format.
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Content types of compressed page blobs.
+CONTENT_TYPES = {GZIP: 'application/gzip', ZSTD: 'application/zstd'}
+
+# Compression levels used unless told otherwise. Pages are compressed once
+# when written, so storage can afford a stronger level than responses.
+STORAGE_LEVELS = {GZIP: 9, ZSTD: 19}
+RESPONSE_LEVELS = {GZIP: 6, ZSTD: 3}
+
+
+def available_encodings():
+    """
+    Returns the encodings that can be used, best first.
+    """
+    if zstandard is not None:
+        return [ZSTD, GZIP]
+    return [GZIP]
+
+
+def compress(data, encoding, level=None):
+    """
+    Compresses bytes with "gzip" or "zstd" (at its default storage level).
+    """
+    if level is None:
+        level = STORAGE_LEVELS[encoding]
+    if encoding == GZIP:
+        # No file name or time in the header, so the same text always
+        # compresses to the same bytes
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if encoding == ZSTD:
+        if zstandard is None:
+            raise ValueError("zstd needs the zstandard package")
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    raise ValueError(f"Unknown encoding: {encoding}")
+
+
+def encoding_of(data):
+    """
+    Returns "gzip" or "zstd" if `data` is compressed with it, None otherwise.
+    """
+    if data.startswith(GZIP_MAGIC):
+        return GZIP
+    if data.startswith(ZSTD_MAGIC):
+        return ZSTD
+    return None
+
+
+def decompress(data):
+    """
+    Decompresses bytes made by `compress`. Anything else is returned as is.
+    """
+    encoding = encoding_of(data)
+    if encoding == GZIP:
+        return gzip.decompress(data)
+    if encoding == ZSTD:
+        if zstandard is None:
+            raise ValueError("Reading zstd pages needs the zstandard package")
+        # Streamed, the frame header may not say how big the text is
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+class ResponseCompressor:
+    """
+    Compresses the responses of an app as `after_request` hook.
+
+    Only complete (not streamed) 200 responses of the types in
+    `COMPRESS_MIMETYPES` and at least `COMPRESS_MIN_SIZE` bytes long are
+    compressed, with the best encoding the client accepts. Compressed bodies
+    are cached by hash of the body, bounded by `COMPRESS_CACHE_SIZE` bytes:
+    hashing a page is far cheaper than compressing it.
+
+    The ETag of a compressed response is made weak, as the bytes differ from
+    the uncompressed ones. Conditional requests compare weak ETags, so clients
+    still get their 304s.
+
+    Args:
+        app - The Flask app, for its settings.
+
+        metrics - `Metrics` to count compressed responses in.
+    """
+
+    def __init__(self, app, metrics):
+        self.app = app
+        self.cache = LRUCache(app.config['COMPRESS_CACHE_SIZE'], sizeof=len)
+        self.responses = metrics.counter(
+            'wiki_http_compressed_responses_total',
+            'Responses sent compressed, by encoding and whether the compressed '
+            'body was cached.', ['encoding', 'cached'])
+
+    def __call__(self, response):
+        config = self.app.config
+        if (response.status_code != 200 or response.direct_passthrough or
+                response.is_streamed or
+                'Content-Encoding' in response.headers or
+                response.mimetype not in config['COMPRESS_MIMETYPES']):
+            return response
+
+        # Whatever we answer, it depends on what the client accepts
+        response.vary.add('Accept-Encoding')
+
+        encoding = request.accept_encodings.best_match(available_encodings())
+        body = response.get_data()
+        if encoding is None or len(body) < config['COMPRESS_MIN_SIZE']:
+            return response
+
+        key = (hashlib.sha1(body).digest(), encoding)
+        compressed = self.cache.get(key)
+        cached = compressed is not None
+        if not cached:
+            compressed = compress(body, encoding, RESPONSE_LEVELS[encoding])
+            self.cache.set(key, compressed)
+        self.responses.inc(encoding, str(cached).lower())
+
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+def init_app(app, metrics):
+    """
+    Compresses the responses of `app`, see `ResponseCompressor`.
+    """
+    compressor = ResponseCompressor(app, metrics)
+    app.after_request(compressor)
+    return compressor
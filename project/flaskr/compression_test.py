@@ -0,0 +1,81 @@
+import gzip
+
+import pytest
+from flask import Flask
+
+from flaskr import compression
+from flaskr.metrics import Metrics
+
+
+def test_compress_and_decompress():
+    text = "It's a me, Mario! ".encode('utf-8') * 100
+    data = compression.compress(text, 'gzip')
+    assert compression.encoding_of(data) == 'gzip'
+    assert len(data) < len(text) / 10
+    assert compression.decompress(data) == text
+    # Plain text is left alone
+    assert compression.encoding_of(text) is None
+    assert compression.decompress(text) == text
+    assert compression.decompress(b"") == b""
+
+
+def test_zstd():
+    pytest.importorskip("zstandard")
+    text = b"Wahoo! " * 100
+    data = compression.compress(text, 'zstd')
+    assert compression.encoding_of(data) == 'zstd'
+    assert compression.decompress(data) == text
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.config.update(COMPRESS_MIMETYPES=['text/html'], COMPRESS_MIN_SIZE=100,
+                      COMPRESS_CACHE_SIZE=1024 * 1024)
+
+    @app.route("/big")
+    def big():
+        response = app.make_response("<p>Mario</p>" * 100)
+        response.set_etag("abc")
+        return response
+
+    @app.route("/small")
+    def small():
+        return "<p>Mario</p>"
+
+    @app.route("/text")
+    def text():
+        return "Mario " * 100, {'Content-Type': 'text/plain'}
+
+    app.extensions['compressor'] = compression.init_app(app, Metrics())
+    return app
+
+
+def test_responses_are_compressed(app):
+    client = app.test_client()
+    compressor = app.extensions['compressor']
+
+    resp = client.get("/big", headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in resp.headers["Vary"]
+    assert resp.headers["ETag"] == 'W/"abc"'
+    assert gzip.decompress(resp.data) == b"<p>Mario</p>" * 100
+    assert int(resp.headers["Content-Length"]) == len(resp.data)
+
+    # The second time, the compressed body comes from the cache
+    client.get("/big", headers={"Accept-Encoding": "gzip"})
+    assert compressor.responses.get("gzip", "false") == 1
+    assert compressor.responses.get("gzip", "true") == 1
+
+
+def test_responses_left_alone(app):
+    client = app.test_client()
+    resp = client.get("/big")
+    assert "Content-Encoding" not in resp.headers
+    assert resp.headers["ETag"] == '"abc"'
+    resp = client.get("/big", headers={"Accept-Encoding": "br"})
+    assert "Content-Encoding" not in resp.headers
+
+    for path in ["/small", "/text"]:
+        resp = client.get(path, headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in resp.headers
@@ -0,0 +1,202 @@
+import atexit
+import json
+import threading
+
+from google.api_core import exceptions
+
+from flaskr.cache import LRUCache
+
+# How many times a user's changes are replayed on a newer version of their
+# object before we give up until the next flush.
+WRITE_ATTEMPTS = 5
+
+
+class _UserFavorites:
+    """
+    The favorite pages of one user, as last loaded or written, plus the
+    generation of the blob they came from (0 if the user has no blob yet).
+    """
+
+    def __init__(self, pages, generation):
+        self.pages = set(pages)
+        self.generation = generation
+
+
+class Favorites:
+    """
+    Stores the favorite pages of every user as one small JSON object per user
+    (`<username>.json`) in a single bucket.
+
+    Sets are loaded on first use and kept in an LRU cache, so checking whether
+    a page is a favorite is a set lookup. Adding and removing pages changes the
+    cached set right away, but the write to storage is delayed by `flush_delay`
+    seconds so several clicks end up in a single upload. Writes use the blob
+    generation as a precondition; if another instance wrote in between, we
+    reload its version and replay our changes on top of it.
+
+    Args:
+        bucket - Bucket holding one object per user.
+
+        cache_size - Maximum number of users kept in memory.
+
+        ttl - Seconds before a cached set is loaded again, to pick up changes
+        made through other instances.
+
+        flush_delay - Seconds to wait before writing changes. With 0, every
+        change is written before `add`/`remove` return.
+
+        legacy_client - If given, users without an object get their favorites
+        imported from the old `<username>-favorites` bucket of this client.
+    """
+
+    def __init__(self, bucket, cache_size=10000, ttl=300, flush_delay=1.0,
+                 legacy_client=None):
+        self.bucket = bucket
+        self.flush_delay = flush_delay
+        self.legacy_client = legacy_client
+        self._cache = LRUCache(cache_size, ttl=ttl)
+        # username -> list of ("add" | "remove", page_name) not written yet
+        self._pending = {}
+        # Same, for the changes being written by `flush` right now
+        self._writing = {}
+        self._timer = None
+        self._flush_at_exit = False
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def get(self, username):
+        """
+        Returns the sorted favorite pages of `username`.
+        """
+        if username is None:
+            return []
+        entry = self._entry(username)
+        with self._lock:
+            return sorted(entry.pages)
+
+    def contains(self, username, page_name):
+        if username is None:
+            return False
+        entry = self._entry(username)
+        with self._lock:
+            return page_name in entry.pages
+
+    def add(self, username, page_name):
+        self._change(username, 'add', page_name)
+
+    def remove(self, username, page_name):
+        self._change(username, 'remove', page_name)
+
+    def flush(self):
+        """
+        Writes every pending change to storage.
+        """
+        with self._flush_lock:
+            with self._lock:
+                self._writing, self._pending = self._pending, {}
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+
+            for username, changes in list(self._writing.items()):
+                written = self._write(username, changes)
+                with self._lock:
+                    del self._writing[username]
+                    if not written:
+                        # Keep the changes around for the next flush
+                        self._pending[username] = (
+                            changes + self._pending.get(username, []))
+
+    def _change(self, username, op, page_name):
+        entry = self._entry(username)
+
+        with self._lock:
+            _apply(entry.pages, [(op, page_name)])
+            self._pending.setdefault(username, []).append((op, page_name))
+
+            if self.flush_delay > 0:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.flush_delay, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                if not self._flush_at_exit:
+                    # Don't lose the last clicks when the instance shuts down
+                    atexit.register(self.flush)
+                    self._flush_at_exit = True
+
+        if self.flush_delay <= 0:
+            self.flush()
+
+    def _entry(self, username):
+        entry = self._cache.get(username)
+        if entry is not None:
+            return entry
+
+        entry = self._load(username)
+        with self._lock:
+            # Changes that aren't written yet must still show up
+            self._apply_unwritten(username, entry)
+            self._cache.set(username, entry)
+        return entry
+
+    def _apply_unwritten(self, username, entry):
+        _apply(entry.pages, self._writing.get(username, []))
+        _apply(entry.pages, self._pending.get(username, []))
+
+    def _load(self, username):
+        blob = self.bucket.get_blob(f"{username}.json")
+        if blob is not None:
+            data = json.loads(blob.download_as_text())
+            return _UserFavorites(data['pages'], blob.generation)
+
+        return _UserFavorites(self._load_legacy(username), 0)
+
+    def _load_legacy(self, username):
+        # Favorites used to be stored as one empty blob per page in a bucket
+        # per user. Read them from there until the user's object is written.
+        if self.legacy_client is None:
+            return []
+        legacy_bucket = self.legacy_client.bucket(username + "-favorites")
+        if not legacy_bucket.exists():
+            return []
+        return [blob.name for blob in legacy_bucket.list_blobs()]
+
+    def _write(self, username, changes):
+        # An expired entry is fine here, it holds our changes either way
+        entry = self._cache.get_stale(username)
+        if entry is None:
+            entry = self._entry(username)
+
+        for _ in range(WRITE_ATTEMPTS):
+            with self._lock:
+                data = json.dumps({'version': 1, 'pages': sorted(entry.pages)},
+                                  separators=(',', ':'))
+                generation = entry.generation
+
+            blob = self.bucket.blob(f"{username}.json")
+            try:
+                blob.upload_from_string(data,
+                                        content_type='application/json',
+                                        if_generation_match=generation)
+            except exceptions.PreconditionFailed:
+                # Someone else wrote this user's favorites, so replay our
+                # changes on top of theirs and try again
+                entry = self._load(username)
+                with self._lock:
+                    self._apply_unwritten(username, entry)
+                    self._cache.set(username, entry)
+                continue
+
+            with self._lock:
+                entry.generation = blob.generation
+            return True
+
+        return False
+
+
+def _apply(pages, changes):
+    for op, page_name in changes:
+        if op == 'add':
+            pages.add(page_name)
+        else:
+            pages.discard(page_name)
@@ -0,0 +1,637 @@
+import atexit
+import base64
+import binascii
+import bisect
+import json
+import threading
+import time
+
+from google.api_core import exceptions
+
+
+class PageIndex:
+    """
+    The names of every wiki page, kept as a sorted list without duplicates.
+
+    Keeping the list sorted lets us insert and look up names with a binary
+    search instead of listing the content bucket on every request. The whole
+    index serializes to a small JSON manifest, so a new instance can load it
+    with a single read.
+
+    Attributes:
+        generation - Generation of the manifest blob this index was loaded from
+                     or last saved to, 0 if it was never stored.
+    """
+
+    def __init__(self, names=(), generation=0):
+        self._names = sorted(set(names))
+        self.generation = generation
+
+    def __len__(self):
+        return len(self._names)
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __contains__(self, name):
+        i = bisect.bisect_left(self._names, name)
+        return i < len(self._names) and self._names[i] == name
+
+    def names(self):
+        return list(self._names)
+
+    def page(self, prefix='', start_after=None, limit=None):
+        """
+        Returns a slice of the sorted names, found with binary searches.
+
+        Args:
+            prefix - Only return names starting with this.
+
+            start_after - Only return names sorted after this one.
+
+            limit - Maximum number of names to return.
+
+        Returns:
+            A (names, has_more) tuple, `has_more` telling whether more names
+            would follow.
+        """
+        start = bisect.bisect_left(self._names, prefix)
+        if start_after is not None and start_after >= prefix:
+            start = bisect.bisect_right(self._names, start_after)
+
+        # Every name starting with the prefix sorts before this one
+        stop = (bisect.bisect_left(self._names, prefix + '\U0010ffff')
+                if prefix else len(self._names))
+
+        if limit is not None and start + limit < stop:
+            return self._names[start:start + limit], True
+        return self._names[start:stop], False
+
+    def add(self, name):
+        """
+        Adds `name` to the index. Returns True if it wasn't there yet.
+        """
+        i = bisect.bisect_left(self._names, name)
+        if i < len(self._names) and self._names[i] == name:
+            return False
+        self._names.insert(i, name)
+        return True
+
+    def remove(self, name):
+        """
+        Removes `name` from the index. Returns True if it was there.
+        """
+        i = bisect.bisect_left(self._names, name)
+        if i == len(self._names) or self._names[i] != name:
+            return False
+        del self._names[i]
+        return True
+
+    def dumps(self):
+        return json.dumps({'version': 1, 'names': self._names},
+                          separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, data, generation=0):
+        return cls(json.loads(data)['names'], generation)
+
+
+def encode_cursor(name):
+    """
+    Turns the last name of a page of results into an opaque cursor for the
+    next page.
+    """
+    return base64.urlsafe_b64encode(name.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Turns a cursor from `encode_cursor` back into a name. Raises ValueError if
+    the cursor is not valid.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return base64.b64decode(padded.encode('ascii'), altchars=b'-_',
+                                validate=True).decode('utf-8')
+    except (binascii.Error, UnicodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+class ImageIndex:
+    """
+    Maps page names to the name of the image blob uploaded for them.
+
+    A page missing from the index has no image, so answering "which image does
+    this page have?" never needs a storage request.
+
+    Attributes:
+        generation - Generation of the manifest blob this index was loaded from
+                     or last saved to, 0 if it was never stored.
+    """
+
+    def __init__(self, images=(), generation=0):
+        self._images = dict(images)
+        self.generation = generation
+
+    def __len__(self):
+        return len(self._images)
+
+    def __contains__(self, page_name):
+        return page_name in self._images
+
+    def get(self, page_name):
+        return self._images.get(page_name)
+
+    def add(self, page_name, blob_name):
+        """
+        Records `blob_name` as the image of `page_name`. Returns True if that
+        changed the index.
+        """
+        if self._images.get(page_name) == blob_name:
+            return False
+        self._images[page_name] = blob_name
+        return True
+
+    def remove(self, page_name):
+        return self._images.pop(page_name, None) is not None
+
+    def dumps(self):
+        return json.dumps({'version': 1, 'images': self._images},
+                          separators=(',', ':'), sort_keys=True)
+
+    @classmethod
+    def loads(cls, data, generation=0):
+        return cls(json.loads(data)['images'], generation)
+
+
+class StoredIndex:
+    """
+    Keeps an index (`PageIndex`, `ImageIndex`...) in memory and in a manifest
+    blob, so each instance only reads it once and no instance has to rebuild it
+    from a bucket listing more than once.
+
+    The bucket is passed to every call rather than kept, so tests and callers
+    can swap the bucket of the backend at any time.
+
+    Storage is only read and written holding `_io_lock`. Readers only take
+    `_lock`, which guards the index in memory, so a page view never waits for
+    a manifest being downloaded or uploaded: while the manifest is reloaded,
+    the index in memory is returned as it is.
+
+    Args:
+        manifest_name - Name of the manifest blob.
+
+        index_class - Class of the index. It needs `dumps`, `loads` and a
+        `generation` attribute, and may set the `content_type` of its manifest
+        (JSON by default).
+
+        build - Function taking the bucket and returning the entries of a new
+        index, called when there is no manifest yet.
+
+        ttl - Seconds before the manifest is checked for changes made by other
+        instances.
+
+        attempts - How many times `update` reloads the manifest and tries again
+        when another instance wrote it first.
+    """
+
+    def __init__(self, manifest_name, index_class, build, ttl, attempts=5):
+        self.manifest_name = manifest_name
+        self.index_class = index_class
+        self.build = build
+        self.ttl = ttl
+        self.attempts = attempts
+        self.index = None
+        self._loaded_at = None
+        self._lock = threading.RLock()
+        self._io_lock = threading.Lock()
+
+    def get(self, bucket):
+        """
+        Returns the index, loading it if it was never loaded or its TTL is up.
+        """
+        with self._lock:
+            if self.index is not None and not self._expired():
+                return self.index
+
+        # Only the first load is waited for
+        if not self._io_lock.acquire(blocking=self.index is None):
+            return self.index
+        try:
+            if self.index is None or self._expired():
+                self._set(self._load(bucket))
+            return self.index
+        finally:
+            self._io_lock.release()
+
+    def update(self, bucket, change):
+        """
+        Applies `change` to the index and saves the manifest.
+
+        Args:
+            bucket - Bucket holding the manifest.
+
+            change - Function taking the index, changing it and returning True
+            if anything changed. It may be called more than once, on a freshly
+            loaded index each time.
+        """
+        self.get(bucket)
+
+        with self._io_lock:
+            index = self.index
+            for _ in range(self.attempts):
+                with self._lock:
+                    if not change(index):
+                        return
+                    data = index.dumps()
+                    generation = index.generation
+
+                try:
+                    generation = self._upload(bucket, index, data, generation)
+                except exceptions.PreconditionFailed:
+                    # Another instance changed the manifest, start over from
+                    # its version
+                    index = self._load(bucket)
+                    self._set(index)
+                    continue
+
+                with self._lock:
+                    index.generation = generation
+                return
+
+    def rebuild(self, bucket):
+        """
+        Rebuilds the index with `build` and stores it as the new manifest.
+        """
+        with self._io_lock:
+            index = self.index_class(self.build(bucket))
+            current = bucket.get_blob(self.manifest_name)
+            index.generation = current.generation if current is not None else 0
+            self._save(bucket, index)
+            self._set(index)
+            return index
+
+    def _expired(self):
+        return (self._loaded_at is None or
+                time.monotonic() - self._loaded_at > self.ttl)
+
+    def _set(self, index):
+        with self._lock:
+            self.index = index
+            self._loaded_at = time.monotonic()
+
+    def _load(self, bucket):
+        blob = bucket.get_blob(self.manifest_name)
+
+        if blob is None:
+            # First run: build the index once, and store it so nobody has to
+            # build it again
+            index = self.index_class(self.build(bucket))
+            try:
+                self._save(bucket, index)
+            except exceptions.PreconditionFailed:
+                # Someone else stored it first, theirs is as good as ours
+                pass
+            return index
+
+        if self.index is not None and self.index.generation == blob.generation:
+            # Nothing changed since we last loaded it
+            return self.index
+
+        return self.index_class.loads(blob.download_as_bytes(), blob.generation)
+
+    def _save(self, bucket, index):
+        index.generation = self._upload(bucket, index, index.dumps(),
+                                        index.generation)
+
+    def _upload(self, bucket, index, data, generation):
+        # Only overwrite the manifest we loaded, so concurrent writers can't
+        # drop each other's entries. Returns the new generation.
+        blob = bucket.blob(self.manifest_name)
+        blob.upload_from_string(data,
+                                content_type=getattr(index, 'content_type',
+                                                     'application/json'),
+                                if_generation_match=generation)
+        return blob.generation
+
+
+class LoggedIndex:
+    """
+    Keeps a large index (`SearchIndex`) in memory and in storage as a snapshot
+    blob plus a log of the changes made since, so writing a page only appends
+    its text to the log rather than rewriting the whole index, and instances
+    catch up with each other by reading the log alone.
+
+    Changes are applied in memory at once and logged in batches, from a timer
+    thread `flush_delay` seconds after the first of them. Once the log is
+    longer than `log_size` bytes, the flush also writes a new snapshot holding
+    every logged change and starts a new log. Storage is only read and written
+    holding `_io_lock`: searches and changes take `_lock`, which only guards
+    the index in memory, so they never wait for a download or an upload.
+
+    Every change replaces or removes an entry, so applying a change twice is
+    harmless. A log written for an older snapshot (while a new one is being
+    written) is simply applied again on top of the new snapshot.
+
+    The log is a JSON object with the generation of the snapshot it was
+    started for and the changes, as [name, value] pairs, the value being None
+    for removed entries.
+
+    Args:
+        snapshot_name - Name of the snapshot blob.
+
+        log_name - Name of the log blob.
+
+        index_class - Class of the index. It needs `add(name, value)`,
+        `remove(name)`, `dumps`, `loads` and a `generation` attribute, and may
+        set the `content_type` of its snapshot.
+
+        build - Function taking the bucket and returning the (name, value)
+        pairs of a new index, called when there is no snapshot yet.
+
+        ttl - Seconds before the log is checked for changes made by other
+        instances.
+
+        flush_delay - Seconds to wait before logging changes. With 0, changes
+        are logged before `update` returns.
+
+        log_size - Bytes of log after which a new snapshot is written.
+
+        attempts - How many times a flush reads the log again and retries when
+        another instance wrote it first.
+    """
+
+    def __init__(self, snapshot_name, log_name, index_class, build, ttl,
+                 flush_delay=1.0, log_size=1024 * 1024, attempts=5):
+        self.snapshot_name = snapshot_name
+        self.log_name = log_name
+        self.index_class = index_class
+        self.build = build
+        self.ttl = ttl
+        self.flush_delay = flush_delay
+        self.log_size = log_size
+        self.attempts = attempts
+        self.index = None
+        self._loaded_at = None
+        # Generation of the log last read, the snapshot it was started for and
+        # how many of its changes are applied to `index`
+        self._log_generation = None
+        self._log_snapshot = None
+        self._applied = 0
+        # Changes not logged yet, and the ones being logged by `flush`
+        self._pending = []
+        self._writing = []
+        self._bucket = None
+        self._timer = None
+        self._flush_at_exit = False
+        self._lock = threading.RLock()
+        self._io_lock = threading.Lock()
+
+    def get(self, bucket):
+        """
+        Returns the index, loading it if it was never loaded or its TTL is up.
+        While another thread catches up with the log, the index in memory is
+        returned as it is.
+        """
+        with self._lock:
+            if self.index is not None and not self._expired():
+                return self.index
+
+        # Only the first load is waited for
+        if not self._io_lock.acquire(blocking=self.index is None):
+            return self.index
+        try:
+            if self.index is None or self._expired():
+                self._refresh(bucket)
+            return self.index
+        finally:
+            self._io_lock.release()
+
+    def read(self, bucket, function):
+        """
+        Returns `function(index)`, called while no change is being applied.
+        """
+        self.get(bucket)
+        with self._lock:
+            return function(self.index)
+
+    def update(self, bucket, changes):
+        """
+        Applies changes to the index in memory, and logs them later.
+
+        Args:
+            bucket - Bucket holding the snapshot and the log.
+
+            changes - (name, value) pairs, value None removing `name`.
+        """
+        changes = list(changes)
+        self.get(bucket)
+
+        with self._lock:
+            self._bucket = bucket
+            _apply_changes(self.index, changes)
+            self._pending.extend(changes)
+
+            if self.flush_delay > 0:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.flush_delay, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                if not self._flush_at_exit:
+                    # Don't lose the last changes when the instance shuts down
+                    atexit.register(self.flush)
+                    self._flush_at_exit = True
+
+        if self.flush_delay <= 0:
+            self.flush()
+
+    def flush(self):
+        """
+        Logs every pending change, and writes a new snapshot if the log got
+        too long.
+        """
+        with self._io_lock:
+            with self._lock:
+                self._writing, self._pending = self._pending, []
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                bucket = self._bucket
+
+            try:
+                if not self._writing:
+                    return
+                for _ in range(self.attempts):
+                    if self._append(bucket, self._writing):
+                        self._writing = []
+                        break
+            finally:
+                with self._lock:
+                    # Keep what couldn't be logged for the next flush
+                    self._pending = self._writing + self._pending
+                    self._writing = []
+
+    def rebuild(self, bucket):
+        """
+        Rebuilds the index with `build`, stores it as the new snapshot and
+        starts a new log.
+        """
+        with self._io_lock:
+            index = self.index_class(self.build(bucket))
+            current = bucket.get_blob(self.snapshot_name)
+            self._save_snapshot(bucket, index,
+                                current.generation if current else 0)
+            log_generation, _ = self._save_log(bucket, index.generation, [])
+
+            with self._lock:
+                self.index = index
+                self._log_generation = log_generation
+                self._log_snapshot = index.generation
+                self._applied = 0
+                self._loaded_at = time.monotonic()
+            return index
+
+    def _expired(self):
+        return (self._loaded_at is None or
+                time.monotonic() - self._loaded_at > self.ttl)
+
+    def _refresh(self, bucket):
+        # Loads the snapshot if it changed, then applies the changes logged
+        # since we last read the log
+        snapshot = bucket.get_blob(self.snapshot_name)
+        if snapshot is None:
+            # First run: build the index once, and store it so nobody has to
+            # build it again
+            index = self.index_class(self.build(bucket))
+            try:
+                self._save_snapshot(bucket, index, 0)
+            except exceptions.PreconditionFailed:
+                # Someone else stored it first, theirs is as good as ours
+                pass
+        elif (self.index is None or
+              self.index.generation != snapshot.generation):
+            index = self.index_class.loads(snapshot.download_as_bytes(),
+                                           snapshot.generation)
+        else:
+            index = self.index
+        fresh = index is not self.index
+
+        log_generation, log_snapshot, start, changes = (
+            self._log_generation, self._log_snapshot, self._applied, [])
+        log_blob = bucket.get_blob(self.log_name)
+        if log_blob is None:
+            log_generation, log_snapshot, start = 0, index.generation, 0
+        elif fresh or log_blob.generation != self._log_generation:
+            log_generation, log = self._read_log(bucket)
+            if fresh or log['snapshot'] != self._log_snapshot:
+                start = 0
+            log_snapshot = log['snapshot']
+            changes = log['changes'][start:]
+            start = len(log['changes'])
+
+        with self._lock:
+            _apply_changes(index, changes)
+            if fresh or changes:
+                # Our own changes are newer than the logged ones
+                _apply_changes(index, self._writing)
+                _apply_changes(index, self._pending)
+            self.index = index
+            self._log_generation = log_generation
+            self._log_snapshot = log_snapshot
+            self._applied = start
+            self._loaded_at = time.monotonic()
+
+    def _append(self, bucket, changes):
+        # Adds `changes` to the log. Returns False if someone else wrote the
+        # log meanwhile.
+        log_generation, log = self._read_log(bucket)
+        if log is None:
+            log = {'snapshot': self.index.generation, 'changes': []}
+        start = len(log['changes'])
+
+        try:
+            log_generation, size = self._save_log(bucket, log['snapshot'],
+                                                  log['changes'] + changes,
+                                                  log_generation)
+        except exceptions.PreconditionFailed:
+            return False
+
+        with self._lock:
+            # Catch up with what other instances logged before us
+            applied = (self._applied if log['snapshot'] == self._log_snapshot
+                       else 0)
+            others = log['changes'][applied:start]
+            if others:
+                _apply_changes(self.index, others)
+                _apply_changes(self.index, changes)
+                _apply_changes(self.index, self._pending)
+            self._log_generation = log_generation
+            self._log_snapshot = log['snapshot']
+            self._applied = start + len(changes)
+
+        if size > self.log_size:
+            self._compact(bucket)
+        return True
+
+    def _compact(self, bucket):
+        # Writes a new snapshot with every logged change and starts a new log
+        # with whatever was logged meanwhile. It is built apart from the index
+        # in memory, which may hold changes not logged yet.
+        snapshot = bucket.get_blob(self.snapshot_name)
+        log_generation, log = self._read_log(bucket)
+        if snapshot is None or log is None:
+            return
+        index = self.index_class.loads(snapshot.download_as_bytes(),
+                                       snapshot.generation)
+        _apply_changes(index, log['changes'])
+        done = len(log['changes'])
+
+        try:
+            self._save_snapshot(bucket, index, snapshot.generation)
+        except exceptions.PreconditionFailed:
+            # Another instance wrote a new snapshot first
+            return
+
+        for _ in range(self.attempts):
+            try:
+                self._save_log(bucket, index.generation, log['changes'][done:],
+                               log_generation)
+                return
+            except exceptions.PreconditionFailed:
+                # Changes were logged meanwhile, keep them in the new log
+                log_generation, log = self._read_log(bucket)
+
+    def _read_log(self, bucket):
+        # Downloading sets the generation, so this is a single read
+        blob = bucket.blob(self.log_name)
+        try:
+            data = blob.download_as_bytes()
+        except exceptions.NotFound:
+            return 0, None
+        return blob.generation, json.loads(data)
+
+    def _save_log(self, bucket, snapshot_generation, changes,
+                  if_generation_match=None):
+        # Returns the generation and size of the new log
+        data = json.dumps({'version': 1, 'snapshot': snapshot_generation,
+                           'changes': changes}, separators=(',', ':'))
+        blob = bucket.blob(self.log_name)
+        blob.upload_from_string(data, content_type='application/json',
+                                if_generation_match=if_generation_match)
+        return blob.generation, len(data)
+
+    def _save_snapshot(self, bucket, index, if_generation_match):
+        blob = bucket.blob(self.snapshot_name)
+        blob.upload_from_string(index.dumps(),
+                                content_type=getattr(index, 'content_type',
+                                                     'application/json'),
+                                if_generation_match=if_generation_match)
+        index.generation = blob.generation
+
+
+def _apply_changes(index, changes):
+    for name, value in changes:
+        if value is None:
+            index.remove(name)
+        else:
+            index.add(name, value)
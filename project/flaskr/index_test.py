@@ -0,0 +1,138 @@
+import json
+import threading
+from unittest import mock
+
+import pytest
+from flaskr import storage
+from flaskr.index import (ImageIndex, LoggedIndex, PageIndex, StoredIndex,
+                          decode_cursor, encode_cursor)
+from flaskr.search import SearchIndex
+
+
+def test_page_index_stays_sorted():
+    index = PageIndex(["Mario", "Zelda", "Mario", "Donkey-Kong"])
+    assert index.names() == ["Donkey-Kong", "Mario", "Zelda"]
+
+    assert index.add("Metroid")
+    assert not index.add("Mario")
+    assert index.names() == ["Donkey-Kong", "Mario", "Metroid", "Zelda"]
+
+    assert index.remove("Mario")
+    assert not index.remove("Mario")
+    assert "Mario" not in index
+    assert "Zelda" in index
+
+
+def test_page_index_round_trip():
+    index = PageIndex(["Mario", "Zelda"])
+    loaded = PageIndex.loads(index.dumps(), generation=7)
+    assert loaded.names() == ["Mario", "Zelda"]
+    assert loaded.generation == 7
+
+
+def test_image_index():
+    index = ImageIndex()
+    assert index.add("Mario", "Mario.png")
+    assert not index.add("Mario", "Mario.png")
+    assert index.add("Mario", "Mario.jpg")
+    assert index.get("Mario") == "Mario.jpg"
+    assert index.get("Zelda") is None
+
+    loaded = ImageIndex.loads(index.dumps())
+    assert loaded.get("Mario") == "Mario.jpg"
+
+
+def test_page_index_pages():
+    index = PageIndex(["Mario", "Mario-Kart", "Metroid", "Zelda", "Donkey-Kong"])
+
+    assert index.page(limit=2) == (["Donkey-Kong", "Mario"], True)
+    assert index.page(start_after="Mario", limit=2) == (["Mario-Kart", "Metroid"],
+                                                       True)
+    assert index.page(start_after="Metroid", limit=2) == (["Zelda"], False)
+
+    assert index.page(prefix="Mario") == (["Mario", "Mario-Kart"], False)
+    assert index.page(prefix="M", start_after="Mario", limit=1) == (
+        ["Mario-Kart"], True)
+    assert index.page(prefix="Luigi") == ([], False)
+
+
+def test_cursors():
+    assert decode_cursor(encode_cursor("Super Mario/Bros")) == "Super Mario/Bros"
+    with pytest.raises(ValueError):
+        decode_cursor("%%%")
+
+
+def test_logged_index_logs_changes_in_batches():
+    bucket = storage.MemoryDriver().bucket("wiki")
+    build = mock.Mock(return_value=[("Mario", "It's a me")])
+    index = LoggedIndex("index.bin", "index.log", SearchIndex, build, ttl=0,
+                        flush_delay=60)
+    other = LoggedIndex("index.bin", "index.log", SearchIndex, build, ttl=0,
+                        flush_delay=0)
+
+    assert len(index.get(bucket)) == 1
+    snapshot = bucket.get_blob("index.bin").generation
+
+    # Changes show up in memory at once, and are only logged when flushed
+    index.update(bucket, [("Luigi", "Mama mia"), ("Mario", "Wahoo")])
+    assert index.read(bucket, lambda i: len(i.search("wahoo"))) == 1
+    assert bucket.get_blob("index.log") is None
+    index.flush()
+    assert bucket.get_blob("index.bin").generation == snapshot
+
+    # Another instance reads the snapshot and the log, and logs its own change
+    assert [r.name for r in other.get(bucket).search("wahoo")] == ["Mario"]
+    other.update(bucket, [("Luigi", None)])
+    assert "Luigi" not in index.get(bucket)
+    build.assert_called_once()
+
+
+def test_logged_index_writes_snapshot_when_log_is_long():
+    bucket = storage.MemoryDriver().bucket("wiki")
+    index = LoggedIndex("index.bin", "index.log", SearchIndex, lambda b: [],
+                        ttl=60, flush_delay=0, log_size=100)
+    index.update(bucket, [("Mario", "It's a me")])
+    snapshot = bucket.get_blob("index.bin").generation
+
+    index.update(bucket, [("Zelda", "Link saves princess Zelda " * 10)])
+    assert bucket.get_blob("index.bin").generation != snapshot
+    log = json.loads(bucket.get_blob("index.log").download_as_bytes())
+    assert log['changes'] == []
+
+    fresh = LoggedIndex("index.bin", "index.log", SearchIndex, lambda b: [],
+                        ttl=60)
+    assert [r.name for r in fresh.get(bucket).search("me zelda")] == [
+        "Zelda", "Mario"]
+
+
+def test_stored_index_reads_while_saving():
+    bucket = storage.MemoryDriver().bucket("wiki")
+    index = StoredIndex("index.json", PageIndex, lambda b: ["Mario"], ttl=60)
+    index.get(bucket)
+
+    # The upload of the manifest hangs until we let it go
+    uploading = threading.Event()
+    release = threading.Event()
+    upload = storage._Blob.upload_from_string
+
+    def slow_upload(blob, *args, **kwargs):
+        uploading.set()
+        release.wait(5)
+        return upload(blob, *args, **kwargs)
+
+    with mock.patch.object(storage._Blob, "upload_from_string", slow_upload):
+        writer = threading.Thread(
+            target=index.update, args=(bucket, lambda i: i.add("Zelda")))
+        writer.start()
+        assert uploading.wait(5)
+        # Readers don't wait for the upload
+        reader = threading.Thread(target=index.get, args=(bucket,))
+        reader.start()
+        reader.join(1)
+        assert not reader.is_alive()
+        release.set()
+        writer.join(5)
+
+    assert "Zelda" in index.get(bucket)
+    loaded = PageIndex.loads(bucket.get_blob("index.json").download_as_bytes())
+    assert loaded.names() == ["Mario", "Zelda"]
@@ -0,0 +1,338 @@
+import bisect
+import contextvars
+import threading
+
+# Upper bounds, in seconds, of the buckets of every latency histogram.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+# Route reported for storage requests made outside of any HTTP request (index
+# loads on a timer, favorites flushes...).
+BACKGROUND_ROUTE = 'background'
+
+
+class RequestStats:
+    """
+    Totals of the storage requests made while serving one HTTP request.
+
+    Attributes:
+        route - Rule of the Flask route serving the request, such as
+                "/pages/<path:page_path>".
+
+        storage_calls - Number of storage requests made so far.
+
+        storage_seconds - Time spent waiting on them, in seconds. Requests
+                          made concurrently all count in full.
+    """
+
+    def __init__(self, route):
+        self.route = route
+        self.storage_calls = 0
+        self.storage_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        # Requests can be made from several fetch threads at once
+        with self._lock:
+            self.storage_calls += 1
+            self.storage_seconds += seconds
+
+
+# Stats of the HTTP request being served. Calls run on the backend's fetch
+# pool get a copy of the context, and with it the same `RequestStats`.
+_request_stats = contextvars.ContextVar('request_stats', default=None)
+
+
+def start_request(route):
+    """
+    Starts counting the storage requests of an HTTP request.
+
+    Returns:
+        A (stats, token) tuple. Pass the token to `end_request` once the
+        request is done.
+    """
+    stats = RequestStats(route)
+    return stats, _request_stats.set(stats)
+
+
+def end_request(token):
+    _request_stats.reset(token)
+
+
+def current_request():
+    """
+    Returns the `RequestStats` of the HTTP request being served, or None.
+    """
+    return _request_stats.get()
+
+
+class Counter:
+    """
+    A Prometheus counter, with one value per combination of label values.
+    """
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def total(self):
+        """
+        Returns the sum of the values of every label combination.
+        """
+        with self._lock:
+            return sum(self._values.values())
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+
+class Gauge:
+    """
+    A Prometheus gauge: a value that can go up and down, or be set.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def add(self, amount, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        with self._lock:
+            return self._values.get(label_values)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+
+class Histogram:
+    """
+    A Prometheus histogram: counts of the observed values falling under each
+    bucket bound, plus their count and sum, per combination of label values.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count per bucket..., count above the last bucket,
+        #                  total count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 3)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def count(self, *label_values):
+        with self._lock:
+            counts = self._values.get(label_values)
+            return counts[-2] if counts else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, list(counts))
+                            for key, counts in self._values.items())
+        for label_values, counts in values:
+            labels = dict(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield (self.name + '_bucket', dict(labels, le=_format(bound)),
+                       cumulative)
+            yield self.name + '_bucket', dict(labels, le='+Inf'), counts[-2]
+            yield self.name + '_count', labels, counts[-2]
+            yield self.name + '_sum', labels, counts[-1]
+
+
+class StartupTimes:
+    """
+    How long the app took to start, to keep an eye on cold starts.
+
+    Attributes:
+        import_seconds - Time spent importing the `flaskr` package and its
+                         dependencies.
+
+        create_app_seconds - Time spent in `create_app`.
+
+        first_request_seconds - Time spent serving the first request, which
+                                pays for everything initialized lazily. None
+                                until it is served.
+
+        ready_seconds - Time from the start of the imports to the end of the
+                        first request. None until it is served.
+    """
+
+    def __init__(self, import_started, import_seconds, create_app_seconds):
+        self.import_started = import_started
+        self.import_seconds = import_seconds
+        self.create_app_seconds = create_app_seconds
+        self.first_request_seconds = None
+        self.ready_seconds = None
+        self._lock = threading.Lock()
+
+    def first_request(self, seconds, now):
+        """
+        Records the duration of a request that just ended at `now` (a
+        `time.perf_counter` value). Returns True if it was the first one.
+        """
+        with self._lock:
+            if self.first_request_seconds is not None:
+                return False
+            self.first_request_seconds = seconds
+            self.ready_seconds = now - self.import_started
+            return True
+
+    def collect(self):
+        # Registered with `Metrics.add_collector`
+        gauge = Gauge('wiki_startup_seconds',
+                      'Time spent starting the app, by phase.', ['phase'])
+        for phase in ['import', 'create_app', 'first_request', 'ready']:
+            value = getattr(self, phase + '_seconds')
+            if value is not None:
+                gauge.set(value, phase)
+        return [gauge]
+
+
+class Metrics:
+    """
+    The counters and histograms of the app, rendered in the Prometheus text
+    format by `render`.
+
+    Storage requests are reported through `record_storage`, which the backend
+    hands to `storage.InstrumentedDriver`. They are counted by operation and by
+    the route of the HTTP request that made them.
+
+    Attributes:
+        storage_operations - Counter of storage requests.
+
+        storage_errors - Counter of storage requests that raised.
+
+        storage_seconds - Histogram of storage request latencies.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+        self.storage_operations = self.counter(
+            'wiki_storage_operations_total',
+            'Storage requests, by operation and route.',
+            ['operation', 'route'])
+        self.storage_errors = self.counter(
+            'wiki_storage_errors_total',
+            'Storage requests that raised, by operation and route.',
+            ['operation', 'route'])
+        self.storage_seconds = self.histogram(
+            'wiki_storage_operation_seconds',
+            'Latency of storage requests, by operation and route.',
+            ['operation', 'route'])
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge(name, help, labels))
+
+    def add_collector(self, collect):
+        """
+        Registers a function called on every `render`, returning more metrics
+        (objects with `name`, `help`, `type` and `samples`) computed from the
+        state of the app, such as cache counters.
+        """
+        with self._lock:
+            self._collectors.append(collect)
+
+    def _add(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def record_storage(self, operation, seconds, failed=False):
+        stats = current_request()
+        route = stats.route if stats is not None else BACKGROUND_ROUTE
+        if stats is not None:
+            stats.add(seconds)
+
+        self.storage_operations.inc(operation, route)
+        self.storage_seconds.observe(seconds, operation, route)
+        if failed:
+            self.storage_errors.inc(operation, route)
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        for collect in collectors:
+            metrics.extend(collect())
+
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{_format_labels(labels)} {_format(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{_escape(str(value))}"'
+                     for key, value in labels.items())
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
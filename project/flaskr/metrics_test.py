@@ -0,0 +1,54 @@
+import contextvars
+
+from flaskr import metrics
+
+
+def test_counter_and_histogram_render():
+    registry = metrics.Metrics()
+    hits = registry.counter('hits_total', 'Hits.', ['page'])
+    latency = registry.histogram('latency_seconds', 'Latency.', ['page'],
+                                 buckets=[0.1, 1])
+    hits.inc('Mario')
+    hits.inc('Mario', amount=2)
+    latency.observe(0.05, 'Mario')
+    latency.observe(0.5, 'Mario')
+    latency.observe(5, 'Mario')
+
+    text = registry.render()
+    assert '# TYPE hits_total counter\nhits_total{page="Mario"} 3\n' in text
+    assert '# TYPE latency_seconds histogram' in text
+    assert 'latency_seconds_bucket{page="Mario",le="0.1"} 1\n' in text
+    assert 'latency_seconds_bucket{page="Mario",le="1"} 2\n' in text
+    assert 'latency_seconds_bucket{page="Mario",le="+Inf"} 3\n' in text
+    assert 'latency_seconds_count{page="Mario"} 3\n' in text
+    assert 'latency_seconds_sum{page="Mario"} 5.55\n' in text
+
+
+def test_label_values_are_escaped():
+    registry = metrics.Metrics()
+    registry.counter('hits_total', 'Hits.', ['page']).inc('a "b"\\')
+    assert 'hits_total{page="a \\"b\\"\\\\"} 1' in registry.render()
+
+
+def test_record_storage_by_route():
+    registry = metrics.Metrics()
+    registry.record_storage('get_blob', 0.002)
+
+    stats, token = metrics.start_request('/pages/<path:page_path>')
+    try:
+        registry.record_storage('get_blob', 0.001)
+        # Calls made on other threads share the request through the context
+        contextvars.copy_context().run(registry.record_storage,
+                                       'download_as_text', 0.003, True)
+    finally:
+        metrics.end_request(token)
+
+    assert metrics.current_request() is None
+    assert stats.storage_calls == 2
+    assert abs(stats.storage_seconds - 0.004) < 1e-9
+    assert registry.storage_operations.get('get_blob', 'background') == 1
+    assert registry.storage_operations.get('get_blob',
+                                           '/pages/<path:page_path>') == 1
+    assert registry.storage_errors.get('download_as_text',
+                                       '/pages/<path:page_path>') == 1
+    assert registry.storage_seconds.count('get_blob', 'background') == 1
@@ -1,15 +1,80 @@
-from flask import render_template, redirect, url_for, request, flash
+from flask import render_template, redirect, url_for, request, flash, session
 from flask_login import LoginManager, login_user, logout_user, current_user, login_required
 from flaskr import user
-from flask import Response
-import base64
-import re
-import requests
+from flask import Response, make_response, g
+import hashlib
+import mimetypes
+import tarfile
+import time
 from flask import abort
-from flaskr.backend import Backend
+from markupsafe import Markup
+from werkzeug.datastructures import ContentRange
+from werkzeug.http import is_resource_modified
+from flaskr import metrics
+from flaskr import bulk
+from flaskr import render
+from flaskr.passwords import Overloaded
 
 def make_endpoints(app, backend):
-    backend = Backend()
+    # Every request is timed, and so are the storage requests it makes
+    request_seconds = backend.metrics.histogram(
+        'wiki_http_request_seconds',
+        'Time spent serving HTTP requests, by route, method and status.',
+        ['route', 'method', 'status'])
+
+    @app.before_request
+    def start_request_metrics():
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        g.request_started = time.perf_counter()
+        g.request_stats, g.request_stats_token = metrics.start_request(route)
+
+    @app.after_request
+    def record_request_metrics(response):
+        stats = g.get('request_stats')
+        if stats is None:
+            return response
+
+        now = time.perf_counter()
+        seconds = now - g.request_started
+        request_seconds.observe(seconds, stats.route, request.method,
+                                str(response.status_code))
+
+        # One line per request, to find the routes hitting storage the most
+        app.logger.info(
+            "%s %s %s %.1fms storage calls=%d storage ms=%.1f route=%s",
+            request.method, request.path, response.status_code,
+            seconds * 1000, stats.storage_calls,
+            stats.storage_seconds * 1000, stats.route)
+
+        startup = app.extensions.get('startup')
+        if startup is not None and startup.first_request(seconds, now):
+            app.logger.info(
+                "Cold start: import %.0fms, create_app %.0fms, "
+                "first request %.0fms, ready after %.0fms",
+                startup.import_seconds * 1000,
+                startup.create_app_seconds * 1000, seconds * 1000,
+                startup.ready_seconds * 1000)
+        return response
+
+    @app.teardown_request
+    def end_request_metrics(exception=None):
+        token = g.pop('request_stats_token', None)
+        if token is not None:
+            metrics.end_request(token)
+
+    @app.route("/_ah/warmup")
+    def warmup():
+        # App Engine sends this before routing traffic to a new instance, so
+        # the first user doesn't pay for building clients and loading indexes
+        backend.warm_up()
+        return "", 200
+
+    @app.route("/metrics")
+    def prometheus_metrics():
+        # Scraped by Prometheus, in its text format
+        return Response(backend.metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
+
     # Flask uses the "app.route" decorator to call methods when users
     # go to a specific route on the project's website.
     @app.route("/")
@@ -21,67 +86,258 @@ def make_endpoints(app, backend):
         return render_template("main.html", greeting=greeting)
 
 
+    def page_validators(page_path, *extra, info=None):
+        """
+        Builds the ETag and Last-Modified of a rendered page without downloading
+        or rendering it.
+
+        Args:
+            page_path - Name of the page.
+
+            extra - Anything else the rendered HTML depends on (its image, the
+            user and their favorites...).
+
+            info - The `PageInfo` of the page, if it was fetched already.
+
+        Returns:
+            An (etag, last_modified) tuple, or None if the page doesn't exist.
+        """
+        if info is None:
+            info = backend.get_page_info(page_path)
+        if info is None:
+            return None
+
+        # The HTML also changes with the renderer, so pages rendered by an
+        # older version are not revalidated as current
+        etag = hashlib.sha1(
+            repr((page_path, info.generation, render.RENDERER_VERSION) +
+                 extra).encode('utf-8')).hexdigest()
+        return etag, info.updated
+
+    def cache_policy():
+        # Anonymous pages are the same for everyone and can sit in the CDN,
+        # pages of logged in users can only be kept by their browser
+        if current_user.is_authenticated:
+            return app.config['PAGE_CACHE_CONTROL_PRIVATE']
+        return app.config['PAGE_CACHE_CONTROL_PUBLIC']
+
+    def conditional_response(validators, render):
+        """
+        Answers with 304 if the client's copy is still current, otherwise calls
+        `render` to build the response. Either way the response gets the
+        validators and caching headers.
+        """
+        etag, last_modified = validators
+        if is_resource_modified(request.environ, etag=etag,
+                                last_modified=last_modified):
+            response = make_response(render())
+        else:
+            response = Response(status=304)
+
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers['Cache-Control'] = cache_policy()
+        response.vary.add('Cookie')
+        return response
+
     @app.route("/pages/<path:page_path>")
     def page(page_path):
+        username = current_user.get_id()
+
+        # Everything the validators depend on is fetched at once, and reused
+        # to render the page. The HTML is only fetched if the browser's copy
+        # is stale.
+        view = backend.get_page_view(page_path, username, html=False)
+        validators = page_validators(page_path, view.image, username,
+                                     view.is_favorite, info=view.info)
+
+        # if we're given a non-existing page name, just send back to the index
+        if validators is None:
+            return redirect(url_for("page_index"))
+
+        return conditional_response(
+            validators,
+            lambda: render_page(page_path, view._replace(
+                html=backend.get_page_html(page_path))))
+
+    def render_page(page_path, view):
+
         # Check if the page exists in the backend
-        if backend.get_wiki_page(page_path):
-
-            """
-            Fetch the text associated with the page from the GCS content bucket and render the "page.html" template
-            This essentially just calls `text = backend.get_wiki_page(page_path)` to get the contents of that page.
-            """
-            text = fetch_page_text(page_path) 
-
-            image_name = page_path
-            is_page_in_favorites = page_path in backend.get_favorites(current_user.get_id())
-            if backend.get_wiki_image(image_name):
-                image = backend.get_wiki_image(image_name)
+        if view.html:
+            # The HTML was rendered and escaped by the backend when the page
+            # was written
+            html = Markup(view.html)
+            is_page_in_favorites = view.is_favorite
+            if view.image:
+                image = view.image
                 image_text = ""
-                return render_template("page.html", page_name=page_path, text = text, image = image, image_text = image_text, image_passed = True, is_page_in_favorites=is_page_in_favorites, page_path=page_path)
-            return render_template("page.html", page_name=page_path, text=text, image = None, image_passed = False, is_page_in_favorites=is_page_in_favorites, page_path=page_path)
+                return render_template("page.html", page_name=page_path, html = html, image = image, image_text = image_text, image_passed = True, is_page_in_favorites=is_page_in_favorites, page_path=page_path)
+            return render_template("page.html", page_name=page_path, html=html, image = None, image_passed = False, is_page_in_favorites=is_page_in_favorites, page_path=page_path)
             
         # if we're given a non-existing page name, just send back to the index
         return redirect(url_for("page_index"))
 
+    @app.route("/pages/<path:page_path>/image")
+    def page_image(page_path):
+        # Sends the browser to the smallest variant of the page image at least
+        # ?w= pixels wide, in WebP if it says it reads it
+        width = request.args.get('w', 0, type=int)
+        webp = 'image/webp' in request.accept_mimetypes
+        url = backend.pick_image_variant(page_path, width, webp)
+        if url is None:
+            abort(404)
+
+        response = redirect(url)
+        response.vary.add('Accept')
+        return response
+
+    @app.route("/pages/<path:page_path>/history")
+    def page_history(page_path):
+        history = backend.get_revisions(page_path)
+        if not history and backend.get_page_info(page_path) is None:
+            return redirect(url_for("page_index"))
+        return render_template("history.html", page_name=page_path,
+                               revisions=list(reversed(history)))
+
+    @app.route("/pages/<path:page_path>/history/<int:number>")
+    def page_revision(page_path, number):
+        text = backend.get_revision(page_path, number)
+        if text is None:
+            abort(404)
+
+        # Old revisions are rendered when viewed, they're rarely looked at
+        return render_template("revision.html", page_name=page_path,
+                               number=number,
+                               html=Markup(render.render_page(text)))
+
+    @app.route("/pages/<path:page_path>/diff")
+    def page_diff(page_path):
+        old = request.args.get('from', type=int)
+        new = request.args.get('to', type=int)
+        if old is None or new is None:
+            abort(400)
+
+        lines = backend.diff_revisions(page_path, old, new)
+        if lines is None:
+            abort(404)
+        return render_template("diff.html", page_name=page_path, old=old,
+                               new=new, lines=lines)
+
     @app.route("/pages")
     def page_index():
-        # Fetch a list of pages from the GCS content bucket and render the "page_index.html" template
-        pages = backend.get_all_page_names()
+        # Fetch one page of the sorted page names, optionally only the ones
+        # starting with ?prefix=, and render the "page_index.html" template
+        prefix = request.args.get('prefix', '')
+        cursor = request.args.get('cursor')
+        try:
+            limit = int(request.args.get('limit', app.config['PAGE_INDEX_LIMIT']))
+            if limit < 1:
+                raise ValueError(limit)
+            pages, next_cursor = backend.get_page_names(
+                prefix, min(limit, app.config['PAGE_INDEX_MAX_LIMIT']), cursor)
+        except ValueError:
+            abort(400)
+
+        next_url = None
+        if next_cursor is not None:
+            next_url = url_for('page_index', prefix=prefix or None, limit=limit,
+                               cursor=next_cursor)
+
         if not pages:
             message = "No pages available."
-            return render_template("page_index.html", message=message)
+            return render_template("page_index.html", message=message, prefix=prefix)
         else:
-            return render_template("page_index.html", pages=pages)
+            return render_template("page_index.html", pages=pages, prefix=prefix,
+                                   next_url=next_url)
 
-    def fetch_page_text(page_name):
-        # Fetch the text associated with the page from the backend
-        text = backend.get_wiki_page(page_name)
-        return text
+    @app.route("/search")
+    def search():
+        # Search the text of every page, the results come from the index in memory
+        query = request.args.get('q', '').strip()
+        results = backend.search(query) if query else []
+        return render_template("search.html", query=query, results=results)
 
     @app.route('/image/<name>')
     def fetch_images(name):
-        backend = Backend()
-        img_bytes = backend.get_image(name)
+        blob = backend.get_image_blob(name)
 
-        if img_bytes is not None:
-            # If the image data was successfully retrieved, return a Flask Response object that sends the image data
-            return Response(img_bytes, mimetype='image/jpeg')
+        if blob is None:
+            # If the image could not be found, return a 404 error
+            return 'Image not found', 404
 
+        # The ETag changes whenever the image does, so browsers and the CDN
+        # can keep their copy until then
+        etag = blob.md5_hash or str(blob.generation)
+        # If-None-Match takes the weak comparison: W/ tags (from proxies that
+        # compress) and "*" match too
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            set_image_cache_control(response, blob)
+            return response
+
+        mimetype = blob.content_type
+        if not mimetype or mimetype == 'application/octet-stream':
+            mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+        # Only send the requested part of the image, unless the client's copy
+        # is outdated (If-Range) or it asked for several ranges at once
+        size = blob.size
+        start, stop = 0, size
+        status = 200
+        byte_range = request.range
+        if_range = request.if_range
+        if (byte_range is not None and len(byte_range.ranges) == 1 and
+                if_range.date is None and if_range.etag in (None, etag)):
+            bounds = byte_range.range_for_length(size)
+            if bounds is None:
+                response = Response('Requested range not satisfiable', 416)
+                response.headers['Content-Range'] = f"bytes */{size}"
+                return response
+            start, stop = bounds
+            status = 206
+
+        # Send the image a chunk at a time, straight from storage
+        response = Response(backend.stream_blob(blob, start, stop - 1),
+                            status=status,
+                            mimetype=mimetype,
+                            direct_passthrough=True)
+        response.content_length = stop - start
+        if status == 206:
+            response.content_range = ContentRange('bytes', start, stop, size)
+        response.accept_ranges = 'bytes'
+        response.set_etag(etag)
+        response.last_modified = blob.updated
+        set_image_cache_control(response, blob)
+        return response
+
+    def set_image_cache_control(response, blob):
+        response.cache_control.public = True
+        if request.args.get('v') == str(blob.generation):
+            # Versioned URLs (see `about`) never change, a new version of the
+            # image gets a new URL
+            response.cache_control.max_age = 365 * 24 * 60 * 60
+            response.cache_control.immutable = True
         else:
-            # If the image data could not be retrieved, return a 404 error
-            return 'Image not found', 404
+            response.cache_control.max_age = app.config['IMAGE_MAX_AGE']
 
     @app.route("/about")
     def about():
-        # Fetch the image data for each team member
+        # Link each team member's image by version, so browsers fetch it once
+        # from /image/ instead of us downloading and inlining it every time
         TEAM_MEMBERS = ['Cambrell', 'Samuel', 'Angel']
+        image_names = {
+            name: f"{name.lower().replace(' ', '_')}.jpg" for name in TEAM_MEMBERS
+        }
+        assets = backend.get_image_assets(list(image_names.values()))
+
         author_images = {}
-        for name in TEAM_MEMBERS:
-            image_name = f"{name.lower().replace(' ', '_')}.jpg"
-            img_bytes = backend.get_image(image_name)
-            if img_bytes is not None:
-                author_images[name] = base64.b64encode(
-                    img_bytes.getvalue()).decode('utf-8')
+        for name, image_name in image_names.items():
+            asset = assets.get(image_name)
+            if asset is not None:
+                author_images[name] = url_for('fetch_images',
+                                              name=image_name,
+                                              v=asset.generation)
 
         # Render the "about.html" template with the author images
         return render_template("about.html", author_images=author_images)
@@ -105,17 +361,18 @@ def make_endpoints(app, backend):
             file.filename = wikiname + "." + file_extension
             
 
-            # Upload the file to Cloud Storage
-            backend.upload(file)
-
             # If there is an image, then we must also upload it.
             if image_file:
                 
                 # Get extension and rename it
                 image_extension = image_file.filename.split(".")[1]
                 image_file.filename = wikiname + "." + image_extension
+            else:
+                image_file = None
 
-                backend.upload_image(image_file)
+            # Stream both files to Cloud Storage at the same time. They are
+            # indexed once we answered.
+            backend.upload_page_files(file, image_file)
 
 
             # Redirect to the home page after the upload is complete
@@ -138,13 +395,31 @@ def make_endpoints(app, backend):
     @login_manager.user_loader
     def load_user(user_ID):
 
+        # The session cookie is signed, so if we checked this user recently
+        # enough we can take the cookie's word for it
+        trust_seconds = app.config['USER_SESSION_TRUST_SECONDS']
+        checked = session.get('user_checked')
+        if (trust_seconds and checked and checked[0] == user_ID and
+                time.time() - checked[1] < trust_seconds):
+            return user.User(user_ID)
+
         #Lookup the user by the ID and if it exists return it, otherwise return None
 
         user_exists = backend.get_user(user_ID)
         if user_exists:
+            if trust_seconds:
+                session['user_checked'] = [user_ID, time.time()]
             return user.User(user_ID)
         return None
 
+    def too_busy(template):
+        # Too many passwords are being hashed, turn this one away rather than
+        # tie up another worker
+        flash("Too many people are logging in right now, please try again in a moment")
+        response = make_response(render_template(template), 503)
+        response.headers['Retry-After'] = '1'
+        return response
+
     @app.route('/login', methods=["POST", "GET"])
     def login():
 
@@ -159,7 +434,10 @@ def make_endpoints(app, backend):
                 )
                 return redirect(url_for('login'))
 
-            successful_login = backend.sign_in(user_ID, user_password)
+            try:
+                successful_login = backend.sign_in(user_ID, user_password)
+            except Overloaded:
+                return too_busy("login.html")
 
             if successful_login:
                 # If the user is logged in successfully,
@@ -188,6 +466,7 @@ def make_endpoints(app, backend):
     @login_required
     def logout():
         logout_user()
+        session.pop('user_checked', None)
         return redirect(url_for('home'))
 
     @app.route("/signup", methods=["POST", "GET"])
@@ -206,7 +485,10 @@ def make_endpoints(app, backend):
 
             prefixed_password = "" + password
 
-            succesful_signup = backend.sign_up(username, prefixed_password)
+            try:
+                succesful_signup = backend.sign_up(username, prefixed_password)
+            except Overloaded:
+                return too_busy("signup.html")
 
             if succesful_signup:
                 new_user = user.User(username)
@@ -222,7 +504,6 @@ def make_endpoints(app, backend):
     @app.route("/add-favs/<page_path>", methods=["POST"])
     @login_required
     def add_to_favorites(page_path):
-        backend = Backend()
         if request.method == 'POST':
             current_username = current_user.get_id()
             backend.add_to_favorites(page_path, current_username)
@@ -233,7 +514,6 @@ def make_endpoints(app, backend):
     @app.route("/remove-favs/<page_path>", methods=["POST"])
     @login_required
     def remove_from_favorites(page_path):
-        backend = Backend()
         if request.method == 'POST':
             current_username = current_user.get_id()
             backend.remove_from_favorites(page_path, current_username)
@@ -241,6 +521,46 @@ def make_endpoints(app, backend):
             return redirect(url_for('page' , page_path = page_path))
         return redirect(url_for('page' , page_path = page_path))
 
+    def require_admin():
+        # Only the users listed in ADMIN_USERS may move the whole wiki around
+        if current_user.get_id() not in app.config['ADMIN_USERS']:
+            abort(403)
+
+    @app.route("/admin/export")
+    @login_required
+    def admin_export():
+        require_admin()
+        archive_format = request.args.get('format', 'tar')
+        if archive_format not in bulk.FORMATS:
+            abort(400)
+
+        # Streamed as it is built, pages are downloaded a batch at a time
+        response = Response(
+            bulk.write_archive(backend.export_items(), archive_format),
+            mimetype=bulk.CONTENT_TYPES[archive_format])
+        response.headers['Content-Disposition'] = (
+            f'attachment; filename={bulk.FILENAMES[archive_format]}')
+        return response
+
+    @app.route("/admin/import", methods=["POST"])
+    @login_required
+    def admin_import():
+        require_admin()
+        archive = request.files.get('archive')
+        if not archive:
+            abort(400)
+
+        archive_format = request.form.get('format') or bulk.format_for(
+            archive.filename)
+        overwrite = request.form.get('overwrite', 'true') != 'false'
+        try:
+            result = backend.import_items(
+                bulk.read_archive(archive.stream, archive_format),
+                overwrite=overwrite)
+        except (ValueError, tarfile.TarError) as e:
+            return {'error': str(e)}, 400
+        return result._asdict()
+
     @app.route("/favs")
     @login_required
     def display_favs():
@@ -250,7 +570,6 @@ def make_endpoints(app, backend):
         """
         #Creating variables for intialization  
         current_username = current_user.get_id()
-        backend = Backend()        
         return render_template("favorites.html", pages = backend.get_favorites(current_username))                 
         
 
@@ -263,8 +582,10 @@ def make_endpoints(app, backend):
             content = request.form['content']
             author = request.form['author']
 
-            # Create the page in the backend
-            backend.create_wiki_page(title, content, author)
+            # Create the page in the backend, unless it already exists
+            if backend.create_wiki_page(title, content, author) is None:
+                flash("A page with this title already exists!")
+                return redirect(url_for('create_page'))
 
             # Redirect to the newly created page
             return redirect(url_for('page', page_path=title.replace(' ', '-')))
@@ -274,12 +595,22 @@ def make_endpoints(app, backend):
 
     @app.route('/wiki/<path:page_path>')
     def view_page(page_path):
-        # Get the content of the page
-        content = backend.get_wiki_page(page_path)
+        validators = page_validators(page_path, current_user.get_id())
+
+        # If the page doesn't exist, return a 404 error
+        if validators is None:
+            abort(404)
+
+        return conditional_response(validators, lambda: render_view_page(page_path))
+
+    def render_view_page(page_path):
+        # Get the rendered content of the page
+        content = backend.get_page_html(page_path)
 
         # If the page doesn't exist, return a 404 error
         if content is None:
             abort(404)
+        content = Markup(content)
 
         # Pass the page_name to the template
         page_name = page_path.split('/')[-1].replace('-', ' ')
@@ -1,8 +1,11 @@
 import io
 import os
+import re
+from unittest import mock
 from flaskr import create_app
 import pytest
-from flaskr.pages import Backend
+from flaskr.backend import Backend
+from flaskr import passwords
 
 
 backend = Backend()
@@ -102,4 +105,391 @@ def test_create_page(client):
     assert resp.status_code == 302
     assert backend.get_wiki_page(title) == content
 
-    
\ No newline at end of file
+    
+
+@pytest.fixture
+def memory_app():
+    # Same app, but the storage lives in memory so the tests can run anywhere
+    app = create_app({
+        'TESTING': True,
+        'STORAGE_DRIVER': 'memory',
+    })
+    yield app
+
+
+@pytest.fixture
+def memory_client(memory_app):
+    return memory_app.test_client()
+
+
+def test_load_user_trusts_recent_session(memory_app, memory_client):
+    memory_app.config['USER_SESSION_TRUST_SECONDS'] = 60
+    memory_client.post("/signup", data={"username": "sam", "password": "1234"})
+    memory_client.get("/")
+
+    back = memory_app.extensions['backend']
+    with mock.patch.object(back, "get_user") as get_user:
+        resp = memory_client.get("/")
+    get_user.assert_not_called()
+    assert b"sam" in resp.data
+
+
+def test_page_view(memory_app, memory_client):
+    back = memory_app.extensions['backend']
+    back.create_wiki_page("Mario", "It's a me")
+
+    resp = memory_client.get("/pages/Mario")
+    assert resp.status_code == 200
+    assert b"It&#39;s a me" in resp.data
+
+    # Missing pages send us back to the index
+    resp = memory_client.get("/pages/Luigi")
+    assert resp.status_code == 302
+
+
+def test_fetch_images_streams_ranges(memory_app, memory_client):
+    back = memory_app.extensions['backend']
+    back.config['STREAM_CHUNK_SIZE'] = 4
+    back.images_bucket.blob("mario.png").upload_from_string(
+        b"0123456789", content_type="image/png")
+
+    resp = memory_client.get("/image/mario.png")
+    assert resp.status_code == 200
+    assert resp.data == b"0123456789"
+    assert resp.mimetype == "image/png"
+    assert resp.headers["Accept-Ranges"] == "bytes"
+    etag = resp.headers["ETag"]
+
+    resp = memory_client.get("/image/mario.png", headers={"Range": "bytes=2-5"})
+    assert resp.status_code == 206
+    assert resp.data == b"2345"
+    assert resp.headers["Content-Range"] == "bytes 2-5/10"
+
+    resp = memory_client.get("/image/mario.png", headers={"Range": "bytes=20-"})
+    assert resp.status_code == 416
+
+    resp = memory_client.get("/image/mario.png",
+                             headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.data == b""
+
+    # If-None-Match compares weakly
+    for tags in ["W/" + etag, "*"]:
+        resp = memory_client.get("/image/mario.png",
+                                 headers={"If-None-Match": tags})
+        assert resp.status_code == 304
+
+    resp = memory_client.get("/image/luigi.png")
+    assert resp.status_code == 404
+
+
+def test_page_conditional_requests(memory_app, memory_client):
+    back = memory_app.extensions['backend']
+    back.create_wiki_page("Mario", "It's a me")
+
+    resp = memory_client.get("/pages/Mario")
+    assert resp.status_code == 200
+    assert resp.headers["Cache-Control"] == "public, max-age=60"
+    etag = resp.headers["ETag"]
+    assert resp.headers["Last-Modified"]
+
+    # The page isn't rendered or downloaded again for a 304, and what the
+    # validators need is fetched concurrently
+    with mock.patch.object(back, "get_page_html") as get_page_html, \
+            mock.patch.object(back, "fetch_all",
+                              wraps=back.fetch_all) as fetch_all:
+        resp = memory_client.get("/pages/Mario",
+                                 headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    get_page_html.assert_not_called()
+    fetch_all.assert_called_once()
+
+    # Changing the page changes its ETag
+    back.update_wiki_page("Mario", "Mario!")
+    resp = memory_client.get("/pages/Mario", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != etag
+
+    # So does a new renderer
+    etag = resp.headers["ETag"]
+    with mock.patch("flaskr.render.RENDERER_VERSION", "next"):
+        resp = memory_client.get("/pages/Mario",
+                                 headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+
+    resp = memory_client.get("/wiki/Mario")
+    assert resp.status_code == 200
+    resp = memory_client.get("/wiki/Mario",
+                             headers={"If-None-Match": resp.headers["ETag"]})
+    assert resp.status_code == 304
+
+
+def test_page_validators_depend_on_user(memory_app, memory_client):
+    back = memory_app.extensions['backend']
+    back.create_wiki_page("Mario", "It's a me")
+    anonymous_etag = memory_client.get("/pages/Mario").headers["ETag"]
+
+    memory_client.post("/signup", data={"username": "sam", "password": "1234"})
+    resp = memory_client.get("/pages/Mario")
+    assert resp.headers["ETag"] != anonymous_etag
+    assert resp.headers["Cache-Control"] == "private, no-cache"
+
+    # Adding the page to the favorites changes the button, so the ETag too
+    memory_client.post("/add-favs/Mario")
+    assert memory_client.get("/pages/Mario").headers["ETag"] != resp.headers["ETag"]
+
+
+def test_about_links_versioned_images(memory_app, memory_client):
+    back = memory_app.extensions['backend']
+    blob = back.images_bucket.blob("samuel.jpg")
+    blob.upload_from_string(b"jpg", content_type="image/jpeg")
+
+    resp = memory_client.get("/about")
+    assert resp.status_code == 200
+    url = f"/image/samuel.jpg?v={blob.generation}"
+    assert url.encode() in resp.data
+    # Images that aren't in the bucket keep their old link
+    assert b"web-uploads/bol.jpg" in resp.data
+
+    # The versions are cached, so the next view makes no storage request
+    with mock.patch.object(back, "get_image_blob") as get_image_blob:
+        memory_client.get("/about")
+    get_image_blob.assert_not_called()
+
+    resp = memory_client.get(url)
+    assert resp.data == b"jpg"
+    assert "immutable" in resp.headers["Cache-Control"]
+
+
+def test_search(memory_app, memory_client):
+    back = memory_app.extensions['backend']
+    back.create_wiki_page("Mario", "Mario saves the princess.")
+    back.create_wiki_page("Zelda", "Link saves princess Zelda.")
+
+    resp = memory_client.get("/search?q=%22princess+zelda%22")
+    assert resp.status_code == 200
+    assert b'href="/pages/Zelda"' in resp.data
+    assert b'href="/pages/Mario"' not in resp.data
+
+    # A new instance starts from the snapshot and the log of changes instead
+    # of reading every page
+    back.search_index.flush()
+    other = create_app({'TESTING': True, 'STORAGE_DRIVER': 'memory'})
+    other_back = other.extensions['backend']
+    other_back.client = back.client
+    other_back.bucket = back.bucket
+    with mock.patch.object(other_back.search_index, "build") as build:
+        assert [r.name for r in other_back.search("saves")] == ["Mario", "Zelda"]
+    build.assert_not_called()
+
+
+def test_page_index_pagination(memory_app, memory_client):
+    back = memory_app.extensions['backend']
+    for name in ["Mario", "Mario-Kart", "Metroid", "Zelda"]:
+        back.create_wiki_page(name, name)
+
+    resp = memory_client.get("/pages?limit=2")
+    assert b"/pages/Mario-Kart" in resp.data
+    assert b"/pages/Metroid" not in resp.data
+
+    # Follow the link to the next page
+    next_url = re.search(rb'href="(/pages\?[^"]+)"', resp.data).group(1)
+    resp = memory_client.get(next_url.decode().replace("&amp;", "&"))
+    assert b"/pages/Metroid" in resp.data
+    assert b"/pages/Zelda" in resp.data
+    assert b"Next" not in resp.data
+
+    resp = memory_client.get("/pages?prefix=Mar")
+    assert b"/pages/Mario-Kart" in resp.data
+    assert b"/pages/Zelda" not in resp.data
+
+    assert memory_client.get("/pages?cursor=%%%").status_code == 400
+    assert memory_client.get("/pages?limit=zero").status_code == 400
+
+
+def test_page_view_shows_rendered_html(memory_app, memory_client):
+    back = memory_app.extensions['backend']
+    back.create_wiki_page("Mario", "# Powers\n\nSee [[Luigi]] <b>")
+
+    resp = memory_client.get("/pages/Mario")
+    assert b"<h2>Powers</h2>" in resp.data
+    assert b'<a class="page-link" href="/pages/Luigi">Luigi</a> &lt;b&gt;' in resp.data
+
+    resp = memory_client.get("/wiki/Mario")
+    assert b"<h2>Powers</h2>" in resp.data
+
+
+def test_metrics(memory_app, memory_client, caplog):
+    back = memory_app.extensions['backend']
+    back.create_wiki_page("Mario", "It's a me")
+    back.page_cache.clear()
+    back.html_cache.clear()
+
+    # Logged at the default LOG_LEVEL, not only in debug mode
+    memory_client.get("/pages/Mario")
+    assert re.search(r"GET /pages/Mario 200 \S+ storage calls=[1-9]\d* "
+                     r"storage ms=\S+ route=/pages/<path:page_path>",
+                     caplog.text)
+
+    resp = memory_client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.mimetype == "text/plain"
+    text = resp.get_data(as_text=True)
+    assert ('wiki_storage_operations_total{operation="get_blob",'
+            'route="/pages/<path:page_path>"}') in text
+    assert ('wiki_http_request_seconds_count{route="/pages/<path:page_path>",'
+            'method="GET",status="200"} 1') in text
+    assert "# TYPE wiki_negative_cache_hits_total counter" in text
+
+
+def test_startup_is_lazy_and_measured(caplog):
+    with mock.patch("flaskr.storage._build_client") as build:
+        app = create_app({'TESTING': True, 'STORAGE_DRIVER': 'gcs'})
+    build.assert_not_called()
+
+    startup = app.extensions['startup']
+    assert startup.import_seconds > 0
+    assert startup.create_app_seconds > 0
+    assert startup.first_request_seconds is None
+
+    app.test_client().get("/")
+    assert "Cold start: import" in caplog.text
+    assert startup.first_request_seconds > 0
+    assert startup.ready_seconds > startup.first_request_seconds
+
+    text = app.test_client().get("/metrics").get_data(as_text=True)
+    assert 'wiki_startup_seconds{phase="first_request"}' in text
+
+
+def test_warmup_loads_indexes(memory_app, memory_client):
+    back = memory_app.extensions['backend']
+    back.create_wiki_page("Mario", "It's a me")
+    back.page_index.index = None
+    back.page_index._loaded_at = None
+
+    assert memory_client.get("/_ah/warmup").status_code == 200
+    assert back.page_index.index.names() == ["Mario"]
+
+
+def test_login_flood_is_turned_away(memory_app, memory_client):
+    back = memory_app.extensions['backend']
+    with mock.patch.object(back, "sign_in",
+                           side_effect=passwords.Overloaded("busy")):
+        resp = memory_client.post("/login", data={"username": "sam",
+                                                  "password": "1234"})
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "1"
+
+
+def test_upload_page_and_image(memory_app, memory_client):
+    back = memory_app.extensions['backend']
+    resp = memory_client.post("/upload", data={
+        "wikiname": "Mario",
+        "file": (io.BytesIO(b"It's a *me*"), "mario.txt"),
+        "image": (io.BytesIO(b"\x89PNG"), "mario.png"),
+    })
+    assert resp.status_code == 302
+
+    back.flush_indexing()
+    resp = memory_client.get("/pages/Mario")
+    assert b"It&#39;s a <em>me</em>" in resp.data
+    assert b"web-uploads/Mario.png" in resp.data
+
+    text = memory_client.get("/metrics").get_data(as_text=True)
+    assert 'wiki_upload_bytes_total{kind="image"} 4' in text
+    assert "wiki_upload_bytes_in_flight 0" in text
+
+
+def test_admin_import_and_export(memory_app, memory_client):
+    memory_app.config['ADMIN_USERS'] = ["boss"]
+    back = memory_app.extensions['backend']
+    back.create_wiki_page("Mario", "It's a me")
+
+    memory_client.post("/signup", data={"username": "sam", "password": "1234"})
+    assert memory_client.get("/admin/export").status_code == 403
+    memory_client.get("/logout")
+
+    memory_client.post("/signup", data={"username": "boss", "password": "1234"})
+    resp = memory_client.get("/admin/export?format=jsonl")
+    assert resp.status_code == 200
+    assert resp.mimetype == "application/x-ndjson"
+    assert b'"name": "Mario"' in resp.data
+
+    resp = memory_client.post("/admin/import", data={
+        "archive": (io.BytesIO(b'{"name": "Luigi", "content": "Mama mia"}\n'),
+                    "pages.jsonl"),
+    })
+    assert resp.status_code == 200
+    assert resp.json == {"pages": 1, "images": 0, "skipped": 0}
+    assert back.get_wiki_page("Luigi") == "Mama mia"
+
+    resp = memory_client.post("/admin/import", data={
+        "archive": (io.BytesIO(b'not json\n'), "pages.jsonl"),
+    })
+    assert resp.status_code == 400
+
+
+def test_page_history(memory_app, memory_client):
+    back = memory_app.extensions['backend']
+    back.create_wiki_page("Mario", "It's a me")
+    back.update_wiki_page("Mario", "It's a *me*, Mario")
+    back.flush_indexing()
+
+    resp = memory_client.get("/pages/Mario/history")
+    assert resp.status_code == 200
+    assert b"Revision 2" in resp.data
+    assert b"/pages/Mario/diff?from=1&amp;to=2" in resp.data
+
+    resp = memory_client.get("/pages/Mario/history/1")
+    assert b"It&#39;s a me" in resp.data
+    resp = memory_client.get("/pages/Mario/diff?from=1&to=2")
+    assert b"<ins>+It&#39;s a *me*, Mario</ins>" in resp.data
+    assert b"<del>-It&#39;s a me</del>" in resp.data
+
+    assert memory_client.get("/pages/Mario/history/3").status_code == 404
+    assert memory_client.get("/pages/Mario/diff?from=1").status_code == 400
+    assert memory_client.get("/pages/Luigi/history").status_code == 302
+
+
+def test_page_image_variants(memory_app, memory_client):
+    pytest.importorskip("PIL")
+    from PIL import Image
+
+    back = memory_app.extensions['backend']
+    back.create_wiki_page("Mario", "It's a me")
+    data = io.BytesIO()
+    Image.new('RGB', (1000, 800), 'blue').save(data, 'JPEG')
+    image = io.BytesIO(data.getvalue())
+    image.filename = "Mario.jpg"
+    back.upload_image(image)
+    back.flush_indexing()
+
+    resp = memory_client.get("/pages/Mario")
+    assert b'<source type="image/webp" srcset="' in resp.data
+    assert b'320w.jpg 320w' in resp.data
+
+    resp = memory_client.get("/pages/Mario/image?w=300",
+                             headers={"Accept": "image/webp,*/*"})
+    assert resp.status_code == 302
+    assert resp.location.endswith("/320w.webp")
+    assert "Accept" in resp.headers["Vary"]
+    assert memory_client.get("/pages/Luigi/image").status_code == 404
+
+
+def test_pages_are_sent_compressed(memory_app, memory_client):
+    import gzip
+
+    back = memory_app.extensions['backend']
+    back.create_wiki_page("Mario", "It's a me, Mario!\n\n" * 200)
+
+    resp = memory_client.get("/pages/Mario", headers={"Accept-Encoding": "gzip"})
+    assert resp.status_code == 200
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert b"It&#39;s a me, Mario!" in gzip.decompress(resp.data)
+    etag = resp.headers["ETag"]
+    assert etag.startswith('W/')
+
+    # The weak ETag still validates
+    resp = memory_client.get("/pages/Mario", headers={
+        "Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert resp.status_code == 304
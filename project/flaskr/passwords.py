@@ -0,0 +1,231 @@
+import atexit
+import base64
+import concurrent.futures
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+
+# Stored hashes look like
+#
+#     $scrypt$v=1$n=16384,r=8,p=1$<salt>$<hash>
+#
+# with the salt and hash in unpadded base64. The version and cost are part of
+# the hash, so they can change without breaking the hashes already stored.
+SCHEME = 'scrypt'
+FORMAT_VERSION = 1
+
+# scrypt cost: CPU/memory cost, block size and parallelism. n=2**14 and r=8
+# take about 16MB and tens of milliseconds per hash.
+DEFAULT_N = 2**14
+DEFAULT_R = 8
+DEFAULT_P = 1
+
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+# The worker processes shared by the whole process, built on first use by
+# `get_pool`.
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class Overloaded(Exception):
+    """
+    Raised when too many passwords are being hashed already, so the caller
+    should answer "try again later" instead of waiting.
+    """
+
+
+def hash_password(password, n=DEFAULT_N, r=DEFAULT_R, p=DEFAULT_P, salt=None):
+    """
+    Hashes a password with a new random salt. Slow on purpose, run it through
+    `PasswordHasher` rather than on a request thread.
+
+    Returns:
+        The hash, in the versioned format described above.
+    """
+    if salt is None:
+        salt = os.urandom(SALT_BYTES)
+    digest = _scrypt(password, salt, n, r, p)
+    return (f"${SCHEME}$v={FORMAT_VERSION}$n={n},r={r},p={p}"
+            f"${_b64encode(salt)}${_b64encode(digest)}")
+
+
+def check_password(password, stored):
+    """
+    Checks a password against a hash made by `hash_password`. Slow, like
+    `hash_password`.
+    """
+    n, r, p, salt, digest = parse_hash(stored)
+    return hmac.compare_digest(_scrypt(password, salt, n, r, p, len(digest)),
+                               digest)
+
+
+def parse_hash(stored):
+    """
+    Splits a hash made by `hash_password` into (n, r, p, salt, digest).
+    Raises ValueError if it's not one.
+    """
+    try:
+        _, scheme, version, cost, salt, digest = stored.split('$')
+        params = dict(item.split('=') for item in cost.split(','))
+        if scheme != SCHEME or version != f"v={FORMAT_VERSION}":
+            raise ValueError(stored)
+        return (int(params['n']), int(params['r']), int(params['p']),
+                _b64decode(salt), _b64decode(digest))
+    except (KeyError, ValueError, TypeError) as e:
+        raise ValueError("Not a password hash") from e
+
+
+def is_hash(stored):
+    """
+    Tells whether `stored` (str or bytes) is in the current format, as opposed
+    to the legacy unsalted SHA-256 of the first version of the wiki.
+    """
+    if isinstance(stored, bytes):
+        return stored.startswith(b'$' + SCHEME.encode('ascii') + b'$')
+    return isinstance(stored, str) and stored.startswith(f'${SCHEME}$')
+
+
+def legacy_digest(password):
+    """
+    The legacy hash: the unsalted SHA-256 of the password as a decimal number.
+    Only used to check passwords that were never migrated.
+    """
+    return str(int(hashlib.sha256(password.encode("utf-8")).hexdigest(), 16))
+
+
+def _scrypt(password, salt, n, r, p, length=HASH_BYTES):
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                          maxmem=n * r * 128 * 2 + 1024 * 1024,
+                          dklen=length)
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode('ascii').rstrip('=')
+
+
+def _b64decode(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4), validate=True)
+
+
+def _ready():
+    # Submitted once to start the worker processes ahead of time
+    return True
+
+
+def get_pool(workers):
+    """
+    Returns the process pool shared by every `PasswordHasher` of the process.
+
+    Workers are started with "spawn" rather than forked: a fork copies the
+    locks held by the other threads of the server, which can leave a worker
+    stuck forever.
+
+    Args:
+        workers - Number of processes. Only the first call decides it.
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'))
+            atexit.register(_pool.shutdown)
+        return _pool
+
+
+class PasswordHasher:
+    """
+    Hashes and checks passwords with scrypt, in worker processes so the KDF
+    never holds the GIL of the threads serving pages.
+
+    At most `max_pending` hashes can be queued or running at once. Past that,
+    calls raise `Overloaded` right away instead of queueing, so a flood of
+    logins only ever ties up a bounded number of request threads.
+
+    Args:
+        workers - Processes running the KDF. With 0, it runs on the calling
+        thread (still bounded by `max_pending`).
+
+        max_pending - Maximum number of hashes queued or running.
+
+        timeout - Seconds to wait for a hash before giving up with
+        `Overloaded`.
+
+        n, r, p - scrypt cost of new hashes. Hashes made with another cost
+        still verify, and are reported as needing a rehash.
+    """
+
+    def __init__(self, workers=2, max_pending=8, timeout=10.0, n=DEFAULT_N,
+                 r=DEFAULT_R, p=DEFAULT_P):
+        self.workers = workers
+        self.timeout = timeout
+        self.cost = (n, r, p)
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def hash(self, password):
+        """
+        Returns a new hash of `password`. Raises `Overloaded` if too many
+        hashes are pending.
+        """
+        return self._wait(self.hash_async(password))
+
+    def hash_async(self, password):
+        """
+        Same as `hash`, but returns a `Future` of the hash.
+        """
+        return self._submit(hash_password, password, *self.cost)
+
+    def verify(self, password, stored):
+        """
+        Checks a password against a stored hash.
+
+        Returns:
+            A (matches, needs_rehash) tuple. `needs_rehash` is True for hashes
+            made with another cost than the current one.
+
+        Raises:
+            Overloaded if too many hashes are pending.
+
+            ValueError if `stored` is not a hash made by `hash_password`.
+        """
+        n, r, p, _, _ = parse_hash(stored)
+        matches = self._wait(self._submit(check_password, password, stored))
+        return matches, matches and (n, r, p) != self.cost
+
+    def warm_up(self):
+        """
+        Starts the worker processes, so the first login doesn't wait for them.
+        """
+        if self.workers > 0:
+            self._wait(self._submit(_ready))
+
+    def _submit(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            raise Overloaded("Too many passwords being hashed")
+
+        try:
+            if self.workers > 0:
+                future = get_pool(self.workers).submit(function, *args)
+            else:
+                future = concurrent.futures.Future()
+                try:
+                    future.set_result(function(*args))
+                except Exception as e:
+                    future.set_exception(e)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _wait(self, future):
+        try:
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError as e:
+            raise Overloaded("Timed out waiting for a password hash") from e
@@ -0,0 +1,77 @@
+import concurrent.futures
+from unittest import mock
+
+import pytest
+
+from flaskr import passwords
+
+# Cheap cost, the tests don't need to be slow
+N = 2**10
+
+
+def test_hash_and_check():
+    stored = passwords.hash_password("hunter2", n=N, r=8, p=1)
+    assert stored.startswith("$scrypt$v=1$n=1024,r=8,p=1$")
+    assert passwords.is_hash(stored)
+    assert passwords.is_hash(stored.encode("ascii"))
+    assert passwords.check_password("hunter2", stored)
+    assert not passwords.check_password("hunter3", stored)
+
+    # Salted: the same password never hashes the same way twice
+    assert stored != passwords.hash_password("hunter2", n=N, r=8, p=1)
+
+
+def test_parse_hash_rejects_other_formats():
+    assert not passwords.is_hash(passwords.legacy_digest("hunter2"))
+    for stored in ["", "$scrypt$v=2$n=1,r=1,p=1$AA$AA", "$bcrypt$v=1$x$y$z",
+                   "$scrypt$v=1$n=1024$AA$AA", "$scrypt$v=1$n=1,r=1,p=1$!$AA"]:
+        with pytest.raises(ValueError):
+            passwords.parse_hash(stored)
+
+
+def test_verify_reports_old_cost():
+    hasher = passwords.PasswordHasher(workers=0, n=N)
+    assert hasher.verify("hunter2", hasher.hash("hunter2")) == (True, False)
+    assert hasher.verify("nope", hasher.hash("hunter2")) == (False, False)
+
+    old = passwords.hash_password("hunter2", n=N // 2)
+    assert hasher.verify("hunter2", old) == (True, True)
+
+
+def test_admission_control():
+
+    class Pool:
+        # Keeps every job pending until we finish it
+        def __init__(self):
+            self.jobs = []
+
+        def submit(self, function, *args):
+            future = concurrent.futures.Future()
+            self.jobs.append((future, function, args))
+            return future
+
+    pool = Pool()
+    hasher = passwords.PasswordHasher(workers=1, max_pending=2, timeout=0.01,
+                                      n=N)
+    with mock.patch("flaskr.passwords.get_pool", return_value=pool):
+        first = hasher.hash_async("a")
+        hasher.hash_async("b")
+        with pytest.raises(passwords.Overloaded):
+            hasher.hash_async("c")
+
+        # A finished job frees its slot
+        future, function, args = pool.jobs[0]
+        future.set_result(function(*args))
+        assert passwords.check_password("a", first.result())
+        hasher.hash_async("c")
+
+        # Waiting too long counts as overloaded too
+        with pytest.raises(passwords.Overloaded):
+            hasher._wait(pool.jobs[-1][0])
+
+
+def test_process_pool():
+    hasher = passwords.PasswordHasher(workers=1, n=N)
+    hasher.warm_up()
+    stored = hasher.hash("hunter2")
+    assert hasher.verify("hunter2", stored) == (True, False)
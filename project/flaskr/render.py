@@ -0,0 +1,76 @@
+import html
+import re
+import urllib.parse
+
+from markupsafe import escape
+
+# Bump this whenever the HTML produced by `render_page` changes. Stored pages
+# rendered by an older version are rendered again the next time they're read.
+RENDERER_VERSION = 1
+
+# Blank lines separate paragraphs.
+PARAGRAPH_RE = re.compile(r'\n[ \t]*\n')
+
+# "# Title" to "###### Title" on a line of its own.
+HEADING_RE = re.compile(r'^(#{1,6})[ \t]+(.+)$')
+
+# [[Page Name]] or [[Page Name|label]] links to another wiki page.
+WIKI_LINK_RE = re.compile(r'\[\[([^\]|]+)(?:\|([^\]]+))?\]\]')
+
+# **bold** and *italic*.
+BOLD_RE = re.compile(r'\*\*(.+?)\*\*')
+ITALIC_RE = re.compile(r'\*(.+?)\*')
+
+
+def render_page(text):
+    """
+    Renders the text of a page into HTML.
+
+    The text is escaped before any formatting is applied, so the only markup in
+    the result is the one added here, and it's safe to insert as is into a
+    template. Supported formatting:
+
+        - paragraphs separated by blank lines, and line breaks inside them
+        - "# Heading" lines (one to six #)
+        - **bold** and *italic*
+        - [[Page Name]] and [[Page Name|label]] links to other pages
+
+    Args:
+        text - The raw text of the page.
+
+    Returns:
+        The HTML, as a string.
+    """
+    text = text.replace('\r\n', '\n').strip('\n')
+    blocks = []
+
+    for block in PARAGRAPH_RE.split(text):
+        if not block.strip():
+            continue
+
+        heading = HEADING_RE.match(block)
+        if heading and '\n' not in block:
+            # The page title is the <h1>, so headings start at <h2>
+            level = min(len(heading.group(1)) + 1, 6)
+            blocks.append(f'<h{level}>{_inline(heading.group(2))}</h{level}>')
+        else:
+            lines = [_inline(line) for line in block.split('\n')]
+            blocks.append('<p>' + '<br>\n'.join(lines) + '</p>')
+
+    return '\n'.join(blocks)
+
+
+def _inline(line):
+    line = str(escape(line))
+    line = WIKI_LINK_RE.sub(_wiki_link, line)
+    line = BOLD_RE.sub(r'<strong>\1</strong>', line)
+    line = ITALIC_RE.sub(r'<em>\1</em>', line)
+    return line
+
+
+def _wiki_link(match):
+    # The text was already escaped, so unescape the target before quoting it
+    target = html.unescape(match.group(1).strip())
+    label = match.group(2) or match.group(1)
+    href = '/pages/' + urllib.parse.quote(target.replace(' ', '-'))
+    return f'<a class="page-link" href="{escape(href)}">{label.strip()}</a>'
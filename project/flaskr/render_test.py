@@ -0,0 +1,28 @@
+from flaskr.render import render_page
+
+
+def test_render_paragraphs_and_line_breaks():
+    assert render_page("one\ntwo\n\nthree") == (
+        "<p>one<br>\ntwo</p>\n<p>three</p>")
+    assert render_page("\n\n") == ""
+
+
+def test_render_headings_and_emphasis():
+    assert render_page("# Title\n\n**bold** and *italic*") == (
+        "<h2>Title</h2>\n<p><strong>bold</strong> and <em>italic</em></p>")
+    # A heading needs a line of its own
+    assert render_page("# Title\ntext") == "<p># Title<br>\ntext</p>"
+
+
+def test_render_wiki_links():
+    assert render_page("See [[Super Mario]]") == (
+        '<p>See <a class="page-link" href="/pages/Super-Mario">Super Mario</a></p>')
+    assert render_page("[[Luigi|his brother]]") == (
+        '<p><a class="page-link" href="/pages/Luigi">his brother</a></p>')
+
+
+def test_render_escapes_html():
+    html = render_page('<script>alert(1)</script> [[a"><b>|x]]')
+    assert "<script>" not in html
+    assert "&lt;script&gt;" in html
+    assert 'href="/pages/a%22%3E%3Cb%3E"' in html
@@ -0,0 +1,143 @@
+import collections
+import difflib
+import json
+
+# One revision of a page:
+#   number     - 1 for the first revision, then counting up.
+#   kind       - "full" if `blob` holds the whole text, "delta" if it holds the
+#                changes from the previous revision.
+#   blob       - Name of the blob holding the text or delta.
+#   generation - Generation of the page blob this revision was written as.
+#   updated    - When it was written, as an ISO 8601 string.
+#   author     - Who wrote it, or None if we don't know.
+#   size       - Length of the text of the revision, in characters.
+Revision = collections.namedtuple(
+    'Revision',
+    ['number', 'kind', 'blob', 'generation', 'updated', 'author', 'size'])
+
+FULL = 'full'
+DELTA = 'delta'
+
+# Version of the format of deltas.
+DELTA_VERSION = 1
+
+
+class RevisionLog:
+    """
+    The revisions of one page, oldest first, stored as a small JSON manifest
+    next to the revision blobs. Reading the history of a page, or finding the
+    blobs needed to rebuild a revision, only takes this one read.
+
+    Attributes:
+        generation - Generation of the manifest blob it was loaded from, 0 if
+                     there is none yet.
+    """
+
+    content_type = 'application/json'
+
+    def __init__(self, revisions=(), generation=0):
+        self.revisions = list(revisions)
+        self.generation = generation
+
+    def __len__(self):
+        return len(self.revisions)
+
+    def last(self):
+        return self.revisions[-1] if self.revisions else None
+
+    def get(self, number):
+        if 1 <= number <= len(self.revisions):
+            return self.revisions[number - 1]
+        return None
+
+    def find(self, generation):
+        """
+        Returns the revision written as `generation` of the page, or None.
+        """
+        for revision in reversed(self.revisions):
+            if revision.generation == generation:
+                return revision
+        return None
+
+    def since_snapshot(self):
+        """
+        Returns how many deltas were written since the last full snapshot.
+        """
+        count = 0
+        for revision in reversed(self.revisions):
+            if revision.kind == FULL:
+                break
+            count += 1
+        return count
+
+    def chain(self, number):
+        """
+        Returns the revisions needed to rebuild revision `number`: the closest
+        full snapshot at or before it, then every delta up to it. Returns None
+        if there is no such revision.
+        """
+        if self.get(number) is None:
+            return None
+        start = number
+        while self.revisions[start - 1].kind != FULL:
+            start -= 1
+        return self.revisions[start - 1:number]
+
+    def add(self, revision):
+        self.revisions.append(revision)
+        return True
+
+    def dumps(self):
+        return json.dumps({
+            'version': 1,
+            'revisions': [revision._asdict() for revision in self.revisions],
+        }, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, data, generation=0):
+        entries = json.loads(data)['revisions']
+        return cls([Revision(**entry) for entry in entries], generation)
+
+
+def make_delta(old, new):
+    """
+    Returns the changes turning the text `old` into `new`, as a compact JSON
+    string. Lines kept from `old` are only stored as a range, so a small edit
+    to a long page gives a small delta.
+    """
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines,
+                                      autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            # Inserted or replaced, deleted lines are just not copied
+            ops.append(''.join(new_lines[j1:j2]))
+    return json.dumps({'version': DELTA_VERSION, 'ops': ops},
+                      separators=(',', ':'))
+
+
+def apply_delta(old, delta):
+    """
+    Rebuilds the new text from `old` and a delta made by `make_delta`.
+    """
+    old_lines = old.splitlines(keepends=True)
+    parts = []
+    for op in json.loads(delta)['ops']:
+        if isinstance(op, str):
+            parts.append(op)
+        else:
+            parts.extend(old_lines[op[0]:op[1]])
+    return ''.join(parts)
+
+
+def diff(old, new, old_label, new_label):
+    """
+    Returns the unified diff between two texts, as a list of lines without
+    line endings.
+    """
+    return list(difflib.unified_diff(old.splitlines(), new.splitlines(),
+                                     old_label, new_label, lineterm=''))
@@ -0,0 +1,38 @@
+from flaskr import revisions
+from flaskr.revisions import FULL, DELTA, Revision, RevisionLog
+
+
+def test_delta_round_trip():
+    old = "Mario\nLuigi\nPeach\nBowser\n"
+    new = "Mario\nPeach\nToad\nBowser\nYoshi"
+    delta = revisions.make_delta(old, new)
+    assert revisions.apply_delta(old, delta) == new
+
+    # Kept lines are stored as ranges
+    assert "Peach" not in delta
+    assert revisions.apply_delta("", revisions.make_delta("", "Hi")) == "Hi"
+    assert revisions.apply_delta("Hi", revisions.make_delta("Hi", "")) == ""
+
+
+def test_log_chain():
+    kinds = [FULL, DELTA, DELTA, FULL, DELTA]
+    log = RevisionLog([Revision(i + 1, kind, f"{i + 1}.{kind}", i + 10, None,
+                                None, 0)
+                       for i, kind in enumerate(kinds)])
+
+    assert [r.number for r in log.chain(3)] == [1, 2, 3]
+    assert [r.number for r in log.chain(4)] == [4]
+    assert [r.number for r in log.chain(5)] == [4, 5]
+    assert log.chain(6) is None
+    assert log.chain(0) is None
+    assert log.since_snapshot() == 1
+    assert log.find(11).number == 2
+
+    loaded = RevisionLog.loads(log.dumps(), 7)
+    assert loaded.revisions == log.revisions
+    assert loaded.generation == 7
+
+
+def test_diff():
+    assert revisions.diff("a\nb\n", "a\nc\n", "r1", "r2") == [
+        "--- r1", "+++ r2", "@@ -1,2 +1,2 @@", " a", "-b", "+c"]
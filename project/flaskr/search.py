@@ -0,0 +1,286 @@
+import collections
+import math
+import re
+import zlib
+
+# Words are runs of letters, digits and underscores, compared in lower case.
+TOKEN_RE = re.compile(r"\w+")
+
+# A query is made of "quoted phrases" and single words.
+QUERY_RE = re.compile(r'"([^"]*)"|(\S+)')
+
+# BM25 parameters: how fast repeated terms saturate, and how much the length of
+# a page counts against it.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# First bytes of a snapshot, with the version of its format.
+SNAPSHOT_MAGIC = b'WSX1'
+
+# A page matching a query, and how well it matches.
+SearchResult = collections.namedtuple('SearchResult', ['name', 'score'])
+
+
+def tokenize(text):
+    return [token.lower() for token in TOKEN_RE.findall(text)]
+
+
+def parse_query(query):
+    """
+    Splits a query into the words to rank by and the phrases every result must
+    contain.
+
+    Returns:
+        A (terms, phrases) tuple. `terms` lists every word of the query,
+        `phrases` lists the quoted phrases of more than one word, each as a list
+        of words.
+    """
+    terms = []
+    phrases = []
+    for phrase, word in QUERY_RE.findall(query):
+        tokens = tokenize(phrase or word)
+        terms.extend(tokens)
+        if phrase and len(tokens) > 1:
+            phrases.append(tokens)
+    return terms, phrases
+
+
+class SearchIndex:
+    """
+    Full-text index over the wiki pages.
+
+    For every word, the index keeps the pages it appears in and the positions
+    it appears at (positional postings), so pages can be ranked with BM25 and
+    quoted phrases can be matched exactly. Pages are added, replaced and removed
+    one at a time as they are written. The whole index packs into a compressed
+    binary snapshot with `dumps`, so an instance can load it with a single read.
+
+    Args:
+        pages - (name, text) pairs of the pages to index.
+
+        generation - Generation of the snapshot blob the index was loaded from,
+        0 if it was never stored.
+    """
+
+    # Used by `StoredIndex` when storing the snapshot.
+    content_type = 'application/octet-stream'
+
+    def __init__(self, pages=(), generation=0):
+        # term -> {doc id -> [positions]}
+        self._postings = {}
+        # doc id -> page name, number of words and distinct words
+        self._names = {}
+        self._lengths = {}
+        self._terms = {}
+        self._ids = {}
+        self._next_id = 0
+        self._total_length = 0
+        self.generation = generation
+
+        for name, text in pages:
+            self.add(name, text)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, name):
+        return name in self._ids
+
+    def add(self, name, text):
+        """
+        Indexes the text of a page, replacing what was indexed for it before.
+        Always returns True, as the index changed.
+        """
+        self.remove(name)
+
+        doc = self._next_id
+        self._next_id += 1
+
+        positions = collections.defaultdict(list)
+        tokens = tokenize(text)
+        for position, token in enumerate(tokens):
+            positions[token].append(position)
+        self._add_doc(doc, name, len(tokens), positions)
+        return True
+
+    def _add_doc(self, doc, name, length, positions):
+        for term, term_positions in positions.items():
+            self._postings.setdefault(term, {})[doc] = term_positions
+
+        self._ids[name] = doc
+        self._names[doc] = name
+        self._lengths[doc] = length
+        self._terms[doc] = list(positions)
+        self._total_length += length
+
+    def remove(self, name):
+        """
+        Removes a page from the index. Returns True if it was indexed.
+        """
+        doc = self._ids.pop(name, None)
+        if doc is None:
+            return False
+
+        for term in self._terms.pop(doc):
+            postings = self._postings[term]
+            del postings[doc]
+            if not postings:
+                del self._postings[term]
+
+        del self._names[doc]
+        self._total_length -= self._lengths.pop(doc)
+        return True
+
+    def search(self, query, limit=20):
+        """
+        Finds the pages matching a query, best first.
+
+        Words are combined with OR and ranked with BM25. Quoted phrases must
+        appear exactly, in order, in every result.
+
+        Args:
+            query - The text typed by the user.
+
+            limit - Maximum number of results.
+
+        Returns:
+            A list of `SearchResult`.
+        """
+        terms, phrases = parse_query(query)
+        if not terms or not self._ids:
+            return []
+
+        scores = collections.defaultdict(float)
+        average_length = self._total_length / len(self._ids)
+        for term in set(terms):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+
+            idf = math.log(1 + (len(self._ids) - len(postings) + 0.5) /
+                           (len(postings) + 0.5))
+            for doc, positions in postings.items():
+                tf = len(positions)
+                norm = 1 - BM25_B + BM25_B * self._lengths[doc] / average_length
+                scores[doc] += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm)
+
+        results = [
+            SearchResult(self._names[doc], score)
+            for doc, score in scores.items()
+            if all(self._has_phrase(doc, phrase) for phrase in phrases)
+        ]
+        results.sort(key=lambda result: (-result.score, result.name))
+        return results[:limit]
+
+    def _has_phrase(self, doc, phrase):
+        try:
+            positions = [set(self._postings[term][doc]) for term in phrase]
+        except KeyError:
+            return False
+        return any(
+            all(start + i in positions[i] for i in range(1, len(phrase)))
+            for start in positions[0])
+
+    def dumps(self):
+        """
+        Packs the index into a compressed binary snapshot. Documents get new,
+        dense ids and positions are delta encoded as varints.
+        """
+        docs = sorted(self._ids.items())
+        new_ids = {doc: i for i, (_, doc) in enumerate(docs)}
+
+        out = bytearray(SNAPSHOT_MAGIC)
+        _write_varint(out, len(docs))
+        for name, doc in docs:
+            _write_string(out, name)
+            _write_varint(out, self._lengths[doc])
+
+        _write_varint(out, len(self._postings))
+        for term in sorted(self._postings):
+            postings = sorted(
+                (new_ids[doc], positions)
+                for doc, positions in self._postings[term].items())
+            _write_string(out, term)
+            _write_varint(out, len(postings))
+            previous_doc = 0
+            for doc, positions in postings:
+                _write_varint(out, doc - previous_doc)
+                previous_doc = doc
+                _write_varint(out, len(positions))
+                previous_position = 0
+                for position in positions:
+                    _write_varint(out, position - previous_position)
+                    previous_position = position
+
+        return zlib.compress(bytes(out))
+
+    @classmethod
+    def loads(cls, data, generation=0):
+        data = zlib.decompress(data)
+        if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError("Not a search index snapshot")
+
+        index = cls(generation=generation)
+        offset = len(SNAPSHOT_MAGIC)
+
+        doc_count, offset = _read_varint(data, offset)
+        names = []
+        lengths = []
+        for _ in range(doc_count):
+            name, offset = _read_string(data, offset)
+            length, offset = _read_varint(data, offset)
+            names.append(name)
+            lengths.append(length)
+
+        doc_positions = [{} for _ in range(doc_count)]
+        term_count, offset = _read_varint(data, offset)
+        for _ in range(term_count):
+            term, offset = _read_string(data, offset)
+            posting_count, offset = _read_varint(data, offset)
+            doc = 0
+            for _ in range(posting_count):
+                delta, offset = _read_varint(data, offset)
+                doc += delta
+                position_count, offset = _read_varint(data, offset)
+                positions = []
+                position = 0
+                for _ in range(position_count):
+                    delta, offset = _read_varint(data, offset)
+                    position += delta
+                    positions.append(position)
+                doc_positions[doc][term] = positions
+
+        for doc in range(doc_count):
+            index._add_doc(doc, names[doc], lengths[doc], doc_positions[doc])
+        index._next_id = doc_count
+        return index
+
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def _write_string(out, text):
+    encoded = text.encode('utf-8')
+    _write_varint(out, len(encoded))
+    out += encoded
+
+
+def _read_string(data, offset):
+    length, offset = _read_varint(data, offset)
+    return data[offset:offset + length].decode('utf-8'), offset + length
@@ -0,0 +1,60 @@
+from flaskr.search import SearchIndex, parse_query, tokenize
+
+
+def make_index():
+    return SearchIndex([
+        ("Super-Mario-Bros", "Super Mario Bros is a platform game. Mario "
+         "saves the princess from Bowser."),
+        ("Zelda", "Link explores Hyrule to save princess Zelda."),
+        ("Mario-Kart", "A racing game with Mario, Luigi and Bowser."),
+    ])
+
+
+def test_tokenize_and_parse_query():
+    assert tokenize("It's a-me, MARIO!") == ["it", "s", "a", "me", "mario"]
+    assert parse_query('mario "princess zelda" Bowser') == (
+        ["mario", "princess", "zelda", "bowser"], [["princess", "zelda"]])
+
+
+def test_bm25_ranking():
+    index = make_index()
+    results = index.search("mario")
+
+    # The page that mentions Mario the most, in fewer words, comes first
+    assert [r.name for r in results] == ["Super-Mario-Bros", "Mario-Kart"]
+    assert results[0].score > results[1].score
+    assert index.search("peach") == []
+    assert index.search("") == []
+
+
+def test_phrase_queries():
+    index = make_index()
+    assert [r.name for r in index.search('"princess zelda"')] == ["Zelda"]
+    assert index.search('"zelda princess"') == []
+
+
+def test_incremental_updates():
+    index = make_index()
+    index.add("Zelda", "Link fights Ganon.")
+    assert index.search("princess")[0].name == "Super-Mario-Bros"
+    assert [r.name for r in index.search("ganon")] == ["Zelda"]
+
+    assert index.remove("Mario-Kart")
+    assert not index.remove("Mario-Kart")
+    assert [r.name for r in index.search("luigi")] == []
+    assert len(index) == 2
+
+
+def test_snapshot_round_trip():
+    index = make_index()
+    index.remove("Mario-Kart")
+    loaded = SearchIndex.loads(index.dumps(), generation=3)
+
+    assert loaded.generation == 3
+    assert len(loaded) == 2
+    for query in ["mario", '"princess zelda"', "bowser save"]:
+        assert loaded.search(query) == index.search(query)
+
+    # A loaded index can still be updated
+    loaded.add("Metroid", "Samus explores Zebes.")
+    assert [r.name for r in loaded.search("samus")] == ["Metroid"]
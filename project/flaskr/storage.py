@@ -0,0 +1,823 @@
+import base64
+import datetime
+import functools
+import hashlib
+import json
+import mimetypes
+import mmap
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from google.api_core import exceptions
+
+# All of our buckets live in this project.
+PROJECT = 'sds-project-1'
+
+# Default number of pooled HTTP connections kept open to Cloud Storage.
+DEFAULT_POOL_SIZE = 10
+
+# Objects under this prefix hold data the app derives and keeps for itself
+# (indexes, manifests...). They are never wiki pages or uploads.
+META_PREFIX = '_meta/'
+
+# The process-wide client, built on first use by `get_client`.
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client(pool_size=DEFAULT_POOL_SIZE):
+    """
+    Returns the storage client shared by the whole process.
+
+    Building a `storage.Client` runs credential discovery and every client
+    opens its own connections, so we only want to pay for that once. The first
+    call builds the client, later calls return the same object no matter which
+    `pool_size` they pass.
+
+    Args:
+        pool_size - Number of connections kept alive in the HTTP pool. This
+        should be at least the number of threads serving requests.
+
+    Returns:
+        The shared `storage.Client`.
+    """
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            _client = _build_client(pool_size)
+        return _client
+
+
+def _build_client(pool_size):
+    # These take a good part of a second to import, so they are only imported
+    # once a client is actually needed, not on every cold start
+    import google.auth
+    import requests
+    from google.auth.transport.requests import AuthorizedSession
+    from google.cloud import storage
+
+    credentials, _ = google.auth.default(scopes=storage.Client.SCOPE)
+
+    # An authorized session is a `requests.Session`, so we can mount an adapter
+    # with a bigger connection pool than the default of 10 on it. Connections
+    # (and their TLS handshakes) are then reused across requests and threads.
+    session = AuthorizedSession(credentials)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+
+    return storage.Client(project=PROJECT,
+                          credentials=credentials,
+                          _http=session)
+
+
+def reset_client():
+    """
+    Drops the shared client so the next `get_client` call builds a new one.
+    Mostly useful for tests.
+    """
+    global _client
+
+    with _client_lock:
+        _client = None
+
+
+"""
+------------------------------------------------
+Storage drivers
+------------------------------------------------
+
+`Backend` only talks to buckets through the small part of the
+`google.cloud.storage` API it needs (`bucket`, `blob`, `get_blob`,
+`list_blobs`, `upload_from_string`, `download_as_bytes`...). A driver is
+anything that hands out buckets with that API:
+
+    GCSDriver    - the real thing, backed by the shared pooled client.
+    MemoryDriver - keeps every object in a dict, nothing leaves the process.
+    LocalDriver  - keeps every object as a file under a directory and reads
+                   them back through memory-mapped files.
+
+The last two let us run the whole app, load tests and benchmarks on one box
+with no network. `make_client` picks one from the app config.
+"""
+
+# Where a public object can be downloaded from, same format as
+# `google.cloud.storage.Blob.public_url`.
+PUBLIC_URL_TEMPLATE = 'https://storage.googleapis.com/{bucket}/{name}'
+
+_generation_lock = threading.Lock()
+_last_generation = 0
+
+
+def make_client(config):
+    """
+    Builds the storage driver selected by the config.
+
+    Args:
+        config - Mapping with the `STORAGE_DRIVER` key, one of "gcs", "memory"
+        or "local". The "local" driver also needs `STORAGE_ROOT`, the directory
+        holding one sub-directory per bucket, and "gcs" uses `STORAGE_POOL_SIZE`.
+        The "memory" and "local" drivers wait `STORAGE_LATENCY` seconds on every
+        request, to behave more like a remote store in benchmarks.
+
+    Returns:
+        A driver with the `bucket` and `create_bucket` methods of a
+        `storage.Client`.
+    """
+    driver = config.get('STORAGE_DRIVER', 'gcs')
+
+    if driver == 'gcs':
+        return GCSDriver(config.get('STORAGE_POOL_SIZE', DEFAULT_POOL_SIZE))
+    latency = config.get('STORAGE_LATENCY', 0)
+    if driver == 'memory':
+        return MemoryDriver(latency)
+    if driver == 'local':
+        if not config.get('STORAGE_ROOT'):
+            raise ValueError("The local storage driver needs STORAGE_ROOT")
+        return LocalDriver(config['STORAGE_ROOT'], latency)
+
+    raise ValueError(f"Unknown storage driver: {driver}")
+
+
+class GCSDriver:
+    """
+    Driver for Google Cloud Storage. Buckets come straight from the process-wide
+    client returned by `get_client`.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE):
+        self.pool_size = pool_size
+
+    @property
+    def client(self):
+        return get_client(self.pool_size)
+
+    def bucket(self, name):
+        return self.client.bucket(name)
+
+    def create_bucket(self, bucket_or_name, **kwargs):
+        return self.client.create_bucket(bucket_or_name=bucket_or_name,
+                                         **kwargs)
+
+
+class MemoryDriver:
+    """
+    Driver keeping every object in memory. Nothing is shared between two
+    `MemoryDriver` objects.
+
+    Args:
+        latency - Seconds every request waits before being served, to stand in
+        for the network.
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, name):
+        with self._lock:
+            if name not in self._stores:
+                self._stores[name] = _MemoryStore()
+            return _Bucket(name, self._stores[name], self)
+
+    def create_bucket(self, bucket_or_name, **kwargs):
+        bucket = self.bucket(_bucket_name(bucket_or_name))
+        bucket._store.create()
+        return bucket
+
+
+class LocalDriver:
+    """
+    Driver keeping every object as a file inside `root`, with one directory per
+    bucket. Reads go through `mmap`, so the page cache does the buffering and
+    we don't copy more than what is asked for.
+
+    Args:
+        root - Directory holding the buckets.
+
+        latency - Seconds every request waits before being served, like
+        `MemoryDriver`.
+    """
+
+    def __init__(self, root, latency=0):
+        self.root = root
+        self.latency = latency
+
+    def bucket(self, name):
+        return _Bucket(name, _LocalStore(os.path.join(self.root, name)), self)
+
+    def create_bucket(self, bucket_or_name, **kwargs):
+        bucket = self.bucket(_bucket_name(bucket_or_name))
+        bucket._store.create()
+        return bucket
+
+
+# Methods of buckets and blobs that make a storage request, and are therefore
+# timed and counted by `InstrumentedDriver`.
+BUCKET_OPERATIONS = frozenset(['exists', 'get_blob', 'list_blobs', 'delete_blob'])
+BLOB_OPERATIONS = frozenset([
+    'exists', 'reload', 'delete', 'upload_from_string', 'upload_from_file',
+    'download_as_bytes', 'download_as_string', 'download_as_text',
+])
+
+
+class InstrumentedDriver:
+    """
+    Wraps another driver (or a `storage.Client`) so every storage request made
+    through its buckets and blobs is timed.
+
+    Buckets and blobs are handed out as thin proxies: the methods listed in
+    `BUCKET_OPERATIONS` and `BLOB_OPERATIONS` report to `record` once they
+    return, everything else goes straight to the wrapped object. Buckets are
+    only asked from the wrapped driver on first use, so building a backend
+    doesn't build the Cloud Storage client.
+
+    Args:
+        driver - The driver doing the actual work.
+
+        record - Function called as `record(operation, seconds, failed)`
+        after every request, `failed` telling whether it raised.
+    """
+
+    def __init__(self, driver, record):
+        self.driver = driver
+        self.record = record
+
+    def bucket(self, name):
+        return _InstrumentedBucket(name, lambda: self.driver.bucket(name),
+                                   self.record)
+
+    def create_bucket(self, bucket_or_name, **kwargs):
+        bucket = self.driver.create_bucket(bucket_or_name, **kwargs)
+        return _InstrumentedBucket(bucket.name, lambda: bucket, self.record)
+
+
+def _timed(operation, method, record, wrap=None):
+
+    def call(*args, **kwargs):
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = method(*args, **kwargs)
+            if wrap is not None:
+                result = wrap(result)
+            failed = False
+            return result
+        finally:
+            record(operation, time.perf_counter() - start, failed)
+
+    return call
+
+
+class _InstrumentedBucket:
+
+    def __init__(self, name, make_bucket, record):
+        self.name = name
+        self._make_bucket = make_bucket
+        self._wrapped = None
+        self._record = record
+        self._lock = threading.Lock()
+
+    @property
+    def _bucket(self):
+        if self._wrapped is None:
+            with self._lock:
+                if self._wrapped is None:
+                    self._wrapped = self._make_bucket()
+        return self._wrapped
+
+    def blob(self, blob_name, *args, **kwargs):
+        return _InstrumentedBlob(self._bucket.blob(blob_name, *args, **kwargs),
+                                 self._record)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        attr = getattr(self._bucket, name)
+        if name == 'get_blob':
+            wrap = lambda blob: (_InstrumentedBlob(blob, self._record)
+                                 if blob is not None else None)
+        elif name == 'list_blobs':
+            return functools.partial(_list_blobs, attr, self._record)
+        elif name in BUCKET_OPERATIONS:
+            wrap = None
+        else:
+            return attr
+        return _timed(name, attr, self._record, wrap)
+
+
+def _list_blobs(list_blobs, record, *args, **kwargs):
+    # Cloud Storage lists lazily, one request per page of results, so its
+    # pages are timed as they are read. The other drivers list on the call.
+    start = time.perf_counter()
+    try:
+        listing = list_blobs(*args, **kwargs)
+    except Exception:
+        record('list_blobs', time.perf_counter() - start, True)
+        raise
+    if not hasattr(listing, 'pages'):
+        record('list_blobs', time.perf_counter() - start, False)
+    return _InstrumentedListing(listing, record)
+
+
+class _InstrumentedListing:
+    """
+    The blobs of a `list_blobs` call, read as they are iterated so listing a
+    big bucket never holds it all in memory. Each page of results read from
+    Cloud Storage is timed as one request. Anything else (`next_page_token`,
+    `prefixes`...) comes from the wrapped listing.
+    """
+
+    def __init__(self, listing, record):
+        self._listing = listing
+        self._record = record
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+    @property
+    def pages(self):
+        if not hasattr(self._listing, 'pages'):
+            # Read already, when `list_blobs` was called
+            yield [_InstrumentedBlob(blob, self._record)
+                   for blob in self._listing]
+            return
+
+        pages = iter(self._listing.pages)
+        while True:
+            start = time.perf_counter()
+            try:
+                page = next(pages)
+            except StopIteration:
+                # No request is made once the last page was read
+                return
+            except Exception:
+                self._record('list_blobs', time.perf_counter() - start, True)
+                raise
+            self._record('list_blobs', time.perf_counter() - start, False)
+            yield [_InstrumentedBlob(blob, self._record) for blob in page]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._listing, name)
+
+
+class _InstrumentedBlob:
+
+    def __init__(self, blob, record):
+        object.__setattr__(self, '_blob', blob)
+        object.__setattr__(self, '_record', record)
+
+    def __getattr__(self, name):
+        attr = getattr(self._blob, name)
+        if name in BLOB_OPERATIONS:
+            return _timed(name, attr, self._record)
+        return attr
+
+    def __setattr__(self, name, value):
+        # Properties such as `metadata` are set on the blob before uploading
+        setattr(self._blob, name, value)
+
+
+# Resumable uploads are sent in chunks that are a multiple of this size.
+UPLOAD_CHUNK_ALIGNMENT = 256 * 1024
+
+
+def upload_stream(blob, stream, chunk_size, content_type=None, on_read=None):
+    """
+    Uploads a file-like object without reading it all in memory first.
+
+    The blob gets a `chunk_size`, which makes Cloud Storage use a resumable
+    upload session: the stream is read and sent one chunk at a time, and a
+    dropped connection resumes from the last chunk the server acknowledged
+    instead of from zero.
+
+    Args:
+        blob - Blob to upload to.
+
+        stream - File-like object to read from.
+
+        chunk_size - Bytes per chunk, rounded up to a multiple of 256KB as
+        Cloud Storage requires.
+
+        content_type - Content type of the object, guessed from the blob name
+        if None.
+
+        on_read - If given, called with the number of bytes of every read
+        from `stream`.
+
+    Returns:
+        The number of bytes uploaded.
+    """
+    # Only imported when something is uploaded, like the client itself
+    from google.cloud.storage.retry import DEFAULT_RETRY
+
+    reader = _CountingReader(stream, on_read)
+    blob.chunk_size = max(1, -(-chunk_size // UPLOAD_CHUNK_ALIGNMENT)) * \
+        UPLOAD_CHUNK_ALIGNMENT
+    # Uploads overwrite whatever is there, so they're safe to retry without
+    # a precondition
+    blob.upload_from_file(reader, content_type=content_type,
+                          retry=DEFAULT_RETRY)
+    return reader.count
+
+
+class _CountingReader:
+
+    def __init__(self, stream, on_read=None):
+        self._stream = stream
+        self._on_read = on_read
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self.count += len(data)
+        if self._on_read is not None and data:
+            self._on_read(len(data))
+        return data
+
+    def tell(self):
+        # Resumable uploads note where they started reading
+        return self.count
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        # When the server acknowledged only part of a chunk, a resumable upload
+        # recovers by seeking back to the last byte it stored and sending the
+        # rest again. The count follows, so it stays the stream position.
+        self.count = self._stream.seek(offset, whence)
+        return self.count
+
+
+def _bucket_name(bucket_or_name):
+    return getattr(bucket_or_name, 'name', bucket_or_name)
+
+
+def _next_generation():
+    # Like Cloud Storage, generations are timestamps in microseconds. They must
+    # also be unique, so two writes in the same microsecond get bumped apart.
+    global _last_generation
+
+    with _generation_lock:
+        _last_generation = max(time.time_ns() // 1000, _last_generation + 1)
+        return _last_generation
+
+
+def _check_generation(name, info, if_generation_match):
+    if if_generation_match is None:
+        return
+    current = info.generation if info is not None else 0
+    if current != if_generation_match:
+        raise exceptions.PreconditionFailed(
+            f"{name}: generation {current} does not match {if_generation_match}")
+
+
+class _ObjectInfo:
+    """
+    Everything we know about a stored object except its data.
+    """
+
+    def __init__(self, size, generation, content_type, md5_hash, updated,
+                 metadata=None):
+        self.size = size
+        self.generation = generation
+        self.content_type = content_type
+        self.md5_hash = md5_hash
+        self.updated = updated
+        self.metadata = metadata
+
+    @classmethod
+    def for_data(cls, data, content_type, metadata=None):
+        return cls(size=len(data),
+                   generation=_next_generation(),
+                   content_type=content_type,
+                   md5_hash=base64.b64encode(
+                       hashlib.md5(data).digest()).decode('ascii'),
+                   updated=datetime.datetime.now(datetime.timezone.utc),
+                   metadata=metadata)
+
+    def to_json(self):
+        return {
+            'size': self.size,
+            'generation': self.generation,
+            'content_type': self.content_type,
+            'md5_hash': self.md5_hash,
+            'updated': self.updated.isoformat(),
+            'metadata': self.metadata,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        data = dict(data)
+        data['updated'] = datetime.datetime.fromisoformat(data['updated'])
+        return cls(**data)
+
+
+class _MemoryStore:
+
+    def __init__(self):
+        self._objects = {}
+        self._created = False
+        self._lock = threading.Lock()
+
+    def create(self):
+        self._created = True
+
+    def exists(self):
+        return self._created or bool(self._objects)
+
+    def stat(self, name):
+        entry = self._objects.get(name)
+        return entry[0] if entry is not None else None
+
+    def read(self, name, start=None, end=None):
+        entry = self._objects.get(name)
+        if entry is None:
+            raise exceptions.NotFound(f"No such object: {name}")
+        return _slice(entry[1], start, end)
+
+    def write(self, name, data, content_type, metadata=None,
+              if_generation_match=None):
+        with self._lock:
+            _check_generation(name, self.stat(name), if_generation_match)
+            info = _ObjectInfo.for_data(data, content_type, metadata)
+            self._objects[name] = (info, bytes(data))
+            return info
+
+    def delete(self, name, if_generation_match=None):
+        with self._lock:
+            info = self.stat(name)
+            if info is None:
+                raise exceptions.NotFound(f"No such object: {name}")
+            _check_generation(name, info, if_generation_match)
+            del self._objects[name]
+
+    def names(self, prefix=None):
+        return sorted(name for name in list(self._objects)
+                      if prefix is None or name.startswith(prefix))
+
+
+class _LocalStore:
+    # Object names may contain slashes, so they are quoted into flat file
+    # names. Quoting never produces "%m", which keeps the sidecar files that
+    # hold each object's metadata apart from the objects themselves.
+    META_SUFFIX = '%meta'
+
+    _locks = {}
+    _locks_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        with self._locks_lock:
+            self._lock = self._locks.setdefault(os.path.abspath(path),
+                                                threading.Lock())
+
+    def _file(self, name):
+        return os.path.join(self.path, urllib.parse.quote(name, safe=''))
+
+    def create(self):
+        os.makedirs(self.path, exist_ok=True)
+
+    def exists(self):
+        return os.path.isdir(self.path)
+
+    def stat(self, name):
+        try:
+            with open(self._file(name) + self.META_SUFFIX) as meta:
+                return _ObjectInfo.from_json(json.load(meta))
+        except FileNotFoundError:
+            return None
+
+    def read(self, name, start=None, end=None):
+        try:
+            with open(self._file(name), 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return b''
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    return _slice(m, start, end)
+        except FileNotFoundError:
+            raise exceptions.NotFound(f"No such object: {name}")
+
+    def write(self, name, data, content_type, metadata=None,
+              if_generation_match=None):
+        self.create()
+        with self._lock:
+            _check_generation(name, self.stat(name), if_generation_match)
+            info = _ObjectInfo.for_data(data, content_type, metadata)
+            self._replace(self._file(name), data)
+            self._replace(self._file(name) + self.META_SUFFIX,
+                          json.dumps(info.to_json()).encode('utf-8'))
+            return info
+
+    def _replace(self, path, data):
+        # Write next to the target and rename over it, so readers never see
+        # a half written file.
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def delete(self, name, if_generation_match=None):
+        with self._lock:
+            info = self.stat(name)
+            if info is None:
+                raise exceptions.NotFound(f"No such object: {name}")
+            _check_generation(name, info, if_generation_match)
+            os.remove(self._file(name) + self.META_SUFFIX)
+            os.remove(self._file(name))
+
+    def names(self, prefix=None):
+        if not self.exists():
+            return []
+        names = []
+        for entry in os.listdir(self.path):
+            if not entry.endswith(self.META_SUFFIX):
+                continue
+            name = urllib.parse.unquote(entry[:-len(self.META_SUFFIX)])
+            if prefix is None or name.startswith(prefix):
+                names.append(name)
+        return sorted(names)
+
+
+def _slice(data, start=None, end=None):
+    # `end` is inclusive, like the byte ranges of `download_as_bytes`.
+    start = start or 0
+    end = len(data) if end is None else end + 1
+    return bytes(data[start:end])
+
+
+class _Bucket:
+    """
+    A bucket of the memory or local driver, mirroring `storage.Bucket`.
+    """
+
+    def __init__(self, name, store, driver=None):
+        self.name = name
+        self._store = store
+        self._driver = driver
+
+    def _round_trip(self):
+        # Every method that would be a request to Cloud Storage calls this
+        # once, so the latency of the driver is paid per request. It is read
+        # every time, so it can be changed once the buckets exist.
+        latency = getattr(self._driver, 'latency', 0)
+        if latency:
+            time.sleep(latency)
+
+    def exists(self):
+        self._round_trip()
+        return self._store.exists()
+
+    def blob(self, blob_name):
+        return _Blob(blob_name, self)
+
+    def get_blob(self, blob_name):
+        self._round_trip()
+        info = self._store.stat(blob_name)
+        if info is None:
+            return None
+        return _Blob(blob_name, self, info)
+
+    def list_blobs(self, prefix=None, max_results=None, start_offset=None,
+                   **kwargs):
+        self._round_trip()
+        blobs = []
+        for name in self._store.names(prefix):
+            if start_offset is not None and name < start_offset:
+                continue
+            if max_results is not None and len(blobs) >= max_results:
+                break
+            info = self._store.stat(name)
+            if info is not None:
+                blobs.append(_Blob(name, self, info))
+        return blobs
+
+    def delete_blob(self, blob_name, **kwargs):
+        self.blob(blob_name).delete(**kwargs)
+
+
+class _Blob:
+    """
+    An object of the memory or local driver, mirroring `storage.Blob`. Like a
+    real blob, one made with `bucket.blob()` has no properties until it is
+    uploaded or reloaded.
+    """
+
+    def __init__(self, name, bucket, info=None):
+        self.name = name
+        self.bucket = bucket
+        self.content_type = None
+        self.metadata = None
+        # Like `storage.Blob`, setting this makes uploads resumable and sent
+        # in chunks of this many bytes
+        self.chunk_size = None
+        self._set_info(info)
+
+    def _set_info(self, info):
+        self._info = info
+        if info is not None:
+            self.content_type = info.content_type
+            self.metadata = info.metadata
+
+    @property
+    def _store(self):
+        return self.bucket._store
+
+    @property
+    def generation(self):
+        return self._info.generation if self._info else None
+
+    @property
+    def size(self):
+        return self._info.size if self._info else None
+
+    @property
+    def md5_hash(self):
+        return self._info.md5_hash if self._info else None
+
+    @property
+    def etag(self):
+        return self.md5_hash
+
+    @property
+    def updated(self):
+        return self._info.updated if self._info else None
+
+    @property
+    def public_url(self):
+        return PUBLIC_URL_TEMPLATE.format(bucket=self.bucket.name,
+                                          name=urllib.parse.quote(self.name))
+
+    def exists(self, **kwargs):
+        self.bucket._round_trip()
+        return self._store.stat(self.name) is not None
+
+    def reload(self, **kwargs):
+        self.bucket._round_trip()
+        info = self._store.stat(self.name)
+        if info is None:
+            raise exceptions.NotFound(f"No such object: {self.name}")
+        self._set_info(info)
+
+    def upload_from_string(self, data, content_type='text/plain',
+                           if_generation_match=None, **kwargs):
+        self.bucket._round_trip()
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        # Like Cloud Storage, the argument wins over the blob's property
+        content_type = content_type or self.content_type or 'text/plain'
+        self._set_info(
+            self._store.write(self.name, data, content_type, self.metadata,
+                              if_generation_match))
+
+    def upload_from_file(self, file_obj, content_type=None,
+                         if_generation_match=None, **kwargs):
+        self.bucket._round_trip()
+        content_type = (content_type or self.content_type or
+                        mimetypes.guess_type(self.name)[0] or
+                        'application/octet-stream')
+
+        if self.chunk_size:
+            # A resumable upload reads (and sends) one chunk at a time
+            chunks = []
+            while True:
+                chunk = file_obj.read(self.chunk_size)
+                if not chunk:
+                    break
+                self.bucket._round_trip()
+                chunks.append(chunk)
+            data = b''.join(chunks)
+        else:
+            data = file_obj.read()
+
+        self._set_info(
+            self._store.write(self.name, data, content_type, self.metadata,
+                              if_generation_match))
+
+    def download_as_bytes(self, start=None, end=None, if_generation_match=None,
+                          **kwargs):
+        self.bucket._round_trip()
+        info = self._store.stat(self.name)
+        if if_generation_match is not None:
+            _check_generation(self.name, info, if_generation_match)
+        data = self._store.read(self.name, start, end)
+        # Like Cloud Storage, a download tells the generation it read
+        if info is not None:
+            self._set_info(info)
+        return data
+
+    def download_as_string(self, **kwargs):
+        return self.download_as_bytes(**kwargs)
+
+    def download_as_text(self, encoding='utf-8', **kwargs):
+        return self.download_as_bytes(**kwargs).decode(encoding)
+
+    def delete(self, if_generation_match=None, **kwargs):
+        self.bucket._round_trip()
+        self._store.delete(self.name, if_generation_match)
@@ -0,0 +1,251 @@
+import io
+import time
+import pytest
+from unittest import mock
+from google.api_core import exceptions
+from flaskr import storage
+
+
+@pytest.fixture(params=["memory", "local"])
+def client(request, tmp_path):
+    if request.param == "memory":
+        return storage.MemoryDriver()
+    return storage.LocalDriver(str(tmp_path))
+
+
+def test_make_client():
+    assert isinstance(storage.make_client({'STORAGE_DRIVER': 'memory'}),
+                      storage.MemoryDriver)
+    assert isinstance(storage.make_client({}), storage.GCSDriver)
+
+    with pytest.raises(ValueError):
+        storage.make_client({'STORAGE_DRIVER': 'local'})
+
+
+def test_upload_and_download(client):
+    bucket = client.bucket("wiki-content-bucket")
+    blob = bucket.blob("Mario.txt")
+
+    # A blob handle has no properties until it is uploaded
+    assert blob.generation is None
+    assert bucket.get_blob("Mario.txt") is None
+
+    blob.upload_from_string("It's a me")
+    assert blob.generation is not None
+
+    stored = bucket.get_blob("Mario.txt")
+    assert stored.generation == blob.generation
+    assert stored.size == 9
+    assert stored.content_type == "text/plain"
+    assert stored.download_as_text() == "It's a me"
+    assert stored.download_as_bytes(start=1, end=3) == b"t's"
+
+
+def test_upload_from_file_guesses_content_type(client):
+    bucket = client.bucket("web-uploads")
+    blob = bucket.blob("Mario.png")
+    blob.upload_from_file(io.BytesIO(b"\x89PNG"))
+
+    assert bucket.get_blob("Mario.png").content_type == "image/png"
+    assert blob.public_url == "https://storage.googleapis.com/web-uploads/Mario.png"
+
+
+def test_generation_preconditions(client):
+    bucket = client.bucket("passwords-bucket")
+    bucket.blob("sam").upload_from_string("1234", if_generation_match=0)
+
+    # Creating the same object again must fail
+    with pytest.raises(exceptions.PreconditionFailed):
+        bucket.blob("sam").upload_from_string("5678", if_generation_match=0)
+
+    generation = bucket.get_blob("sam").generation
+    bucket.blob("sam").upload_from_string("5678",
+                                          if_generation_match=generation)
+
+    # The generation changed, so the old one is now stale
+    with pytest.raises(exceptions.PreconditionFailed):
+        bucket.blob("sam").upload_from_string("9999",
+                                              if_generation_match=generation)
+    assert bucket.get_blob("sam").download_as_text() == "5678"
+
+
+def test_list_and_delete(client):
+    bucket = client.bucket("wiki-content-bucket")
+    assert not bucket.exists()
+
+    for name in ["b.txt", "a.txt", "folder/c.txt"]:
+        bucket.blob(name).upload_from_string(name)
+
+    assert bucket.exists()
+    assert [b.name for b in bucket.list_blobs()] == ["a.txt", "b.txt",
+                                                     "folder/c.txt"]
+    assert [b.name for b in bucket.list_blobs(prefix="folder/")] == [
+        "folder/c.txt"
+    ]
+
+    bucket.blob("a.txt").delete()
+    assert not bucket.blob("a.txt").exists()
+    with pytest.raises(exceptions.NotFound):
+        bucket.blob("a.txt").download_as_bytes()
+
+
+def test_create_bucket(client):
+    bucket = client.create_bucket(bucket_or_name="sam-favorites")
+    assert bucket.exists()
+    assert client.bucket("sam-favorites").exists()
+
+
+def test_upload_content_type_argument_wins():
+    bucket = storage.MemoryDriver().bucket('wiki')
+    blob = bucket.blob('Mario.png')
+    blob.content_type = 'text/plain'
+    blob.upload_from_string(b"\x89PNG", content_type='image/png')
+    assert bucket.get_blob('Mario.png').content_type == 'image/png'
+
+
+def test_instrumented_driver_times_requests():
+    calls = []
+    client = storage.InstrumentedDriver(
+        storage.MemoryDriver(),
+        lambda operation, seconds, failed: calls.append((operation, failed)))
+    bucket = client.bucket('wiki')
+
+    blob = bucket.blob('Mario.txt')
+    blob.metadata = {'a': 'b'}
+    blob.upload_from_string("It's a me")
+    assert bucket.get_blob('Mario.txt').metadata == {'a': 'b'}
+    assert [b.name for b in bucket.list_blobs()] == ['Mario.txt']
+    assert bucket.get_blob('Luigi.txt') is None
+    with pytest.raises(exceptions.NotFound):
+        bucket.blob('Luigi.txt').download_as_bytes()
+
+    # Properties don't make requests
+    assert blob.generation is not None
+    assert blob.public_url.endswith('/wiki/Mario.txt')
+
+    assert calls == [
+        ('upload_from_string', False),
+        ('get_blob', False),
+        ('list_blobs', False),
+        ('get_blob', False),
+        ('download_as_bytes', True),
+    ]
+
+
+def test_instrumented_listing_is_lazy():
+    # Stands in for the listing of Cloud Storage, one request per page
+    class Listing:
+        next_page_token = "token"
+
+        def __init__(self, pages):
+            self.fetched = 0
+            self._pages = pages
+
+        @property
+        def pages(self):
+            for page in self._pages:
+                self.fetched += 1
+                yield page
+
+    blobs = [mock.Mock(name=str(i)) for i in range(5)]
+    listing = Listing([blobs[:2], blobs[2:4], blobs[4:]])
+    bucket = mock.Mock()
+    bucket.list_blobs.return_value = listing
+    calls = []
+    client = storage.InstrumentedDriver(
+        mock.Mock(bucket=lambda name: bucket),
+        lambda operation, seconds, failed: calls.append((operation, failed)))
+
+    listed = client.bucket('wiki').list_blobs()
+    assert listing.fetched == 0
+    assert calls == []
+    assert listed.next_page_token == "token"
+
+    first = next(iter(listed))
+    assert first._blob is blobs[0]
+    assert listing.fetched == 1
+    assert calls == [('list_blobs', False)]
+
+    assert len(list(client.bucket('wiki').list_blobs())) == 5
+    assert len(calls) == 4
+
+
+def test_injected_latency():
+    client = storage.MemoryDriver(latency=0.01)
+    bucket = client.bucket('wiki')
+    start = time.monotonic()
+    bucket.blob('Mario.txt').upload_from_string("It's a me")
+    bucket.get_blob('Mario.txt').download_as_text()
+    assert time.monotonic() - start >= 0.03
+
+    # Can be turned off once the buckets exist
+    client.latency = 0
+    start = time.monotonic()
+    bucket.get_blob('Mario.txt')
+    assert time.monotonic() - start < 0.01
+
+
+def test_upload_stream_sends_chunks():
+    client = storage.MemoryDriver()
+    bucket = client.bucket('wiki')
+    reads = []
+
+    with mock.patch.object(storage._Bucket, '_round_trip') as round_trip:
+        size = storage.upload_stream(bucket.blob('Mario.txt'),
+                                     io.BytesIO(b"x" * 600 * 1024), 300 * 1024,
+                                     on_read=reads.append)
+
+    assert size == 600 * 1024
+    assert sum(reads) == size
+    # Rounded up to 512KB: one request to start, and one per chunk
+    assert round_trip.call_count == 3
+    assert bucket.blob('Mario.txt').download_as_bytes() == b"x" * 600 * 1024
+
+
+def test_upload_reader_resends_partially_acknowledged_chunk():
+    from google.resumable_media import requests as resumable_requests
+
+    chunk_size = storage.UPLOAD_CHUNK_ALIGNMENT
+    content = bytes(range(256)) * (chunk_size * 2 // 256)
+    received = bytearray()
+    reads = []
+
+    def response(status, **headers):
+        result = mock.Mock(status_code=status, headers=headers)
+        result.json.return_value = {}
+        return result
+
+    def request(method, url, data=None, headers=None, timeout=None):
+        if method == 'POST':
+            return response(200, location='https://example.com/session')
+        if data is None:
+            # Asking the server where the upload is at
+            return response(308, range='bytes=0-%d' % (len(received) - 1))
+        if not received:
+            # The server only stored the first 1000 bytes of the first chunk
+            received.extend(data[:1000])
+            return response(308, range='bytes=0-999')
+        received.extend(data)
+        if len(received) < len(content):
+            return response(308, range='bytes=0-%d' % (len(received) - 1))
+        return response(200)
+
+    transport = mock.Mock(request=request)
+    reader = storage._CountingReader(io.BytesIO(content), reads.append)
+    upload = resumable_requests.ResumableUpload('https://example.com/upload',
+                                                chunk_size)
+    upload.initiate(transport, reader, {}, 'text/plain', stream_final=False)
+    while not upload.finished:
+        try:
+            upload.transmit_next_chunk(transport)
+        except ValueError:
+            # The stream is ahead of what the server acknowledged: recovering
+            # seeks back to the last byte it stored
+            upload.recover(transport)
+
+    assert bytes(received) == content
+    # The count follows the seek back instead of counting bytes twice
+    assert reader.count == reader.tell() == len(content)
+    # The second chunk was read before the upload noticed it was ahead, then
+    # everything after the first 1000 bytes was read again
+    assert reads == [chunk_size, chunk_size, chunk_size, chunk_size - 1000]
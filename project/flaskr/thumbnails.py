@@ -0,0 +1,159 @@
+import collections
+import functools
+import importlib.util
+import io
+import json
+
+# Widths, in pixels, of the variants made of every image. Images are never
+# scaled up, so smaller images get fewer variants.
+DEFAULT_WIDTHS = (320, 640, 1280)
+
+# Quality of the JPEG and WebP variants, from 1 to 100.
+DEFAULT_QUALITY = 80
+
+WEBP = 'image/webp'
+
+# Formats Pillow saves each content type in.
+_FORMATS = {'image/webp': 'WEBP', 'image/jpeg': 'JPEG', 'image/png': 'PNG'}
+_EXTENSIONS = {'image/webp': '.webp', 'image/jpeg': '.jpg',
+               'image/png': '.png'}
+
+# One resized copy of an image:
+#   width        - Its width in pixels, as used in `srcset`.
+#   content_type - "image/webp", or the JPEG or PNG fallback for browsers
+#                  without WebP.
+#   name         - Name of its blob.
+Variant = collections.namedtuple('Variant', ['width', 'content_type', 'name'])
+
+
+@functools.lru_cache(maxsize=None)
+def available():
+    """
+    Tells whether variants can be made, which takes Pillow. Without it no
+    variants are made, and pages keep showing the original images.
+    """
+    # Pillow is only imported when an image is resized, not on every cold
+    # start, so only check that it is installed
+    return importlib.util.find_spec('PIL') is not None
+
+
+def extension(content_type):
+    return _EXTENSIONS[content_type]
+
+
+def make_variants(data, widths=DEFAULT_WIDTHS, quality=DEFAULT_QUALITY):
+    """
+    Resizes an image to each of `widths` narrower than it, keeping its aspect
+    ratio, and recompresses every size as WebP (when Pillow supports it) and as
+    JPEG, or PNG for images with transparency.
+
+    Animated images are left alone, resizing them would keep a single frame.
+
+    Args:
+        data - The original image, as bytes.
+
+        widths - Widths of the variants, in pixels.
+
+        quality - Quality of the JPEG and WebP variants.
+
+    Returns:
+        A list of (width, content type, bytes) tuples, smallest first. Empty
+        if the image can't be read or is too small for any of `widths`.
+    """
+    from PIL import Image, ImageOps, features
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return []
+    if getattr(image, 'is_animated', False):
+        return []
+
+    # Photos are often stored sideways with an EXIF orientation
+    image = ImageOps.exif_transpose(image)
+    has_alpha = (image.mode in ('RGBA', 'LA', 'PA') or
+                 'transparency' in image.info)
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    content_types = [WEBP] if features.check('webp') else []
+    content_types.append('image/png' if has_alpha else 'image/jpeg')
+
+    variants = []
+    for width in sorted(set(widths)):
+        if width >= image.width:
+            break
+        height = max(1, round(image.height * width / image.width))
+        resized = image.resize((width, height), Image.LANCZOS)
+        for content_type in content_types:
+            out = io.BytesIO()
+            options = {'optimize': True}
+            if content_type != 'image/png':
+                options['quality'] = quality
+            resized.save(out, _FORMATS[content_type], **options)
+            variants.append((width, content_type, out.getvalue()))
+    return variants
+
+
+class VariantIndex:
+    """
+    The variants made of every uploaded image, by name of the original blob,
+    so picking one never takes a storage request. Images with no variants
+    (too small, or not readable) are listed too, so they're not tried again.
+    """
+
+    def __init__(self, images=(), generation=0):
+        # Blob name -> (generation of the original, [Variant...])
+        self._images = dict(images)
+        self.generation = generation
+
+    def __len__(self):
+        return len(self._images)
+
+    def __contains__(self, blob_name):
+        return blob_name in self._images
+
+    def get(self, blob_name):
+        """
+        Returns the variants of an image, smallest first, or None if none
+        were made yet.
+        """
+        entry = self._images.get(blob_name)
+        return entry[1] if entry is not None else None
+
+    def source_generation(self, blob_name):
+        entry = self._images.get(blob_name)
+        return entry[0] if entry is not None else None
+
+    def add(self, blob_name, source_generation, variants):
+        """
+        Records the variants made from `source_generation` of an image.
+        Returns True if that changed the index.
+        """
+        entry = (source_generation, sorted(variants))
+        if self._images.get(blob_name) == entry:
+            return False
+        self._images[blob_name] = entry
+        return True
+
+    def remove(self, blob_name):
+        return self._images.pop(blob_name, None) is not None
+
+    def dumps(self):
+        return json.dumps({
+            'version': 1,
+            'images': {
+                name: {'generation': generation,
+                       'variants': [list(variant) for variant in variants]}
+                for name, (generation, variants) in self._images.items()
+            },
+        }, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, data, generation=0):
+        images = json.loads(data)['images']
+        return cls({
+            name: (entry['generation'],
+                   [Variant(*variant) for variant in entry['variants']])
+            for name, entry in images.items()
+        }, generation)
@@ -0,0 +1,63 @@
+import io
+import subprocess
+import sys
+
+import pytest
+
+from flaskr import thumbnails
+from flaskr.thumbnails import Variant, VariantIndex
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def make_image(width, height, mode='RGB', format='JPEG'):
+    out = io.BytesIO()
+    Image.new(mode, (width, height), 'red').save(out, format)
+    return out.getvalue()
+
+
+def test_make_variants():
+    variants = thumbnails.make_variants(make_image(1000, 500), [320, 640, 1280])
+
+    # Never scaled up, and each width in WebP and JPEG
+    assert [(width, content_type) for width, content_type, _ in variants] == [
+        (320, 'image/webp'), (320, 'image/jpeg'),
+        (640, 'image/webp'), (640, 'image/jpeg')]
+    resized = Image.open(io.BytesIO(variants[1][2]))
+    assert resized.format == 'JPEG'
+    assert resized.size == (320, 160)
+
+
+def test_transparent_images_fall_back_to_png():
+    data = make_image(800, 800, 'RGBA', 'PNG')
+    content_types = [content_type for _, content_type, _ in
+                     thumbnails.make_variants(data, [320])]
+    assert content_types == ['image/webp', 'image/png']
+
+
+def test_unreadable_or_small_images_have_no_variants():
+    assert thumbnails.make_variants(b"not an image") == []
+    assert thumbnails.make_variants(make_image(100, 100)) == []
+
+
+def test_variant_index():
+    index = VariantIndex()
+    variants = [Variant(640, 'image/webp', 'b'), Variant(320, 'image/webp', 'a')]
+    assert index.add('Mario.png', 5, variants)
+    assert not index.add('Mario.png', 5, variants)
+    assert index.get('Mario.png')[0].width == 320
+    assert index.get('Luigi.png') is None
+
+    loaded = VariantIndex.loads(index.dumps(), 3)
+    assert loaded.get('Mario.png') == index.get('Mario.png')
+    assert loaded.source_generation('Mario.png') == 5
+    assert loaded.generation == 3
+
+
+def test_pillow_is_imported_lazily():
+    # Cold starts don't pay for importing Pillow
+    code = "import sys, flaskr; print('PIL' in sys.modules)"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True,
+                            text=True, check=True)
+    assert result.stdout.strip() == "False"
+    assert thumbnails.available()